@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+## Compiled, indexed drug resistance mutation annotation table
+
+import argparse
+import bisect
+import collections
+import os
+import pickle
+import re
+import sys
+
+Annotation = collections.namedtuple('Annotation', ['key', 'gene', 'reference', 'position', 'alternates', 'start', 'end', 'length'])
+
+# reference amino acid(s), codon position and alternates, e.g. M36LIVT or (KW)69(TT;SA)
+keyPattern = re.compile(r'^(\(?[A-Za-z]*\)?)(\d+)(.*)$')
+geneNames = {'P': 'PR', 'I': 'IN', 'RT': 'RT'}
+
+
+class AnnotationIndex():
+  """
+  Annotation entries indexed by key, by gene:position and by nucleotide coordinate
+  """
+  def __init__(self, entries):
+    self.entries = sorted(entries, key=lambda entry: (entry.start, entry.end))
+    self.starts = [entry.start for entry in self.entries]
+    self.maxLength = max([entry.end - entry.start for entry in self.entries] + [0])
+    self.keys = {entry.key: entry for entry in self.entries}
+    self.positions = {}
+    for entry in self.entries:
+      self.positions.setdefault(entry.gene + ':' + str(entry.position), []).append(entry)
+
+  @staticmethod
+  def parse(filename):
+    return AnnotationIndex(AnnotationIndex.parseEntries(filename))
+
+  @staticmethod
+  def parseEntries(filename):
+    entries = []
+    with open(filename, 'r') as annotationFile:
+      for line in annotationFile:
+        lineparts = line.split()
+        if len(lineparts) == 0:
+          continue
+        match = keyPattern.match(lineparts[0])
+        alternates = match.group(3)
+        if alternates.startswith('('):
+          alternates = alternates.strip('()').split(';')
+        else:
+          alternates = list(alternates)
+        entries.append(Annotation(lineparts[0], geneNames.get(lineparts[4], lineparts[4]), match.group(1).strip('()'),
+                                  int(match.group(2)), tuple(alternates), int(lineparts[1]), int(lineparts[2]),
+                                  int(lineparts[3])))
+    return entries
+
+  # load the compiled entries stored next to the annotation table as plain tuples,
+  # recompiling them when the table changed
+  @staticmethod
+  def load(filename):
+    compiled = filename + '.index'
+    stat = os.stat(filename)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    try:
+      with open(compiled, 'rb') as infile:
+        saved = pickle.load(infile)
+      if saved[0] == signature:
+        return AnnotationIndex([Annotation(*entry) for entry in saved[1]])
+    except (OSError, EOFError, pickle.UnpicklingError, IndexError, TypeError):
+      pass
+    entries = AnnotationIndex.parseEntries(filename)
+    index = AnnotationIndex(entries)
+    try:
+      with open(compiled + '.tmp', 'wb') as outfile:
+        pickle.dump((signature, [tuple(entry) for entry in entries]), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(compiled + '.tmp', compiled)
+    except OSError:
+      sys.stderr.write("could not write compiled annotation index " + compiled + "\n")
+    return index
+
+  def __contains__(self, key):
+    return key in self.keys
+
+  def byKey(self, key):
+    return self.keys.get(key)
+
+  # entries at a codon position, given as "RT:184" or as gene and position
+  def byPosition(self, gene, position=None):
+    if position is None:
+      gene, position = gene.split(':')
+    return self.positions.get(gene + ':' + str(position), [])
+
+  # entries overlapping the nucleotide coordinates start..end (inclusive)
+  def byRange(self, start, end):
+    first = bisect.bisect_left(self.starts, start - self.maxLength)
+    last = bisect.bisect_right(self.starts, end)
+    return [entry for entry in self.entries[first:last] if entry.end >= start]
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("lookups", help="Annotation keys, gene:position or start-end coordinate ranges", nargs='*')
+  parser.add_argument("-file", help="Annotation table", type=str, default="HIV_DR_ANNO_REVISED.txt")
+  args = parser.parse_args()
+
+  index = AnnotationIndex.load(args.file)
+  for lookup in args.lookups:
+    if ':' in lookup:
+      entries = index.byPosition(lookup)
+    elif re.match(r'^\d+-\d+$', lookup):
+      entries = index.byRange(*[int(coordinate) for coordinate in lookup.split('-')])
+    else:
+      entries = [index.byKey(lookup)] if lookup in index else []
+    for entry in entries:
+      sys.stdout.write(lookup + "\t" + entry.key + "\t" + entry.gene + "\t" + str(entry.position) + "\t" +
+                       ",".join(entry.alternates) + "\t" + str(entry.start) + "\t" + str(entry.end) + "\n")
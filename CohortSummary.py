@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+## Run-level barcode x drug and barcode x mutation matrices, cohort queries and the cohort summary sheets
+
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from DrugMetadata import lookupDrug, canonicalAbbreviation, levelNames
+
+genes = {'protease': 'PR', 'reverse_transcriptase': 'RT', 'integrase': 'IN'}
+
+
+def parseFloat(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return np.nan
+
+
+class CohortMatrix():
+  """
+  Scores and resistance levels of every barcode x drug and frequencies of every
+  barcode x mutation of a run, as dense arrays. Missing scores and absent mutations are NaN,
+  missing levels are 0
+  """
+  def __init__(self, barcodes, drugs, scores, levels, mutations, frequencies):
+    self.barcodes = np.asarray(barcodes, dtype=str)
+    self.drugs = np.asarray(drugs, dtype=str)
+    self.scores = np.asarray(scores, dtype=np.float32)
+    self.levels = np.asarray(levels, dtype=np.int8)
+    self.mutations = np.asarray(mutations, dtype=str)
+    self.frequencies = np.asarray(frequencies, dtype=np.float32)
+    self.drugColumns = {drug: i for i, drug in enumerate(self.drugs)}
+    self.mutationColumns = {mutation: i for i, mutation in enumerate(self.mutations)}
+
+  # build the matrices from {barcode: {drug: (score, level)}} and {barcode: {mutation: frequency}}
+  @staticmethod
+  def build(drugScores, mutationFrequencies):
+    barcodes = list(drugScores)
+    # columns in order of first appearance
+    drugColumns = {}
+    mutationColumns = {}
+    for barcode in barcodes:
+      for drug in drugScores[barcode]:
+        drugColumns.setdefault(drug, len(drugColumns))
+      for mutation in mutationFrequencies[barcode]:
+        mutationColumns.setdefault(mutation, len(mutationColumns))
+    drugs = list(drugColumns)
+    mutations = list(mutationColumns)
+    scores = np.full((len(barcodes), len(drugs)), np.nan, dtype=np.float32)
+    levels = np.zeros((len(barcodes), len(drugs)), dtype=np.int8)
+    frequencies = np.full((len(barcodes), len(mutations)), np.nan, dtype=np.float32)
+    for row, barcode in enumerate(barcodes):
+      for drug, (score, level) in drugScores[barcode].items():
+        scores[row, drugColumns[drug]] = score
+        levels[row, drugColumns[drug]] = level
+      for mutation, frequency in mutationFrequencies[barcode].items():
+        frequencies[row, mutationColumns[mutation]] = frequency
+    return CohortMatrix(barcodes, drugs, scores, levels, mutations, frequencies)
+
+  # from the result records of ScoreMutations, which list every called mutation
+  @staticmethod
+  def fromRecords(records):
+    drugScores = {}
+    mutationFrequencies = {}
+    for record in records:
+      drugScores[record['barcode']] = {canonicalAbbreviation(drugScore['drug']): (drugScore['score'], drugScore['level'])
+                                       for gene in record['genes'] for drugScore in gene['drugScores']}
+      mutationFrequencies[record['barcode']] = {mutation['mutation']: parseFloat(mutation['frequency'])
+                                                for mutation in record['mutations']}
+    return CohortMatrix.build(drugScores, mutationFrequencies)
+
+  # from parsed ReportGenerator profiles, which only carry the mutations that contributed a partial score
+  # and the minority variants
+  @staticmethod
+  def fromReporters(reporters):
+    drugScores = {}
+    mutationFrequencies = {}
+    for reporter in reporters:
+      scores = {}
+      frequencies = {}
+      for gene, geneScores in reporter.profile.items():
+        for drugScore in geneScores:
+          scores[canonicalAbbreviation(drugScore['drug'])] = (parseFloat(drugScore['score']), drugScore['level'])
+          for partial in drugScore['partialScores']:
+            if partial['frequency'] is not None:
+              frequencies[genes.get(gene, gene) + ':' + partial['mutations'][0]] = partial['frequency']
+      for gene, variants in reporter.minority.items():
+        for mutation, frequency in variants:
+          frequencies[genes.get(gene, gene) + ':' + mutation] = parseFloat(frequency)
+      drugScores[reporter.barcode] = scores
+      mutationFrequencies[reporter.barcode] = frequencies
+    return CohortMatrix.build(drugScores, mutationFrequencies)
+
+  def save(self, filename):
+    np.savez_compressed(filename, barcodes=self.barcodes, drugs=self.drugs, scores=self.scores, levels=self.levels,
+                        mutations=self.mutations, frequencies=self.frequencies)
+
+  @staticmethod
+  def load(filename):
+    with np.load(filename) as arrays:
+      return CohortMatrix(arrays['barcodes'], arrays['drugs'], arrays['scores'], arrays['levels'], arrays['mutations'],
+                          arrays['frequencies'])
+
+  # barcodes x drugs counts per resistance level, one column per level 0 (not scored) to 5
+  def levelCounts(self):
+    return np.stack([(self.levels == level).sum(axis=0) for level in range(len(levelNames))], axis=1)
+
+  def hasDrug(self, drug):
+    return canonicalAbbreviation(drug) in self.drugColumns
+
+  # mask of the barcodes at or above a resistance level, none for a drug the cohort was not scored for
+  def atLevel(self, drug, minLevel):
+    column = self.drugColumns.get(canonicalAbbreviation(drug))
+    if column is None:
+      return np.zeros(len(self.barcodes), dtype=bool)
+    return self.levels[:, column] >= minLevel
+
+  # number of barcodes at or above a resistance level for one drug, e.g. high-level resistant to EFV
+  def countAtLevel(self, drug, minLevel=5):
+    return int(self.atLevel(drug, minLevel).sum())
+
+  def barcodesAtLevel(self, drug, minLevel=5):
+    return self.barcodes[self.atLevel(drug, minLevel)]
+
+  # fraction of barcodes carrying each mutation at or above a frequency (percent)
+  def prevalence(self, minFrequency=0.0):
+    if len(self.barcodes) == 0:
+      return np.zeros(len(self.mutations))
+    return (self.frequencies >= minFrequency).sum(axis=0) / float(len(self.barcodes))
+
+  def medianFrequencies(self):
+    medians = np.full(len(self.mutations), np.nan)
+    detected = ~np.isnan(self.frequencies).all(axis=0)
+    medians[detected] = np.nanmedian(self.frequencies[:, detected], axis=0)
+    return medians
+
+  def medianScores(self):
+    medians = np.full(len(self.drugs), np.nan)
+    scored = ~np.isnan(self.scores).all(axis=0)
+    medians[scored] = np.nanmedian(self.scores[:, scored], axis=0)
+    return medians
+
+
+# write the drug and mutation cohort tables into a worksheet, row by row so it also
+# works in constant_memory workbooks
+def writeCohortSheet(worksheet, cohort, formats, minFrequency=20.0):
+  header = formats['main_table_header']
+  worksheet.set_column(0, 0, 24)
+  worksheet.set_column(1, 9, 14)
+  worksheet.write_row(0, 0, ['Cohort of ' + str(len(cohort.barcodes)) + ' samples'], formats['report'])
+  worksheet.write_row(2, 0, ['Drug', 'Class', 'Scored'] + list(levelNames[1:]) + ['Median score'], header)
+  counts = cohort.levelCounts()
+  medians = cohort.medianScores()
+  row = 3
+  for i, drug in enumerate(cohort.drugs):
+    metadata = lookupDrug(drug)
+    worksheet.write_row(row, 0, [drug, '' if metadata is None else metadata.drugClass, int(counts[i, 1:].sum())] +
+                        [int(count) for count in counts[i, 1:]] +
+                        ['' if np.isnan(medians[i]) else float(medians[i])])
+    row += 1
+
+  row += 1
+  worksheet.write_row(row, 0, ['Mutation', 'Samples', 'Prevalence %', 'At >= ' + str(minFrequency) + '% %',
+                               'Median frequency'], header)
+  row += 1
+  prevalence = cohort.prevalence()
+  abundant = cohort.prevalence(minFrequency)
+  medianFrequencies = cohort.medianFrequencies()
+  for i in np.argsort(-prevalence, kind='stable'):
+    worksheet.write_row(row, 0, [str(cohort.mutations[i]), int(round(prevalence[i] * len(cohort.barcodes))),
+                                 round(float(prevalence[i]) * 100, 2), round(float(abundant[i]) * 100, 2),
+                                 '' if np.isnan(medianFrequencies[i]) else float(medianFrequencies[i])])
+    row += 1
+
+
+def loadCohort(inputs):
+  if len(inputs) == 1 and inputs[0].endswith('.npz'):
+    return CohortMatrix.load(inputs[0])
+  records = []
+  reporters = []
+  for input in inputs:
+    if input.endswith('.jsonl'):
+      with open(input, 'r') as infile:
+        records.extend(json.loads(line) for line in infile if line.strip())
+    else:
+      from ReportGenerator import ReportGenerator
+      reporter = ReportGenerator(None, input)
+      reporter.parseFile(input)
+      reporters.append(reporter)
+  if len(reporters) > 0 and len(records) > 0:
+    raise ValueError("give either results files or _scores.txt profiles, not both")
+  if len(reporters) > 0:
+    return CohortMatrix.fromReporters(reporters)
+  return CohortMatrix.fromRecords(records)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("inputs", help="results.jsonl files, _scores.txt profiles or one saved .npz cohort", nargs='+')
+  parser.add_argument("-npz", help="Save the cohort matrices as a compressed .npz file", type=str)
+  parser.add_argument("-sheet", help="Write the cohort summary to this Excel workbook", type=str)
+  parser.add_argument("-drug", help="Print the barcodes at or above -level for this drug", type=str)
+  parser.add_argument("-level", help="Minimum resistance level, 5 is high-level resistance", type=int, default=5)
+  parser.add_argument("-frequency", help="Minimum mutation frequency (percent) for prevalence", type=float, default=20.0)
+  args = parser.parse_args()
+
+  try:
+    cohort = loadCohort(args.inputs)
+  except ValueError as error:
+    sys.stderr.write(str(error) + "\n")
+    sys.exit(1)
+  sys.stderr.write(str(len(cohort.barcodes)) + " barcodes, " + str(len(cohort.drugs)) + " drugs, " +
+                   str(len(cohort.mutations)) + " mutations\n")
+  if args.npz is not None:
+    cohort.save(args.npz)
+  if args.sheet is not None:
+    import xlsxwriter
+    from ReportGenerator import addExcelFormats
+    workbook = xlsxwriter.Workbook(args.sheet, {'constant_memory': True})
+    writeCohortSheet(workbook.add_worksheet('Cohort'), cohort, addExcelFormats(workbook), args.frequency)
+    workbook.close()
+
+  start = time.perf_counter()
+  counts = cohort.levelCounts()
+  prevalence = cohort.prevalence(args.frequency)
+  elapsed = time.perf_counter() - start
+  for i, drug in enumerate(cohort.drugs):
+    sys.stdout.write("%-5s %6d at level >= %d\n" % (drug, counts[i, args.level:].sum(), args.level))
+  for i in np.argsort(-prevalence, kind='stable')[:10]:
+    sys.stdout.write("%-16s %6.1f%% at >= %g%%\n" % (cohort.mutations[i], prevalence[i] * 100, args.frequency))
+  if args.drug is not None:
+    for barcode in cohort.barcodesAtLevel(args.drug, args.level):
+      sys.stdout.write(barcode + "\n")
+  sys.stderr.write("cohort queries took %.2f ms\n" % (elapsed * 1000))
+  if args.drug is not None and not cohort.hasDrug(args.drug):
+    sys.stderr.write("no " + args.drug + " scores in the cohort, scored drugs: " + ", ".join(cohort.drugs) + "\n")
+    sys.exit(1)
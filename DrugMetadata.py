@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+## Antiretroviral drug metadata and the report layout shared by the PDF and Excel reports
+
+import collections
+import types
+
+Drug = collections.namedtuple('Drug', ['abbreviation', 'name', 'brand', 'drugClass', 'aliases', 'reported'])
+
+# one entry per drug. aliases are the other abbreviations used by the HIVdb service
+# and older reports, reported drugs are always listed and shown as Susceptible when
+# the profile has no score for them
+drugs = (
+  Drug('ABC', 'Abacavir', "Ziagenu\u00AE", 'NRTI', (), True),
+  Drug('ddI', 'Didanosine', "Videx\u00AE", 'NRTI', ('DDI',), True),
+  Drug('FTC', 'Emtricitabine', "Emtriva\u00AE", 'NRTI', (), True),
+  Drug('3TC', 'Lamivudine', "Epivir\u00AE", 'NRTI', ('LMV',), True),
+  Drug('d4T', 'Stavudine', "Zerit\u00AE", 'NRTI', ('D4T',), True),
+  Drug('AZT', 'Zidovudine', "Retrovir\u00AE", 'NRTI', ('ZDV',), True),
+  Drug('TDF', 'Tenofovir disoproxil fumarate', "Viread\u00AE", 'NRTI', (), True),
+  Drug('TAF', 'Tenofovir alafenamide', "Vemlidy\u00AE", 'NRTI', (), False),
+  Drug('EFV', 'Efavirenz', "Sustiva\u00AE", 'NNRTI', (), True),
+  Drug('ETR', 'Etravirine', "Intelence\u00AE", 'NNRTI', (), True),
+  Drug('NVP', 'Nevirapine', "Viramune\u00AE", 'NNRTI', (), True),
+  Drug('RPV', 'Rilpivirine', "Edurant\u00AE", 'NNRTI', (), True),
+  Drug('DOR', 'Doravirine', "Pifeltro\u00AE", 'NNRTI', (), False),
+  Drug('DLV', 'Delavirdine', "Rescriptor\u00AE", 'NNRTI', (), False),
+  Drug('ATV', 'Atazanavir', "Reyataz\u00AE", 'PI', (), True),
+  Drug('FPV', 'Fosamprenavir', "Lexiva\u00AE", 'PI', (), True),
+  Drug('DRV', 'Darunavir', "Prezista\u00AE", 'PI', (), True),
+  Drug('IDV', 'Indinavir', "Crixivan\u00AE", 'PI', (), True),
+  Drug('LPV', 'Lopinavir', "Kaletra\u00AE", 'PI', (), True),
+  Drug('NFV', 'Nelfinavir', "Viracept\u00AE", 'PI', (), True),
+  Drug('SQV', 'Saquinavir', "Invirase\u00AE", 'PI', (), True),
+  Drug('TPV', 'Tipranavir', "Aptivus\u00AE", 'PI', (), True),
+  Drug('APV', 'Amprenavir', "Agenerase\u00AE", 'PI', (), False),
+  Drug('RAL', 'Raltegravir', "Isentress\u00AE", 'INSTI', (), True),
+  Drug('EVG', 'Elvitegravir', "Vitekta\u00AE", 'INSTI', (), True),
+  Drug('DTG', 'Dolutegravir', "Tivicay\u00AE", 'INSTI', (), True),
+  Drug('BIC', 'Bictegravir', "", 'INSTI', (), False),
+  Drug('CAB', 'Cabotegravir', "Vocabria\u00AE", 'INSTI', (), False),
+  Drug('COBI', 'Cobicistat', "Tybost\u00AE", 'booster', (), False),
+  Drug('RTV', 'Ritonavir', "Norvir\u00AE", 'booster', (), False),
+  Drug('T20', 'Enfuvirtide', "Fuzeon\u00AE", 'entry', (), False),
+  Drug('MVC', 'Maraviroc', "Selzentry\u00AE", 'entry', (), False),
+  Drug('IBA', 'Ibalizumab', "Trogarzo\u00AE", 'entry', (), False),
+)
+
+def normalizeAbbreviation(abbreviation):
+  return abbreviation.strip().upper()
+
+# normalized abbreviation or alias -> drug
+drugIndex = types.MappingProxyType({normalizeAbbreviation(alias): drug for drug in drugs
+                                    for alias in (drug.abbreviation,) + drug.aliases})
+
+# drug class -> drugs always listed in a report for that class
+reportedDrugs = types.MappingProxyType({drugClass: tuple(drug for drug in drugs if drug.drugClass == drugClass and drug.reported)
+                                        for drugClass in collections.OrderedDict.fromkeys(drug.drugClass for drug in drugs)})
+
+def lookupDrug(abbreviation):
+  return drugIndex.get(normalizeAbbreviation(abbreviation))
+
+# the canonical abbreviation of a drug, unknown drugs keep the abbreviation they came with
+def canonicalAbbreviation(abbreviation):
+  drug = lookupDrug(abbreviation)
+  return abbreviation if drug is None else drug.abbreviation
+
+
+# HIVdb resistance levels, 0 is used for a drug that was not scored
+levelNames = ('', 'Susceptible', 'Potential Low-Level Resistance', 'Low-Level Resistance', 'Intermediate Resistance',
+              'High-Level Resistance')
+levelIndex = types.MappingProxyType({name: level for level, name in enumerate(levelNames) if name})
+
+
+ReportGroup = collections.namedtuple('ReportGroup', ['heading', 'gene', 'notDetected', 'sections'])
+ReportSection = collections.namedtuple('ReportSection', ['drugClass', 'label', 'subheading', 'color'])
+
+# report layout: a numbered group per gene holding one section per drug class. The
+# PDF prints the headings, the Excel report labels the first row of each section
+# and colours its label column
+reportLayout = (
+  ReportGroup('1) Resistance to Reverse transcriptase Inhibitors (RTI)', 'reverse_transcriptase',
+              'Reverse transcriptase mutations not detected', (
+    ReportSection('NRTI', 'NRTI', 'Resistance to Nucleoside / Nucleotide RTI (NRTI)                        '
+                  'Drug Resistance Associated Mutations', 'green'),
+    ReportSection('NNRTI', 'NNRTI', 'Resistance to Non-Nucleoside RTI (NNRTI)', 'green'),
+  )),
+  ReportGroup('2) Resistance to Protease Inhibitors (PI)', 'protease', 'Protease mutations not detected', (
+    ReportSection('PI', 'PI', None, 'blue'),
+  )),
+  ReportGroup('3) Resistance to Integrase inhibitors (II)', 'integrase', 'Integrase mutations not detected', (
+    ReportSection('INSTI', 'IN', None, 'red'),
+  )),
+)
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+
+## Offline drug resistance scoring from a local penalty score table
+
+import argparse
+import collections
+import json
+import re
+import sys
+import threading
+import numpy as np
+
+# the hivdb GraphQL service names drugs by this enum, e.g. LMV for 3TC and ATV for ATV/r
+enumNames = {'3TC': 'LMV'}
+
+# a submitted mutation: gene, optional consensus amino acid, position and the called amino
+# acids, Insertion/i or Deletion/d for indels, e.g. RT:M184V, RT:K238NT, RT:D67d, RT:69Insertion
+mutationPattern = re.compile(r'^([A-Z]+):([A-Z]?)(\d+)(Insertion|Deletion|[A-Z]+|i|d)$')
+
+# HIV-1 gene lengths in codons, a position outside its gene is not a mutation the table can score
+geneLengths = {'CA': 231, 'PR': 99, 'RT': 560, 'IN': 288}
+
+# ASI condition tokens: a rule term (position and amino acids), a score, keywords and punctuation
+tokenPattern = re.compile(r'\s*(\d+[A-Za-z]+|-?\d+(?:\.\d+)?|MAX|AND|=>|\(|\)|,)')
+
+
+class LocalScorer():
+  """
+  Scores mutation lists against a versioned penalty table converted from an HIVdb ASI
+  algorithm and returns the same drugResistance structure as the hivdb GraphQL service.
+  A drug's score sums its rule items; an item scores its highest matching alternative
+  (ASI MAX groups), an alternative matching when every one of its terms does
+  (ASI combinations). Mutations the table cannot read make the mutation list unscored
+  """
+  def __init__(self, tableFile):
+    with open(tableFile, 'r') as infile:
+      table = json.load(infile)
+    self.version = table['version']
+    self.levels = sorted(table['levels'], key=lambda level: -level['minScore'])
+    self.geneOrder = [gene for gene in table['drugs']]
+    # columns of the score matrices, one per (gene, drug class, drug, display abbreviation)
+    self.drugs = [(gene, drug[0], drug[1], drug[2]) for gene in table['drugs'] for drug in table['drugs'][gene]]
+
+    # terms are 'RT:184IV' strings, alternatives tuples of term indices
+    self.terms = []
+    termIndex = {}
+    self.positionTerms = collections.defaultdict(list)
+    self.alternatives = []
+    alternativeIndex = {}
+    # per drug column, its items as ([alternative index], [score])
+    self.items = [[] for drug in self.drugs]
+    drugIndex = {drug[2]: d for d, drug in enumerate(self.drugs)}
+    for drug, items in table['rules'].items():
+      for item in items:
+        alternatives = []
+        for terms, score in item:
+          for term in terms:
+            if term not in termIndex:
+              termIndex[term] = len(self.terms)
+              self.terms.append(term)
+              position, aminoAcids = re.match(r'^(\w+:\d+)(\D+)$', term).groups()
+              self.positionTerms[position].append((termIndex[term], set(aminoAcids)))
+          key = tuple(termIndex[term] for term in terms)
+          if key not in alternativeIndex:
+            alternativeIndex[key] = len(self.alternatives)
+            self.alternatives.append(key)
+          alternatives.append((alternativeIndex[key], score))
+        self.items[drugIndex[drug]].append(([a for a, score in alternatives], [score for a, score in alternatives]))
+
+    # single alternative items add up linearly, MAX groups are evaluated one by one
+    self.weights = np.zeros((len(self.alternatives), len(self.drugs)))
+    self.groups = []
+    # per alternative, the (drug column, item, score) it can contribute to
+    self.alternativeItems = collections.defaultdict(list)
+    for d, items in enumerate(self.items):
+      for i, (alternatives, scores) in enumerate(items):
+        if len(alternatives) == 1:
+          self.weights[alternatives[0], d] += scores[0]
+        else:
+          self.groups.append((d, np.array(alternatives), np.array(scores, dtype=float)))
+        for a, score in zip(alternatives, scores):
+          self.alternativeItems[a].append((d, i, score))
+    self.combinations = [(a, list(terms)) for a, terms in enumerate(self.alternatives) if len(terms) > 1]
+    self.uncovered = collections.Counter()
+    self.lock = threading.Lock()
+
+  # gene, position key, amino acids and hivdb text of a submitted mutation, None if unreadable
+  def parse(self, mutation):
+    match = mutationPattern.match(mutation)
+    if match is None:
+      return None
+    gene, consensus, position, called = match.groups()
+    if not 0 < int(position) <= geneLengths.get(gene, 0):
+      return None
+    if called in ('Insertion', 'i'):
+      # the api's generic 69Insertion is reported against the T69 consensus
+      if consensus == '' and gene + position == 'RT69':
+        consensus = 'T'
+      return gene, gene + ':' + position, set('i'), consensus + position + 'Insertion'
+    if called in ('Deletion', 'd'):
+      return gene, gene + ':' + position, set('d'), consensus + position + 'Deletion'
+    return gene, gene + ':' + position, set(called), consensus + position + called
+
+  def level(self, score):
+    for level in self.levels:
+      if score >= level['minScore']:
+        return level
+    return self.levels[-1]
+
+  # score every mutation list at once. Lists holding a mutation the table cannot read,
+  # or one in a gene it has no drugs for, are returned as None and counted in uncovered
+  def score(self, mutationLists):
+    present = np.zeros((len(mutationLists), len(self.terms)), dtype=bool)
+    matchedTexts = []
+    covered = []
+    for i, mutations in enumerate(mutationLists):
+      texts = {}
+      ok = True
+      for mutation in mutations:
+        parsed = self.parse(mutation)
+        if parsed is None or parsed[0] not in self.geneOrder:
+          with self.lock:
+            self.uncovered[mutation] += 1
+          ok = False
+          continue
+        gene, position, aminoAcids, text = parsed
+        for term, termAminoAcids in self.positionTerms.get(position, []):
+          if aminoAcids & termAminoAcids:
+            present[i, term] = True
+            texts.setdefault(term, text)
+      matchedTexts.append(texts)
+      covered.append(ok)
+
+    alternativesPresent = present[:, [terms[0] for terms in self.alternatives]]
+    for a, terms in self.combinations:
+      alternativesPresent[:, a] = present[:, terms].all(axis=1)
+    scores = alternativesPresent @ self.weights
+    for d, alternatives, groupScores in self.groups:
+      best = np.where(alternativesPresent[:, alternatives], groupScores, -np.inf).max(axis=1)
+      scores[:, d] += np.where(np.isinf(best), 0.0, best)
+
+    return [self.drugResistance(mutations, matchedTexts[i], alternativesPresent[i], scores[i]) if covered[i] else None
+            for i, mutations in enumerate(mutationLists)]
+
+  def drugResistance(self, mutations, texts, alternativesPresent, scores):
+    genes = set(mutation.split(':')[0] for mutation in mutations)
+    scores = scores.tolist()
+    # the contributing (score, alternative) of every matched item per drug column
+    best = collections.defaultdict(dict)
+    for a in np.flatnonzero(alternativesPresent).tolist():
+      for d, i, score in self.alternativeItems[a]:
+        if i not in best[d] or (score, a) > best[d][i]:
+          best[d][i] = (score, a)
+    output = []
+    for gene in self.geneOrder:
+      if gene not in genes:
+        continue
+      drugScores = []
+      for d, drug in enumerate(self.drugs):
+        if drug[0] != gene:
+          continue
+        partialScores = [{'mutations': [{'text': texts[term]} for term in self.alternatives[a]], 'score': float(score)}
+                         for i, (score, a) in sorted(best[d].items()) if score != 0]
+        level = self.level(scores[d])
+        drugScores.append({'drugClass': {'name': drug[1]}, 'drug': {'name': drug[2], 'displayAbbr': drug[3]},
+                           'SIR': level['SIR'], 'score': scores[d], 'level': level['level'],
+                           'text': level['text'], 'partialScores': partialScores})
+      output.append({'gene': {'name': gene}, 'drugScores': drugScores})
+    return output
+
+  def close(self):
+    if len(self.uncovered) > 0:
+      sys.stderr.write("local scorer: barcodes with mutations outside the " + self.version + " penalty table were not "
+                       "scored: " + ", ".join(mutation + " x" + str(count) for mutation, count in
+                                              self.uncovered.most_common()) + "\n")
+
+
+# read a recorded _scores.txt file into {gene: {drug: [drugClass, score, text, [(mutation, score)]]}}.
+# A combination is recorded under its first mutation only
+def readRecordedScores(filename):
+  recorded = collections.OrderedDict()
+  gene = None
+  with open(filename, 'r') as infile:
+    for line in infile:
+      lineparts = line.split()
+      if len(lineparts) == 1 and lineparts[0] in ('PR', 'RT', 'IN'):
+        gene = lineparts[0]
+        recorded[gene] = collections.OrderedDict()
+      elif gene is not None and len(lineparts) >= 4 and lineparts[0] in ('PI', 'NRTI', 'NNRTI', 'INSTI'):
+        partials = []
+        if lineparts[-1].startswith('('):
+          for partial in lineparts[-1].strip('(),').split(','):
+            fields = partial.split(':')
+            partials.append((fields[0], float(fields[1])))
+          lineparts = lineparts[:-1]
+        recorded[gene][lineparts[1]] = [lineparts[0], float(lineparts[2]), " ".join(lineparts[3:]), partials]
+  return recorded
+
+
+# the items of an ASI SCORE FROM condition as [[[terms], score], ...], an item of several
+# alternatives being a MAX group
+def parseCondition(condition, gene):
+  tokens = tokenPattern.findall(condition.replace('SCORE FROM', '', 1))
+  position = 0
+
+  def take(expected=None):
+    nonlocal position
+    token = tokens[position]
+    if expected is not None and token != expected:
+      raise ValueError("expected " + expected + " in the ASI condition, found " + token)
+    position += 1
+    return token
+
+  def alternative():
+    parenthesized = tokens[position] == '('
+    if parenthesized:
+      take('(')
+    terms = [gene + ':' + take()]
+    while tokens[position] == 'AND':
+      take('AND')
+      terms.append(gene + ':' + take())
+    if parenthesized:
+      take(')')
+    take('=>')
+    return [terms, float(take())]
+
+  items = []
+  take('(')
+  while tokens[position] != ')':
+    if tokens[position] == 'MAX':
+      take('MAX')
+      take('(')
+      group = [alternative()]
+      while tokens[position] == ',':
+        take(',')
+        group.append(alternative())
+      take(')')
+      items.append(group)
+    else:
+      items.append([alternative()])
+    if tokens[position] == ',':
+      take(',')
+  return items
+
+# convert an HIVdb ASI algorithm XML file into a penalty table
+def buildTable(algorithmFile):
+  import xml.etree.ElementTree as ElementTree
+  root = ElementTree.parse(algorithmFile).getroot()
+  definitions = root.find('DEFINITIONS')
+  classGenes = {}
+  for definition in definitions.findall('GENE_DEFINITION'):
+    for drugClass in definition.findtext('DRUGCLASSLIST').split(','):
+      classGenes[drugClass.strip()] = definition.findtext('NAME')
+  drugClasses = {}
+  for drugClass in definitions.findall('DRUGCLASS'):
+    for drug in drugClass.findtext('DRUGLIST').split(','):
+      drugClasses[drug.strip()] = drugClass.findtext('NAME')
+  levelNames = {int(level.findtext('ORDER')): (level.findtext('ORIGINAL'), level.findtext('SIR'))
+                for level in definitions.findall('LEVEL_DEFINITION')}
+  levels = []
+  for low, level in re.findall(r'(-INF|-?\d+)\s+TO\s+(?:INF|-?\d+)\s*=>\s*(\d+)', definitions.findtext('GLOBALRANGE')):
+    text, sir = levelNames[int(level)]
+    # scores below the lowest bound fall to the last level
+    levels.append({'minScore': 0 if low == '-INF' else int(low), 'level': int(level), 'text': text, 'SIR': sir})
+
+  drugs = collections.OrderedDict()
+  rules = collections.OrderedDict()
+  for drug in root.findall('DRUG'):
+    abbreviation = drug.findtext('NAME')
+    drugClass = drugClasses[abbreviation]
+    gene = classGenes[drugClass]
+    name = enumNames.get(abbreviation, abbreviation.split('/')[0])
+    drugs.setdefault(gene, []).append([drugClass, name, abbreviation])
+    rules[name] = parseCondition(drug.find('RULE').findtext('CONDITION'), gene)
+  return {
+    'version': root.findtext('ALGNAME') + ' ' + root.findtext('ALGVERSION'),
+    'source': 'converted from the ' + root.findtext('ALGNAME') + ' ' + root.findtext('ALGVERSION') + ' ASI algorithm (' +
+              root.findtext('ALGDATE') + '), Stanford HIV Drug Resistance Database',
+    'levels': levels,
+    'drugs': drugs,
+    'rules': rules
+  }
+
+
+# compare local scores with recorded remote responses, the submitted mutations
+# are reconstructed from the recorded partial scores so genes without any scored
+# mutation cannot be reconstructed and are skipped. Combinations are compared by
+# their first mutation, the only one a recorded text view keeps
+def checkParity(scorer, filenames):
+  compared = 0
+  mismatches = []
+  for filename in filenames:
+    recorded = readRecordedScores(filename)
+    mutations = []
+    for gene in recorded:
+      for drug in recorded[gene]:
+        for mutation, score in recorded[gene][drug][3]:
+          if gene + ':' + mutation not in mutations:
+            mutations.append(gene + ':' + mutation)
+    if len(mutations) == 0:
+      continue
+    scored = scorer.score([mutations])[0]
+    local = {} if scored is None else {drugDef['drug']['name']: drugDef for gene in scored for drugDef in gene['drugScores']}
+    for gene in recorded:
+      if not any(mutation.startswith(gene + ':') for mutation in mutations):
+        continue
+      for drug, (drugClass, score, text, partials) in recorded[gene].items():
+        compared += 1
+        drugDef = local.get(drug)
+        localPartials = None if drugDef is None else collections.Counter(
+          (partial['mutations'][0]['text'], partial['score']) for partial in drugDef['partialScores'])
+        if (drugDef is None or drugDef['score'] != score or drugDef['text'] != text or
+            localPartials != collections.Counter(partials)):
+          mismatches.append((filename, drug, score, text, None if drugDef is None else drugDef['score']))
+  return compared, mismatches
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("recorded", help="Recorded _scores.txt files from the remote service", nargs='*')
+  parser.add_argument("-table", help="Penalty score table", type=str, default="HIVDB_PENALTY_SCORES.json")
+  parser.add_argument("-build", help="Convert this HIVdb ASI algorithm XML file into the penalty table", type=str)
+  args = parser.parse_args()
+
+  if args.build is not None:
+    with open(args.table, 'w') as outfile:
+      json.dump(buildTable(args.build), outfile, indent=1, sort_keys=False)
+      outfile.write("\n")
+
+  if len(args.recorded) > 0:
+    compared, mismatches = checkParity(LocalScorer(args.table), args.recorded)
+    for filename, drug, score, text, localScore in mismatches:
+      sys.stdout.write(filename + "  " + drug + "  recorded " + str(score) + " " + text + "  local " + str(localScore) + "\n")
+    sys.stdout.write(str(compared - len(mismatches)) + " of " + str(compared) + " drug scores match the recorded responses\n")
+    sys.exit(1 if len(mismatches) > 0 else 0)
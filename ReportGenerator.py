@@ -2,18 +2,219 @@
 
 ## Generate PDF report
 
-from subprocess import call
+import io
 import os
 import re
 import sys
 import argparse
-from fpdf import FPDF
-import xlsxwriter
+import json
+from DrugMetadata import lookupDrug, canonicalAbbreviation, levelIndex, reportedDrugs, reportLayout
+
+# fpdf, xlsxwriter and numpy (CohortSummary) are imported by the functions rendering
+# their format, so a PDF-only or Excel-only job never loads the others
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# logo images are read from the working directory, falling back to the ones next to this module
+def logoFile(filename):
+  if os.path.exists(filename):
+    return filename
+  return os.path.join(HERE, filename)
+
+
+# read the structured result records written by ScoreMutations, one per line
+def readResults(filename):
+  with open(filename, 'r') as infile:
+    for line in infile:
+      if line.strip():
+        yield json.loads(line)
+
+
+# profiles stored in a run archive: the result records of its results.jsonl entries,
+# otherwise (entry name, text) for each of its _scores.txt entries
+def readArchive(filename):
+  import zipfile
+  with zipfile.ZipFile(filename, 'r') as archive:
+    names = archive.namelist()
+    results = [name for name in names if os.path.basename(name) == 'results.jsonl']
+    if len(results) > 0:
+      for name in results:
+        for line in archive.read(name).decode('utf-8').splitlines():
+          if line.strip():
+            yield json.loads(line)
+    else:
+      for name in names:
+        if name.endswith('_scores.txt'):
+          yield (filename + ':' + name, archive.read(name).decode('utf-8'))
+
+# the _scores.txt profile of one barcode, read through the archive index
+def archiveProfile(filename, barcode):
+  import zipfile
+  with zipfile.ZipFile(filename, 'r') as archive:
+    return archive.read(barcode + '_scores.txt').decode('utf-8')
+
+
+class PDFTemplate():
+  """
+  Static PDF page assets (the logo images) decoded once per process and shared by every document
+  """
+  logos = ['CFAR-logo.jpg', 'jcrc_logo-1.jpg']
+
+  def __init__(self):
+    from fpdf import FPDF
+    pdf = FPDF(orientation='P', unit='mm', format='A4')
+    pdf.add_page()
+    for logo in self.logos:
+      pdf.image(logoFile(logo), x=0, y=0, h=1, w=1)
+    self.images = pdf.images
+
+  # a new document with the decoded logos already registered, so fpdf reuses them
+  # instead of reading and parsing the files again
+  def newDocument(self):
+    from fpdf import FPDF
+    pdf = FPDF(orientation='P', unit='mm', format='A4')
+    for name in self.images:
+      pdf.images[name] = dict(self.images[name])
+    return pdf
+
+pdfTemplate = None
+
+def getPDFTemplate():
+  global pdfTemplate
+  if pdfTemplate is None:
+    pdfTemplate = PDFTemplate()
+  return pdfTemplate
+
+# render several profiles into one PDF, one page per barcode sharing a single
+# copy of each logo image
+def generateCombinedPDFReport(reporters, filename):
+  pdf = getPDFTemplate().newDocument()
+  for reporter in reporters:
+    reporter.renderPDFPage(pdf)
+  pdf.output(filename)
+
+
+# cell formats shared by every worksheet of a workbook
+def addExcelFormats(workbook):
+  return {
+    'bold': workbook.add_format({'bold': True}),
+    'brand_header': workbook.add_format({'font_color': 'blue', 'bold': True}),
+    'report': workbook.add_format({'font_color': 'red', 'bold': True}),
+    'metadata_header': workbook.add_format({'bg_color': '#F1C096', 'bold': True}),
+    'green': workbook.add_format({'bg_color': '#397d22', 'font_color': '#FFFFFF'}),
+    'call_color': workbook.add_format({'font_color': 'green', 'bold': True}),
+    'call_color_grey': workbook.add_format({'font_color': 'green', 'bold': True, 'bg_color': '#c9d2d6'}),
+    'grey': workbook.add_format({'bg_color': '#c9d2d6'}),
+    'blue': workbook.add_format({'bg_color': '#2e0cb3', 'font_color': '#FFFFFF'}),
+    'red': workbook.add_format({'bg_color': '#8f1507', 'font_color': '#FFFFFF'}),
+    'main_table_header': workbook.add_format({'bg_color': '#000000', 'font_color': '#FFFFFF',
+                                              'bold': True, 'center_across': True}),
+    'psub_header': workbook.add_format({'font_color': 'purple', 'center_across': True, 'font_size': 8})
+  }
+
+# sample worksheets per workbook. With constant_memory every worksheet keeps a temporary
+# file open until its workbook is closed, so a larger cohort is split over several workbooks
+sheetsPerWorkbook = 250
+
+# the files of a workbook split in parts: cohort.xlsx, cohort-2.xlsx, cohort-3.xlsx, ...
+def workbookFiles(filename, parts):
+  base, extension = os.path.splitext(filename)
+  return [filename] + [base + '-' + str(part) + extension for part in range(2, parts + 1)]
+
+# fail before writing anything when a workbook would need more open files than allowed
+def checkOpenFiles(sheets):
+  try:
+    import resource
+  except ImportError:
+    return
+  limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+  if limit != resource.RLIM_INFINITY and sheets + 64 > limit:
+    raise ValueError("a workbook of " + str(sheets) + " worksheets needs more than the " + str(limit) + " open files "
+                     "allowed, lower the sheets per workbook or raise the limit (ulimit -n)")
+
+# write many profiles into workbooks of at most sheets sample worksheets each. The first
+# has a summary sheet with one row per barcode and a cohort sheet with per-drug and
+# per-mutation totals for every profile, all share one set of formats. Memory stays flat
+# because constant_memory streams each row to disk as it is finished. Returns the files written
+def generateExcelWorkbook(reporters, filename, sheets=sheetsPerWorkbook):
+  import xlsxwriter
+  from CohortSummary import CohortMatrix, writeCohortSheet
+  sheets = max(sheets, 1)
+  checkOpenFiles(sheets + 2)
+  parts = [reporters[first:first + sheets] for first in range(0, len(reporters), sheets)] or [[]]
+  filenames = workbookFiles(filename, len(parts))
+  drugs = []
+  for reporter in reporters:
+    for gene in ('reverse_transcriptase', 'protease', 'integrase'):
+      for drugScore in reporter.profile[gene]:
+        if canonicalAbbreviation(drugScore['drug']) not in drugs:
+          drugs.append(canonicalAbbreviation(drugScore['drug']))
+
+  sheetNames = set(['summary', 'cohort'])
+  for index, partFile in enumerate(filenames):
+    workbook = xlsxwriter.Workbook(partFile, {'constant_memory': True})
+    formats = addExcelFormats(workbook)
+    if index == 0:
+      summary = workbook.add_worksheet('Summary')
+      summary.set_column(0, 0, 22)
+      summary.set_column(1, len(drugs), 14)
+      summary.write_row(0, 0, ['Barcode'] + drugs, formats['main_table_header'])
+      for row, reporter in enumerate(reporters, 1):
+        calls = {}
+        for gene in ('reverse_transcriptase', 'protease', 'integrase'):
+          for drugScore in reporter.profile[gene]:
+            calls[canonicalAbbreviation(drugScore['drug'])] = drugScore['text']
+        summary.write_row(row, 0, [reporter.barcode] + [calls.get(drug, '') for drug in drugs])
+      writeCohortSheet(workbook.add_worksheet('Cohort'), CohortMatrix.fromReporters(reporters), formats)
+
+    for reporter in parts[index]:
+      # worksheet names are limited to 31 characters, cannot contain []:*?/\ and must be unique
+      baseName = re.sub(r'[\[\]:*?/\\]', '_', reporter.barcode) or 'Sample'
+      sheetName = baseName[:31]
+      suffix = 1
+      while sheetName.lower() in sheetNames:
+        suffix += 1
+        sheetName = baseName[:28] + '_' + str(suffix)
+      sheetNames.add(sheetName.lower())
+      reporter.writeExcelSheet(workbook.add_worksheet(sheetName), formats)
+    workbook.close()
+  return filenames
+
+
+geneNames = {'PR': 'protease', 'RT': 'reverse_transcriptase', 'IN': 'integrase'}
+
+
+def parseNumber(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+# frequencies are shown with two decimals whether read from a text view or a record
+def formatFrequency(frequency):
+  return "%.2f" % frequency
+
+# a drug score line of a _scores.txt text view (class, drug, score, a one to three word
+# interpretation, then the partial scores) in the layout of the drugScores of a result record
+def textDrugScore(lineparts):
+  text = " ".join(part for part in lineparts[3:] if not part.startswith('('))
+  partialScores = []
+  if lineparts[-1].startswith('('):
+    for partial in lineparts[-1].strip('(),').split(','):
+      # older profiles list mutation:score without the frequency
+      fields = partial.split(':') + [None]
+      if len(fields) < 3 or fields[0] == '':
+        continue
+      partialScores.append({'mutations': [fields[0]], 'score': parseNumber(fields[1]), 'frequency': parseNumber(fields[2])})
+  return {'drugClass': lineparts[0], 'drug': lineparts[1], 'score': parseNumber(lineparts[2]), 'level': levelIndex.get(text, 0),
+          'SIR': None, 'text': text, 'partialScores': partialScores}
 
 
 class ReportGenerator():
   """
-  Class for generating a pdf report for the mutation profile of a single sample
+  Class for generating a pdf report for the mutation profile of a single sample. The
+  profile holds the drug scores of every gene in the layout of a result record
   """
   def __init__(self, reportTitle, profileFile):
     self.reportTitle = reportTitle
@@ -24,212 +225,157 @@ class ReportGenerator():
     }
     self.barcode = ""
     self.profileFile = profileFile
-    self.brandDict = {'ABC': "Ziagenu\u00AE", 'ddI': "Videx\u00AE", 'FTC': "Emtriva\u00AE",
-                      '3TC': "Epivir\u00AE", 'd4T': "Zerit\u00AE", 'AZT': "Retrovir\u00AE",
-                      'TDF': "Viread\u00AE", 'EFV': "Sustiva\u00AE", 'ETR': "Intelence\u00AE", 'NVP': "Viramune\u00AE", 'RPV': "Edurant\u00AE",
-                      'ATV': "Reyataz\u00AE", 'FPV': "Lexiva\u00AE", 'DRV': "Prezista\u00AE",
-                      'IDV': "Crixivan\u00AE", 'LPV': "Kaletra\u00AE", 'NFV': "Viracept\u00AE", 'SQV': "Invirase\u00AE", 'TPV': "Aptivus\u00AE",
-                      'RAL': "Isentress\u00AE", 'DTG': "Tivicay\u00AE",
-                      'DDI': "Videx\u00AE", 'D4T': "Zerit\u00AE", 'LMV': "Epivir\u00AE",
-                      'DOR': "Pifeltro\u00AE", 'EVG': "Vitekta\u00AE"}
-    self.drugDict = {'3TC': 'Lamivudine', 'ABC': 'Abacavir', 'APV': 'Amprenavir',
-                     'ATV': 'Atazanavir', 'BIC': 'Bictegravir', 'COBI': 'Cobicistat',
-                     'd4T': 'Stavudine', 'ddI': 'Didanosine','DLV': 'Delavirdine',
-                     'DOR': 'Doravirine', 'DRV': 'Darunavir', 'DTG': 'Dolutegravir',
-                     'EFV': 'Efavirenz', 'ETR': 'Etravirine', 'EVG': 'Elvitegravir',
-                     'FPV': 'Fosamprenavir', 'FTC': 'Emtricitabine', 'IBA': 'Ibalizumab',
-                     'IDV': 'Indinavir', 'LPV': 'Lopinavir', 'MVC': 'Maraviroc',
-                     'NFV': 'Nelfinavir', 'NVP': 'Nevirapine', 'RAL': 'Raltegravir',
-                     'RPV': 'Rilpivirine', 'RTV': 'Ritonavir ', 'SQV': 'Saquinavir',
-                     'T20': 'Enfuvirtide', 'TAF': 'Tenofovir alafenamide',
-                     'TDF': 'Tenofovir disoproxil fumarate', 'TPV': 'Tipranavir',
-                     'ZDV': 'Zidovudine', 'D4T': 'Stavudine', 'AZT': 'Zidovudine',
-                     'DDI': 'Didanosine', 'LMV': 'Lamivudine'}
-
-    self.fixed = { 'NRTI': {'ABC': 'Abacavir', 'DDI': 'Didanosine','ddI': 'Didanosine',
-                  'FTC': 'Emtricitabine', '3TC': 'Lamivudine', 'D4T': 'Stavudine', 'LMV': 'Lamivudine',
-                  'd4T': 'Stavudine', 'AZT': 'Zidovudine', 'TDF':'Tenofovir disoproxil fumarate'},
-                  'NNRTI': {'EFV': 'Efavirenz', 'ETR': 'Etravirine', 'NVP': 'Nevirapine',
-                            'RPV': 'Rilpivirine'},
-                  'PI': {'ATV': 'Atazanavir', 'FPV': 'Fosamprenavir', 'DRV': 'Darunavir',
-                     'IDV': 'Indinavir', 'LPV': 'Lopinavir', 'NFV': 'Nelfinavir',
-                     'SQV': 'Saquinavir', 'TPV': 'Tipranavir'},
-                  'IN': {'RAL': 'Raltegravir', 'EVG': 'Elvitegravir', 'DTG': 'Dolutegravir'} }
+    # unscored minority variants per gene as (mutation, frequency), and the frequency they are below
+    self.minority = {gene: [] for gene in self.profile}
+    self.minorityFrequency = None
+
+  def addMinority(self, mutation, frequency):
+    gene, mutation = mutation.split(':', 1)
+    self.minority[geneNames.get(gene, gene)].append((mutation, frequency))
 
   def parseFile(self, filename):
     with open(filename, 'r') as infile:
-      for line in infile:
-        lineparts = line.split()
-        if len(lineparts) > 0:
-          drugClass = lineparts[0]
-          if lineparts[0] == 'barcode:':
-            self.barcode = lineparts[1]
-
-          if drugClass == "PI":
-            self.profile['protease'].append(lineparts)
-          elif drugClass == "NRTI" or drugClass == "NNRTI":
-            self.profile['reverse_transcriptase'].append(lineparts)
-          elif drugClass == "INSTI":
-            self.profile['integrase'].append(lineparts)
+      self.parseLines(infile)
+
+  # a _scores.txt profile given as text, e.g. read out of a run archive
+  def parseText(self, text):
+    self.parseLines(text.splitlines())
+
+  def parseLines(self, lines):
+    for line in lines:
+      lineparts = line.split()
+      if len(lineparts) > 0:
+        drugClass = lineparts[0]
+        if lineparts[0] == 'barcode:':
+          self.barcode = lineparts[1]
+        if lineparts[0] == 'minority' and len(lineparts) == 5:
+          self.minorityFrequency = float(lineparts[3].rstrip('%:'))
+          for variant in lineparts[4].split(','):
+            if variant:
+              mutation, frequency = variant.rsplit(':', 1)
+              self.addMinority(mutation, parseNumber(frequency))
+
+        if drugClass == "PI":
+          self.profile['protease'].append(textDrugScore(lineparts))
+        elif drugClass == "NRTI" or drugClass == "NNRTI":
+          self.profile['reverse_transcriptase'].append(textDrugScore(lineparts))
+        elif drugClass == "INSTI":
+          self.profile['integrase'].append(textDrugScore(lineparts))
+
+  # fill the profile from a structured result record instead of a _scores.txt file
+  def loadRecord(self, record):
+    self.barcode = record['barcode']
+    self.record = record
+    for gene in record['genes']:
+      self.profile[geneNames.get(gene['gene'], gene['gene'])].extend(gene['drugScores'])
+    for mutation in record['mutations']:
+      if mutation.get('minority'):
+        self.addMinority(mutation['mutation'], mutation['frequency'])
+    self.minorityFrequency = record.get('minorityFrequency')
 
   def drugName(self, drugAbbrv):
-    drugName = ""
-    if drugAbbrv in self.drugDict:
-      drugName = self.drugDict[drugAbbrv] + " (" + drugAbbrv + ")"
-    else:
-      drugName = drugAbbrv
-    return drugName
+    drug = lookupDrug(drugAbbrv)
+    if drug is None:
+      return drugAbbrv
+    return drug.name + " (" + drug.abbreviation + ")"
 
-  def frequencies(self, frequencyStr):
-    mutations = re.sub(r':\d+.?\d+:', '   ', frequencyStr)
-    mutations = re.sub(r'[()]', '', mutations)
-    mutations = re.sub(r',', ', ', mutations)
-    output = mutations[:-2]
-    return output
+  def minorityVariants(self, gene):
+    return ", ".join(mutation + " " + ("" if frequency is None else formatFrequency(frequency)) + "%"
+                     for mutation, frequency in self.minority[gene])
 
-  def generatePDFReport(self):
-    pdf = FPDF(orientation='P', unit='mm', format='A4')
+  # the mutations behind the partial scores of a drug with their frequencies
+  def frequencies(self, drugScore):
+    return ", ".join(partial['mutations'][0] + ("" if partial['frequency'] is None else
+                                                "   " + formatFrequency(partial['frequency']))
+                     for partial in drugScore['partialScores'])
+
+  def generatePDFReport(self, filename=None):
+    pdf = getPDFTemplate().newDocument()
+    self.renderPDFPage(pdf)
+    if filename is None:
+      filename = "pdfs/" + self.barcode + ".pdf"
+    pdf.output(filename)
+
+  # the PDF report as bytes, for callers that send it on instead of writing a file
+  def pdfData(self):
+    pdf = getPDFTemplate().newDocument()
+    self.renderPDFPage(pdf)
+    return pdf.output(dest='S').encode('latin-1')
+
+  def renderPDFPage(self, pdf):
     pdf.add_page()
     pdf.set_font("Arial", size=12)
-    pdf.image('CFAR-logo.jpg', x = 5, y = 5, h = 36, w = 30)
-    pdf.image('jcrc_logo-1.jpg', x = 170, y = 5, h = 36, w = 30)
+    pdf.image(logoFile('CFAR-logo.jpg'), x = 5, y = 5, h = 36, w = 30)
+    pdf.image(logoFile('jcrc_logo-1.jpg'), x = 170, y = 5, h = 36, w = 30)
     pdf.cell(200, 10, txt="GENOTYPIC HIV-1 RESISTANCE PROFILE", ln=1, align="C")
     pdf.cell(200, 10, txt=self.reportTitle, ln=1, align="C")
     pdf.set_font("Arial", size=10)
     pdf.cell(25, 10, ln=2)
     pdf.cell(100, 10, txt="DRUG RESISTANCE INTERPRETATION", ln=1)
-    pdf.set_font("Arial", style='B', size=9)
-    pdf.cell(150, 10, txt="1) Resistance to Reverse transcriptase Inhibitors (RTI)", ln=1)
-    pdf.set_font("Arial", style='B', size=8)
-    pdf.cell(5, 5)
-    pdf.cell(150, 10, txt="Resistance to Nucleoside / Nucleotide RTI (NRTI)                        Drug Resistance Associated Mutations", ln=1)
-    pdf.set_font("Arial", size=8)
-
-    for resistance in self.profile['reverse_transcriptase']:
-      drugAbbrv = resistance[1]
-      if resistance[0] == "NRTI":
-        drugName = ""
-        if drugAbbrv in self.drugDict:
-          drugName = self.drugDict[drugAbbrv] + " (" + drugAbbrv + ")"
-        else:
-          drugName = drugAbbrv
-        res = ""
-        if resistance[3] == "Susceptible":
-          res = resistance[3]
-        else:
-          res = resistance[3] + " " + resistance[4]
-        pdf.cell(5, 5)
-        pdf.cell(50, 5, txt=drugName)
-        pdf.cell(35, 5, txt=res)
-        if len(resistance) == 6:
-          freqString = self.frequencies(resistance[5])
-          pdf.set_font("Arial", size=6)
-          pdf.cell(25, 5, txt=freqString, ln=1)
-          pdf.set_font("Arial", size=8)
-        else:
-          pdf.cell(25, 5, txt="", ln=1)
-
-    pdf.set_font("Arial", style='B', size=8)
-    pdf.cell(5, 5)
-    pdf.cell(150, 10, txt="Resistance to Non-Nucleoside RTI (NNRTI)", ln=1)
-    pdf.set_font("Arial", size=8)
-
-    for resistance in self.profile['reverse_transcriptase']:
-      drugAbbrv = resistance[1]
-      if resistance[0] == "NNRTI":
-        drugName = ""
-        if drugAbbrv in self.drugDict:
-          drugName = self.drugDict[drugAbbrv] + " (" + drugAbbrv + ")"
-        else:
-          drugName = drugAbbrv
-        res = ""
-        if resistance[3] == "Susceptible":
-          res = resistance[3]
-        else:
-          res = resistance[3] + " " + resistance[4]
-        pdf.cell(5, 5)
-        pdf.cell(50, 5, txt=drugName)
-        pdf.cell(35, 5, txt=res)
-        if len(resistance) == 6:
-          pdf.set_font("Arial", size=6)
-          freqString = self.frequencies(resistance[5])
-          pdf.cell(25, 5, txt=freqString, ln=1)
-          pdf.set_font("Arial", size=8)
-        else:
-          pdf.cell(25, 5, txt="", ln=1)
-    if len(self.profile['reverse_transcriptase']) == 0:
-      pdf.cell(5, 5)
-      pdf.cell(50, 5, txt="Reverse transcriptase mutations not detected")
-
-    pdf.cell(10, 10, txt="", ln=1)
-    pdf.set_font("Arial", style='B', size=9)
-    pdf.cell(150, 10, txt="2) Resistance to Protease Inhibitors (PI)", ln=1)
-    pdf.set_font("Arial", size=8)
-    ## do the for each
-    for resistance in self.profile['protease']:
-      drugName = self.drugName(resistance[1])
-      res = ""
-      if resistance[3] == "Susceptible":
-        res = resistance[3]
-      else:
-        res = resistance[3] + " " + resistance[4]
-      pdf.cell(5, 5)
-      pdf.cell(50, 5, txt=drugName)
-      pdf.cell(35, 5, txt=res)
-      if len(resistance) == 6:
-        pdf.set_font("Arial", size=6)
-        freqString = self.frequencies(resistance[5])
-        pdf.cell(25, 5, txt=freqString, ln=1)
+    for group in reportLayout:
+      pdf.set_font("Arial", style='B', size=9)
+      pdf.cell(150, 10, txt=group.heading, ln=1)
+      for section in group.sections:
+        if section.subheading is not None:
+          pdf.set_font("Arial", style='B', size=8)
+          pdf.cell(5, 5)
+          pdf.cell(150, 10, txt=section.subheading, ln=1)
         pdf.set_font("Arial", size=8)
-      else:
-        pdf.cell(25, 5, txt="", ln=1)
-    if len(self.profile['protease']) == 0:
-      pdf.cell(5, 5)
-      pdf.cell(50, 5, txt="Protease mutations not detected")
-    pdf.cell(10, 10, txt="", ln=1)
-    pdf.set_font("Arial", style='B', size=9)
-    pdf.cell(150, 10, txt="3) Resistance to Integrase inhibitors (II)", ln=1)
-    pdf.set_font("Arial", size=8)
-    ## do the for each
-    if len(self.profile['integrase']) == 0:
-      pdf.cell(5, 5)
-      pdf.cell(50, 5, txt="Integrase mutations not detected")
-    for resistance in self.profile['integrase']:
-      drugName = self.drugName(resistance[1])
-      res = ""
-      if resistance[3] == "Susceptible":
-        res = resistance[3]
-      else:
-        res = resistance[3] + " " + resistance[4]
-      pdf.cell(5, 5)
-      pdf.cell(50, 5, txt=drugName)
-      pdf.cell(35, 5, txt=res)
-      if len(resistance) == 6:
+        for drugScore in self.profile[group.gene]:
+          if drugScore['drugClass'] == section.drugClass:
+            self.writePDFResistance(pdf, drugScore)
+      if len(self.profile[group.gene]) == 0:
+        pdf.cell(5, 5)
+        pdf.cell(50, 5, txt=group.notDetected, ln=1 if len(self.minority[group.gene]) > 0 else 0)
+      if len(self.minority[group.gene]) > 0:
         pdf.set_font("Arial", size=6)
-        freqString = self.frequencies(resistance[5])
-        pdf.cell(25, 5, txt=freqString, ln=1)
-        pdf.set_font("Arial", size=8)
-      else:
-        pdf.cell(25, 5, txt="", ln=1)
-    pdf.cell(10, 10, txt="", ln=1)
-    pdf.output("pdfs/" + self.barcode + ".pdf")
-
-  def generateExcelReport(self):
-    workbook = xlsxwriter.Workbook('demo.xlsx')
-    worksheet = workbook.add_worksheet()
-    bold = workbook.add_format({'bold': True})
-    brand_header = workbook.add_format({'font_color': 'blue', 'bold': True})
-    report = workbook.add_format({'font_color': 'red', 'bold': True})
-    metadata_header = workbook.add_format({'bg_color': '#F1C096', 'bold': True})
-    green = workbook.add_format({'bg_color': '#397d22', 'font_color': '#FFFFFF'})
-    call_color = workbook.add_format({'font_color': 'green', 'bold': True})
-    call_color_grey = workbook.add_format({'font_color': 'green', 'bold': True, 'bg_color': '#c9d2d6'})
-    grey = workbook.add_format({'bg_color': '#c9d2d6'})
-    blue = workbook.add_format({'bg_color': '#2e0cb3', 'font_color': '#FFFFFF'})
-    red = workbook.add_format({'bg_color': '#8f1507', 'font_color': '#FFFFFF'})
-    main_table_header = workbook.add_format({'bg_color': '#000000', 'font_color': '#FFFFFF',
-                                             'bold': True, 'center_across': True})
-    psub_header = workbook.add_format({'font_color': 'purple', 'center_across': True, 'font_size': 8})
+        pdf.cell(5, 5)
+        pdf.cell(150, 5, txt="Minority variants (< %g%%, not scored): %s" % (self.minorityFrequency,
+                 self.minorityVariants(group.gene)), ln=1)
+      pdf.cell(10, 10, txt="", ln=1)
+
+  def writePDFResistance(self, pdf, drugScore):
+    pdf.cell(5, 5)
+    pdf.cell(50, 5, txt=self.drugName(drugScore['drug']))
+    pdf.cell(35, 5, txt=drugScore['text'])
+    if len(drugScore['partialScores']) > 0:
+      pdf.set_font("Arial", size=6)
+      pdf.cell(25, 5, txt=self.frequencies(drugScore), ln=1)
+      pdf.set_font("Arial", size=8)
+    else:
+      pdf.cell(25, 5, txt="", ln=1)
+
+  def generateExcelReport(self, filename=None):
+    if filename is None:
+      os.makedirs("xlsx", exist_ok=True)
+      filename = "xlsx/" + self.barcode + ".xlsx"
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+    formats = addExcelFormats(workbook)
+    self.writeExcelSheet(workbook.add_worksheet(), formats)
+    workbook.close()
+
+  def excelData(self):
+    import xlsxwriter
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    formats = addExcelFormats(workbook)
+    self.writeExcelSheet(workbook.add_worksheet(), formats)
+    workbook.close()
+    return output.getvalue()
+
+  # write the report into a worksheet strictly row by row, as required by
+  # xlsxwriter's constant_memory mode
+  def writeExcelSheet(self, worksheet, formats):
+    bold = formats['bold']
+    brand_header = formats['brand_header']
+    report = formats['report']
+    metadata_header = formats['metadata_header']
+    call_color = formats['call_color']
+    call_color_grey = formats['call_color_grey']
+    grey = formats['grey']
+    main_table_header = formats['main_table_header']
+    psub_header = formats['psub_header']
     # set columns widths
     worksheet.set_column('A:A', 6.17)  # pixels to *width* unitss
     worksheet.set_column('B:B', 4)
@@ -251,19 +397,19 @@ class ReportGenerator():
     worksheet.write('A4', 'HIV-1 DRUG RESISTANCE REPORT', report)
     worksheet.write_row("A6:I6", ['Patient / Sample Information','','','','','','','',''], metadata_header)
     #worksheet.write('A6', 'Patient / Sample Information', bold)
+    worksheet.write_row("K6:N6", ['Physician / Project Information','','',''], metadata_header)
     worksheet.write('A7', 'MRN:', bold)
-    worksheet.write('A8', 'Name:', bold)
-    worksheet.write('A9', 'DOB:', bold)
-    worksheet.write('A10', 'Gender:', bold)
     worksheet.write('H7', 'Sample ID:', bold)
+    worksheet.write('K7', 'Name:', bold)
+    worksheet.write('A8', 'Name:', bold)
     worksheet.write('H8', 'Lab ID:', bold)
+    worksheet.write('K8', 'Institution:', bold)
+    worksheet.write('A9', 'DOB:', bold)
     worksheet.write('H9', 'Date Collected:', bold)
+    worksheet.write('K9', 'Address:', bold)
+    worksheet.write('A10', 'Gender:', bold)
     worksheet.write('H10', 'Date Received:', bold)
     worksheet.write('H11', 'Date Reported:', bold)
-    worksheet.write_row("K6:N6", ['Physician / Project Information','','',''], metadata_header)
-    worksheet.write('K7', 'Name:', bold)
-    worksheet.write('K8', 'Institution:', bold)
-    worksheet.write('K9', 'Address:', bold)
     worksheet.write_row("A13:F13", ['Subtyping information','','','','',''], metadata_header)
     worksheet.write_row("I13:N13", ['Codons Analyzed','','','','',''], metadata_header)
     ## MAIN TABLE
@@ -273,141 +419,40 @@ class ReportGenerator():
     worksheet.write('C20', 'Generic Name', psub_header)
     worksheet.write('D20', 'Brand Name', psub_header)
     worksheet.write('F20', 'Assessment', psub_header)
-    worksheet.write_row("H20:K20", ['MUTATIONS DETECTED AT ≥ 20%','','',''], psub_header)
-    #worksheet.write_row("M20:N20", ['MUTATIONS DETECTED AT < 20%',''], psub_header)
+    if self.minorityFrequency is None:
+      worksheet.write_row("H20:K20", ['MUTATIONS DETECTED AT ≥ 20%','','',''], psub_header)
+    else:
+      worksheet.write_row("H20:K20", ['MUTATIONS DETECTED AT ≥ %g%%' % self.minorityFrequency,'','',''], psub_header)
+      worksheet.write_row("M20:N20", ['MUTATIONS DETECTED AT < %g%%' % self.minorityFrequency,''], psub_header)
     rowNum = 21
-    ## NRTI
-    first_nrti = 0
-    first_nnrti = 0
-    first_pi = 0
-    first_in = 0
-    title = ""
-
-    for resistance in self.profile['reverse_transcriptase']:
-      if resistance[0] == "NRTI":
-        if first_nrti == 0:
-          title = "NRTI"
-        else:
-          title = ""
-        self.writeResistance(worksheet, resistance, rowNum, grey, green, title, call_color, call_color_grey)
-        rowNum += 1
-        first_nrti += 1
-    for fixed in self.fixed['NRTI']:
-      # write out the fixed drugs with susceptible if not found
-      found = False
-      if first_nrti == 0:
-        title = "NRTI"
-      else:
-        title = ""
-      for res in self.profile['reverse_transcriptase']:
-        if res[1].upper() == fixed.upper():
-          found = True
-      if not found:
-        self.writeResistance(worksheet, ['NRTI', fixed, '', 'Susceptible', '', ''], rowNum, grey, green, title, call_color, call_color_grey)
-        rowNum += 1
-        first_nrti += 1
-    ## NNRTI
-    rowNum += 1
-    for resistance in self.profile['reverse_transcriptase']:
-      if resistance[0] == "NNRTI":
-        if first_nnrti == 0:
-          title = "NNRTI"
-        else:
-          title = ""
-        self.writeResistance(worksheet, resistance, rowNum, grey, green, title, call_color, call_color_grey)
-        rowNum += 1
-        first_nnrti += 1
-    for fixed in self.fixed['NNRTI']:
-      # write out the fixed drugs with susceptible if not found
-      found = False
-      if first_nnrti == 0:
-        title = "NNRTI"
-      else:
-        title = ""
-      for res in self.profile['reverse_transcriptase']:
-        if res[1].upper() == fixed.upper():
-          found = True
-      if not found:
-        self.writeResistance(worksheet, ['NNRTI', fixed, '', 'Susceptible', '', ''], rowNum, grey, green, title, call_color, call_color_grey)
-        rowNum += 1
-        first_nnrti += 1
-    ## PI
-    rowNum += 1
-    for resistance in self.profile['protease']:
-      if resistance[0] == "PI":
-        if first_pi == 0:
-          title = "PI"
-        else:
+    for group in reportLayout:
+      # one hash lookup per drug: reported drugs already in the profile under any
+      # of their abbreviations are not listed again
+      present = set(canonicalAbbreviation(drugScore['drug']) for drugScore in self.profile[group.gene])
+      for section in group.sections:
+        # a blank row between sections
+        if section is not reportLayout[0].sections[0]:
+          rowNum += 1
+        title = section.label
+        color = formats[section.color]
+        rows = [drugScore for drugScore in self.profile[group.gene] if drugScore['drugClass'] == section.drugClass]
+        rows += [{'drugClass': section.drugClass, 'drug': drug.abbreviation, 'text': 'Susceptible', 'partialScores': []}
+                 for drug in reportedDrugs.get(section.drugClass, ()) if drug.abbreviation not in present]
+        for drugScore in rows:
+          self.writeResistance(worksheet, drugScore, rowNum, grey, color, title, call_color, call_color_grey)
+          # the unscored minority variants of a gene are listed once, next to its first drug
+          if section is group.sections[0] and drugScore is rows[0] and len(self.minority[group.gene]) > 0:
+            worksheet.write('M' + str(rowNum), self.minorityVariants(group.gene))
+          rowNum += 1
           title = ""
-        self.writeResistance(worksheet, resistance, rowNum, grey, blue, title, call_color, call_color_grey)
-        rowNum += 1
-        first_pi += 1
-    for fixed in self.fixed['PI']:
-      # write out the fixed drugs with susceptible if not found
-      found = False
-      if first_pi == 0:
-        title = "PI"
-      else:
-        title = ""
-      for res in self.profile['protease']:
-        if res[1].upper() == fixed.upper():
-          found = True
-      if not found:
-        self.writeResistance(worksheet, ['PI', fixed, '', 'Susceptible', '', ''], rowNum, grey, blue, title, call_color, call_color_grey)
-        rowNum += 1
-        first_pi += 1
-    ## IN
-    rowNum += 1
-    for resistance in self.profile['integrase']:
-      if resistance[0] == "IN":
-        if first_in == 0:
-          title = "IN"
-        else:
-          title = ""
-        self.writeResistance(worksheet, resistance, rowNum, grey, red, title, call_color, call_color_grey)
-        rowNum += 1
-        first_in += 1
-    for fixed in self.fixed['IN']:
-      # write out the fixed drugs with susceptible if not found
-      found = False
-      if first_in == 0:
-        title = "IN"
-      else:
-        title = ""
-      for res in self.profile['integrase']:
-        if res[1].upper() == fixed.upper():
-          found = True
-      if not found:
-        self.writeResistance(worksheet, ['IN', fixed, '', 'Susceptible', '', ''], rowNum, grey, red, title, call_color, call_color_grey)
-        rowNum += 1
-        first_in += 1
 
-    workbook.close()
-
-  def writeResistance(self, worksheet, resistance, rowNum, grey, green, title, call_color, call_color_grey):
-    drugAbbrv = resistance[1]
-    resistanceClass = resistance[0]
-    drugName = ""
-    brandName = ""
-    if drugAbbrv in self.drugDict:
-      drugName = self.drugDict[drugAbbrv]
-    else:
-      drugName = drugAbbrv
-
-    if drugAbbrv in self.brandDict:
-      brandName = self.brandDict[drugAbbrv]
-
-    res = ""
-    mutations = ""
-    if resistance[3] == "Susceptible":
-      res = resistance[3]
-    else:
-      res = resistance[3] + " " + resistance[4]
-    if len(resistance) == 6:
-      mutations = re.sub(r':\d+.?\d+:', '   ', resistance[5])
-      mutations = re.sub(r'[()]', '', mutations)
-      mutations = re.sub(r',', ', ', mutations)
-      mutations = re.sub(r',$', '', mutations)
+  def writeResistance(self, worksheet, drugScore, rowNum, grey, green, title, call_color, call_color_grey):
+    drug = lookupDrug(drugScore['drug'])
+    drugAbbrv = drugScore['drug'] if drug is None else drug.abbreviation
+    drugName = drugScore['drug'] if drug is None else drug.name
+    brandName = "" if drug is None else drug.brand
+    res = drugScore['text']
+    mutations = self.frequencies(drugScore)
 
     worksheet.write('A' + str(rowNum), title, green)
     if rowNum % 2 == 0:
@@ -424,10 +469,22 @@ class ReportGenerator():
       worksheet.write('H' + str(rowNum), mutations, grey)
 
 if __name__ == "__main__":
-  reporter = ReportGenerator('SAMPLE1', 'output/CGAGGCTG+TCTCTCCG_scores.txt')
-  reporter.parseFile(reporter.profileFile)
-  reporter.generatePDFReport()
-  reporter.generateExcelReport()
+  parser = argparse.ArgumentParser()
+  parser.add_argument("profile", help="Scored profile file, or a run archive with -barcode", nargs='?',
+                      default='output/CGAGGCTG+TCTCTCCG_scores.txt')
+  parser.add_argument("-barcode", help="Barcode whose profile is read from the run archive given as profile", type=str)
+  parser.add_argument("-title", help="Report title", type=str, default='SAMPLE1')
+  parser.add_argument("-pdf", help="PDF report file, defaults to pdfs/<barcode>.pdf", type=str)
+  parser.add_argument("-xlsx", help="Excel report file, defaults to xlsx/<barcode>.xlsx", type=str)
+  args = parser.parse_args()
+
+  reporter = ReportGenerator(args.title, args.profile)
+  if args.barcode is not None:
+    reporter.parseText(archiveProfile(args.profile, args.barcode))
+  else:
+    reporter.parseFile(reporter.profileFile)
+  reporter.generatePDFReport(args.pdf)
+  reporter.generateExcelReport(args.xlsx)
   #print(reporter.profile)
 
 
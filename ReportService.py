@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+## Long-lived HTTP service scoring called mutations and returning the reports, for LIMS integration
+
+import argparse
+import asyncio
+import base64
+import json
+import sys
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import ScoreMutations
+from ReportGenerator import getPDFTemplate
+from looper import loadProfile
+from RunTimer import timer
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+  def __init__(self, status, message, headers=None):
+    Exception.__init__(self, message)
+    self.status = status
+    self.headers = headers or {}
+
+
+class ReportService():
+  """
+  Asyncio HTTP/1.1 service. POST /score takes called mutation rows (the -file format)
+  for one or more barcodes and answers with each barcode's result record and its
+  PDF/XLSX reports, base64 encoded. The annotation table, drug metadata, scoring
+  session, response cache and PDF template are loaded once and stay warm. At most
+  limit requests are worked on at once and queue more wait for a slot, anything
+  beyond that is turned away with 503 and Retry-After. Scored records are added to a
+  results store run when one is given
+  """
+  def __init__(self, scorer, variants, formats, batchSize=1, limit=4, queue=16, maxBody=16 * 1024 * 1024,
+               idleTimeout=60, store=None, run=None):
+    self.scorer = scorer
+    self.variants = variants
+    self.formats = formats
+    self.batchSize = batchSize
+    self.limit = limit
+    self.queue = queue
+    self.maxBody = maxBody
+    self.idleTimeout = idleTimeout
+    self.store = store
+    self.run = run
+    self.executor = ThreadPoolExecutor(max_workers=limit)
+    self.slots = asyncio.Semaphore(limit)
+    self.active = 0
+    self.waiting = 0
+    self.served = 0
+    self.rejected = 0
+
+  # load everything a request would otherwise pay for on first use
+  def warm(self):
+    ScoreMutations.getAnnotations()
+    getPDFTemplate()
+
+  async def handle(self, reader, writer):
+    try:
+      while True:
+        try:
+          request = await asyncio.wait_for(self.readRequest(reader), self.idleTimeout)
+        except HTTPError as error:
+          # the body was not read, so the connection cannot be reused
+          await self.respond(writer, error.status, {'error': str(error)}, False, error.headers)
+          break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+          break
+        if request is None:
+          break
+        method, path, query, headers, body = request
+        keepAlive = headers.get('connection', '').lower() != 'close'
+        try:
+          payload = await self.dispatch(method, path, query, body)
+          status = 200
+          extra = {}
+        except HTTPError as error:
+          status, payload, extra = error.status, {'error': str(error)}, error.headers
+        await self.respond(writer, status, payload, keepAlive, extra)
+        if not keepAlive:
+          break
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  async def readRequest(self, reader):
+    line = await reader.readline()
+    if not line:
+      return None
+    try:
+      method, target, version = line.decode('latin-1').split()
+    except ValueError:
+      raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      name, separator, value = line.decode('latin-1').partition(':')
+      headers[name.strip().lower()] = value.strip()
+    try:
+      length = int(headers.get('content-length', 0))
+    except ValueError:
+      raise HTTPError(400, "malformed Content-Length")
+    if length > self.maxBody:
+      raise HTTPError(413, "request body larger than " + str(self.maxBody) + " bytes")
+    body = await reader.readexactly(length)
+    url = urllib.parse.urlsplit(target)
+    return method, url.path, urllib.parse.parse_qs(url.query), headers, body
+
+  async def respond(self, writer, status, payload, keepAlive, headers):
+    data = json.dumps(payload, separators=(',', ':')).encode()
+    lines = ["HTTP/1.1 " + str(status) + " " + reasons.get(status, ''), "Content-Type: application/json",
+             "Content-Length: " + str(len(data)), "Connection: " + ("keep-alive" if keepAlive else "close")]
+    lines += [name + ": " + value for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + data)
+    # a client that does not read its responses holds up only its own connection
+    await writer.drain()
+
+  async def dispatch(self, method, path, query, body):
+    if path == '/health':
+      return {'status': 'ok', 'active': self.active, 'waiting': self.waiting, 'served': self.served,
+              'rejected': self.rejected}
+    if path == '/stats':
+      return timer.summary()
+    if path != '/score':
+      raise HTTPError(404, "unknown path " + path)
+    if method != 'POST':
+      raise HTTPError(405, "POST called mutations to /score", {'Allow': 'POST'})
+    formats = query.get('formats', [",".join(self.formats)])[0].split(',')
+    title = query.get('title', [None])[0]
+
+    # backpressure: a bounded number of requests wait for a slot
+    if self.waiting >= self.queue:
+      self.rejected += 1
+      raise HTTPError(503, "service busy, retry later", {'Retry-After': '1'})
+    self.waiting += 1
+    try:
+      await self.slots.acquire()
+    finally:
+      self.waiting -= 1
+    self.active += 1
+    try:
+      results = await asyncio.get_running_loop().run_in_executor(self.executor, self.scoreAndRender,
+                                                                 body.decode('utf-8', 'replace'), formats, title)
+    finally:
+      self.active -= 1
+      self.slots.release()
+    self.served += 1
+    return {'results': results}
+
+  # parse, score and render one request, in an executor thread
+  def scoreAndRender(self, text, formats, title):
+    try:
+      groups = ScoreMutations.groupRows(ScoreMutations.tokenizeRows(text.splitlines()), self.variants)
+    except ValueError as error:
+      raise HTTPError(400, str(error))
+    if len(groups) == 0:
+      raise HTTPError(400, "no called mutations in the request body")
+    try:
+      results = []
+      for batch in ScoreMutations.batched(groups, self.batchSize):
+        outputs = self.scorer.scoreBatch(batch)
+        if self.store is not None:
+          self.store.addRecords(self.run, [record for output, record in outputs])
+        for (barcode, mutations), (output, record) in zip(batch, outputs):
+          result = {'barcode': barcode, 'status': record['status'], 'record': record}
+          if record['status'] != 'error':
+            reporter = loadProfile(record, title)
+            if 'pdf' in formats:
+              with timer.stage('render pdf', 1, [barcode]):
+                result['pdf'] = base64.b64encode(reporter.pdfData()).decode('ascii')
+            if 'xlsx' in formats:
+              with timer.stage('render xlsx', 1, [barcode]):
+                result['xlsx'] = base64.b64encode(reporter.excelData()).decode('ascii')
+          results.append(result)
+      return results
+    except Exception:
+      sys.stderr.write(traceback.format_exc())
+      raise HTTPError(500, "scoring or rendering failed, see the service log")
+
+  # write the stage timings of the last interval and start a new one
+  async def reportStats(self, interval):
+    while True:
+      await asyncio.sleep(interval)
+      summary = timer.summary()
+      if len(summary['stages']) > 0:
+        sys.stderr.write(time.strftime("%Y-%m-%d %H:%M:%S") + " " + str(self.served) + " requests served, " +
+                         str(self.rejected) + " turned away\n" + timer.report(summary))
+      timer.reset()
+
+
+async def serve(service, host, port, statsInterval):
+  started = time.perf_counter()
+  service.warm()
+  server = await asyncio.start_server(service.handle, host, port)
+  sys.stderr.write("warm in %.2fs, listening on http://%s:%d\n" % (time.perf_counter() - started, host,
+                   server.sockets[0].getsockname()[1]))
+  stats = asyncio.get_running_loop().create_task(service.reportStats(statsInterval))
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    stats.cancel()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  ScoreMutations.addScoringArguments(parser)
+  parser.add_argument("-host", help="Address the service listens on", type=str, default="127.0.0.1")
+  parser.add_argument("-port", help="Port the service listens on, 0 picks a free one", type=int, default=8008)
+  parser.add_argument("-limit", help="Requests scored and rendered at once", type=int, default=4)
+  parser.add_argument("-queue", help="Requests waiting for a slot before new ones get 503", type=int, default=16)
+  parser.add_argument("-max-body", help="Largest accepted request body in MB", type=float, default=16)
+  parser.add_argument("-formats", help="Comma separated report formats returned by default", type=str, default="pdf,xlsx")
+  parser.add_argument("-stats-interval", help="Seconds between stage timing reports on stderr", type=float, default=300)
+  args = parser.parse_args()
+  # /stats reports latency percentiles, the samples are dropped every -stats-interval
+  timer.detailed = True
+
+  try:
+    scorer = ScoreMutations.makeScorer(args)
+  except ValueError as error:
+    sys.stderr.write(str(error) + "\n")
+    sys.exit(1)
+  store = None
+  run = None
+  if args.store is not None:
+    from ResultsStore import ResultsStore
+    store = ResultsStore(args.store)
+    run = store.addRun(args.run_name or "service " + args.host + ":" + str(args.port), None)
+  service = ReportService(scorer, ScoreMutations.makeVariantFilter(args), args.formats.split(','),
+                          ScoreMutations.batchSize(args), max(args.limit, 1), max(args.queue, 0),
+                          int(args.max_body * 1024 * 1024), store=store, run=run)
+  try:
+    asyncio.run(serve(service, args.host, args.port, args.stats_interval))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    service.executor.shutdown()
+    scorer.close()
+    if store is not None:
+      store.close()
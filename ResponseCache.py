@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+## Persistent cache of drug resistance responses keyed by mutation set
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache():
+  """
+  SQLite backed cache of drugResistance responses. Entries are keyed by the sorted
+  mutation list, the query text and the algorithm version, and are evicted by age and total size
+  """
+  def __init__(self, path, query, algorithmVersion, maxBytes=256 * 1024 * 1024, maxAge=30 * 86400):
+    self.path = path
+    self.query = query
+    self.algorithmVersion = algorithmVersion
+    self.maxBytes = maxBytes
+    self.maxAge = maxAge
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                    "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+    self.db.commit()
+    self.prune()
+
+  def key(self, mutations):
+    canonical = json.dumps([sorted(set(mutations)), self.query, self.algorithmVersion], separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+  def get(self, mutations):
+    key = self.key(mutations)
+    with self.lock:
+      row = self.db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+      now = time.time()
+      if row is None or now - row[1] > self.maxAge:
+        self.misses += 1
+        return None
+      self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+      self.db.commit()
+      self.hits += 1
+    return json.loads(row[0])
+
+  def put(self, mutations, response):
+    data = json.dumps(response, separators=(',', ':'))
+    now = time.time()
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                      (self.key(mutations), data, len(data), now, now))
+      self.db.commit()
+
+  # drop expired entries, then the least recently used ones until the cache fits in maxBytes
+  def prune(self):
+    with self.lock:
+      self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.maxAge,))
+      total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+      if total > self.maxBytes:
+        evict = []
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+          if total <= self.maxBytes:
+            break
+          evict.append((key,))
+          total -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", evict)
+      self.db.commit()
+
+  def close(self):
+    self.prune()
+    self.db.close()
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+## Append-only SQLite store of scored results, indexed for lookups across runs
+
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from DrugMetadata import canonicalAbbreviation
+
+geneCodes = {'protease': 'PR', 'reverse_transcriptase': 'RT', 'integrase': 'IN'}
+
+schema = (
+  "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, name TEXT NOT NULL, source TEXT, created REAL NOT NULL)",
+  "CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, run INTEGER NOT NULL, barcode TEXT NOT NULL, "
+  "status TEXT NOT NULL, record BLOB NOT NULL)",
+  "CREATE TABLE IF NOT EXISTS drugScores (result INTEGER NOT NULL, drug TEXT NOT NULL, score REAL, level INTEGER)",
+  "CREATE TABLE IF NOT EXISTS mutations (result INTEGER NOT NULL, mutation TEXT NOT NULL, name TEXT NOT NULL, "
+  "frequency REAL, minority INTEGER NOT NULL)",
+  "CREATE INDEX IF NOT EXISTS results_barcode ON results (barcode)",
+  "CREATE INDEX IF NOT EXISTS results_run ON results (run)",
+  "CREATE INDEX IF NOT EXISTS drugScores_drug ON drugScores (drug, level)",
+  "CREATE INDEX IF NOT EXISTS mutations_mutation ON mutations (mutation, frequency)",
+  "CREATE INDEX IF NOT EXISTS mutations_name ON mutations (name, frequency)",
+)
+
+
+class ResultsStore():
+  """
+  Append-only SQLite store of result records. Every run adds its records and nothing is
+  updated, so the history of a barcode is every run that scored it. Drug scores and
+  mutations are kept in indexed tables, the full record compressed next to them
+  """
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    # readers are not blocked while a run is writing
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.drugs = {}
+    for statement in schema:
+      self.db.execute(statement)
+    self.db.commit()
+
+  def drug(self, abbreviation):
+    if abbreviation not in self.drugs:
+      self.drugs[abbreviation] = canonicalAbbreviation(abbreviation)
+    return self.drugs[abbreviation]
+
+  def addRun(self, name, source=None):
+    with self.lock:
+      cursor = self.db.execute("INSERT INTO runs (name, source, created) VALUES (?, ?, ?)", (name, source, time.time()))
+      self.db.commit()
+    return cursor.lastrowid
+
+  def addRecords(self, run, records):
+    drugRows = []
+    mutationRows = []
+    with self.lock:
+      for record in records:
+        data = zlib.compress(json.dumps(record, separators=(',', ':')).encode(), 1)
+        result = self.db.execute("INSERT INTO results (run, barcode, status, record) VALUES (?, ?, ?, ?)",
+                                 (run, record['barcode'], record['status'], data)).lastrowid
+        drugRows.extend((result, self.drug(drugScore['drug']), drugScore['score'], drugScore['level'])
+                        for gene in record['genes'] for drugScore in gene['drugScores'])
+        mutationRows.extend((result, mutation['mutation'], mutation['mutation'].split(':', 1)[-1], mutation['frequency'],
+                             1 if mutation.get('minority') else 0) for mutation in record['mutations'])
+      self.db.executemany("INSERT INTO drugScores VALUES (?, ?, ?, ?)", drugRows)
+      self.db.executemany("INSERT INTO mutations VALUES (?, ?, ?, ?, ?)", mutationRows)
+      self.db.commit()
+
+  def runs(self):
+    with self.lock:
+      return self.db.execute("SELECT runs.id, runs.name, runs.source, runs.created, COUNT(results.id) FROM runs "
+                             "LEFT JOIN results ON results.run = runs.id GROUP BY runs.id ORDER BY runs.id").fetchall()
+
+  # every stored result of a barcode as (run name, run time, record), oldest first
+  def history(self, barcode):
+    with self.lock:
+      rows = self.db.execute("SELECT runs.name, runs.created, results.record FROM results JOIN runs ON runs.id = results.run "
+                             "WHERE results.barcode = ? ORDER BY results.id", (barcode,)).fetchall()
+    return [(name, created, json.loads(zlib.decompress(data))) for name, created, data in rows]
+
+  # (barcode, run name, mutation, frequency) of every result carrying a mutation at or above a
+  # frequency (percent). Mutations are given with their gene, e.g. RT:K103N, or without it.
+  # Imported profiles may not carry frequencies, those only match without a minimum
+  def withMutation(self, mutation, minFrequency=0.0):
+    condition = "mutations." + ('mutation' if ':' in mutation else 'name') + " = ?"
+    parameters = (mutation,)
+    if minFrequency > 0:
+      condition += " AND mutations.frequency >= ?"
+      parameters += (minFrequency,)
+    with self.lock:
+      return self.db.execute("SELECT results.barcode, runs.name, mutations.mutation, mutations.frequency FROM mutations "
+                             "JOIN results ON results.id = mutations.result JOIN runs ON runs.id = results.run "
+                             "WHERE " + condition + " ORDER BY results.id", parameters).fetchall()
+
+  # (barcode, run name, score, level) of every result at or above a resistance level for a drug
+  def atLevel(self, drug, minLevel=5):
+    with self.lock:
+      return self.db.execute("SELECT results.barcode, runs.name, drugScores.score, drugScores.level FROM drugScores "
+                             "JOIN results ON results.id = drugScores.result JOIN runs ON runs.id = results.run "
+                             "WHERE drugScores.drug = ? AND drugScores.level >= ? ORDER BY results.id",
+                             (self.drug(drug), minLevel)).fetchall()
+
+  def close(self):
+    self.db.close()
+
+
+# a result record rebuilt from a parsed _scores.txt profile. The text view only carries
+# the mutations behind a partial score and the minority variants, so only those are listed
+def profileRecord(reporter, status='scored'):
+  record = {'barcode': reporter.barcode, 'status': status, 'mutations': [], 'genes': []}
+  listed = set()
+  for gene, drugScores in reporter.profile.items():
+    for drugScore in drugScores:
+      for partial in drugScore['partialScores']:
+        mutation = geneCodes[gene] + ':' + ("69Insertion" if partial['mutations'][0] == "T69Insertion" else partial['mutations'][0])
+        if mutation not in listed:
+          listed.add(mutation)
+          record['mutations'].append({'mutation': mutation, 'frequency': partial['frequency']})
+    if len(drugScores) > 0:
+      record['genes'].append({'gene': geneCodes[gene], 'drugScores': drugScores})
+  for gene, variants in reporter.minority.items():
+    for mutation, frequency in variants:
+      record['mutations'].append({'mutation': geneCodes[gene] + ':' + mutation, 'frequency': frequency, 'minority': True})
+  return record
+
+def textProfileRecord(text):
+  from ReportGenerator import ReportGenerator
+  reporter = ReportGenerator(None, None)
+  reporter.parseText(text)
+  status = 'scored'
+  if "Error with query!" in text:
+    status = 'error'
+  elif len(reporter.profile['protease'] + reporter.profile['reverse_transcriptase'] + reporter.profile['integrase']) == 0:
+    status = 'no mutations'
+  return profileRecord(reporter, status)
+
+def readProfileRecord(filename):
+  with open(filename, 'r') as infile:
+    return textProfileRecord(infile.read())
+
+# a result record for any looper profile: a record, a _scores.txt file or an archive entry
+def anyProfileRecord(profile):
+  if isinstance(profile, dict):
+    return profile
+  if isinstance(profile, tuple):
+    return textProfileRecord(profile[1])
+  return readProfileRecord(profile)
+
+# import results.jsonl files, run archives and directories of earlier runs, one run per path.
+# A directory holding a results.jsonl is imported from it, otherwise from its _scores.txt files
+def importPaths(store, paths, runName=None, chunk=1000):
+  for path in paths:
+    source = os.path.abspath(path)
+    if os.path.isdir(path) and os.path.exists(os.path.join(path, 'results.jsonl')):
+      path = os.path.join(path, 'results.jsonl')
+    if os.path.isdir(path):
+      filenames = sorted(glob.glob(os.path.join(path, '*_scores.txt')))
+      records = (readProfileRecord(filename) for filename in filenames)
+    elif path.endswith('.zip'):
+      from ReportGenerator import readArchive
+      records = (anyProfileRecord(profile) for profile in readArchive(path))
+    else:
+      from ReportGenerator import readResults
+      records = readResults(path)
+    run = store.addRun(runName or os.path.basename(os.path.normpath(source)), source)
+    count = 0
+    batch = []
+    for record in records:
+      batch.append(record)
+      if len(batch) == chunk:
+        store.addRecords(run, batch)
+        count += len(batch)
+        batch = []
+    store.addRecords(run, batch)
+    count += len(batch)
+    sys.stderr.write("imported " + str(count) + " results from " + path + "\n")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("store", help="Results store database", type=str)
+  parser.add_argument("-import", help="results.jsonl files, run archives or output directories to import", dest="imports", nargs='+')
+  parser.add_argument("-run", help="Run name of the imported results, defaults to the file or directory name", type=str)
+  parser.add_argument("-runs", help="List the stored runs", action="store_true")
+  parser.add_argument("-barcode", help="Every stored result of a barcode", type=str)
+  parser.add_argument("-mutation", help="Results carrying a mutation, e.g. K103N or RT:K103N", type=str)
+  parser.add_argument("-frequency", help="Minimum frequency (percent) of -mutation", type=float, default=0.0)
+  parser.add_argument("-drug", help="Results at or above -level for a drug", type=str)
+  parser.add_argument("-level", help="Minimum resistance level of -drug, 5 is high-level resistance", type=int, default=5)
+  args = parser.parse_args()
+
+  store = ResultsStore(args.store)
+  if args.imports is not None:
+    importPaths(store, args.imports, args.run)
+  start = time.perf_counter()
+  if args.runs:
+    for run, name, source, created, count in store.runs():
+      sys.stdout.write("%d\t%s\t%s\t%d results\t%s\n" % (run, name, time.strftime("%Y-%m-%d %H:%M", time.localtime(created)),
+                                                     count, source or ''))
+  if args.barcode is not None:
+    for name, created, record in store.history(args.barcode):
+      sys.stdout.write(name + "\t" + time.strftime("%Y-%m-%d %H:%M", time.localtime(created)) + "\t" +
+                       json.dumps(record, separators=(',', ':')) + "\n")
+  if args.mutation is not None:
+    for barcode, name, mutation, frequency in store.withMutation(args.mutation, args.frequency):
+      sys.stdout.write("%s\t%s\t%s\t%s\n" % (barcode, name, mutation, frequency))
+  if args.drug is not None:
+    for barcode, name, score, level in store.atLevel(args.drug, args.level):
+      sys.stdout.write("%s\t%s\t%s\t%s\n" % (barcode, name, score, level))
+  sys.stderr.write("query took %.1f ms\n" % ((time.perf_counter() - start) * 1000))
+  store.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+## Single zip archive holding the per-barcode artifacts of a run instead of a file per barcode
+
+import fnmatch
+import os
+import threading
+import zipfile
+
+
+class StreamFile():
+  """
+  Write-only view of a file. Without seek zipfile streams each entry followed by a data
+  descriptor instead of seeking back to patch its header, which would flush the buffer
+  """
+  def __init__(self, outfile):
+    self.outfile = outfile
+
+  def write(self, data):
+    return self.outfile.write(data)
+
+  def flush(self):
+    self.outfile.flush()
+
+
+class RunArchive():
+  """
+  Zip archive written through one buffered file handle. It is built under a temporary
+  name and fsynced once when closed, then renamed over the previous archive, so an
+  interrupted run leaves the previous archive intact. The zip central directory is the
+  index: one profile or report is read back without scanning the others. A writer owns
+  the entries matching its patterns, e.g. the text views of a scoring run; entries of the
+  previous archive it does not own are copied into the new one when it closes
+  """
+  def __init__(self, path, compress=False, owned=None, bufferSize=1024 * 1024):
+    self.path = path
+    self.owned = list(owned) if owned is not None else ['*']
+    self.count = 0
+    self.names = set()
+    self.lock = threading.Lock()
+    # the previous archive stays readable until this one replaces it
+    self.previous = None
+    if os.path.exists(path):
+      try:
+        self.previous = zipfile.ZipFile(path, 'r')
+      except zipfile.BadZipFile:
+        pass
+    self.archiveFile = open(path + '.tmp', 'wb', buffering=bufferSize)
+    self.archive = zipfile.ZipFile(StreamFile(self.archiveFile), 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+
+  def add(self, name, data):
+    with self.lock:
+      self.archive.writestr(name, data)
+      self.names.add(name)
+      self.count += 1
+
+  def addFile(self, name, filename):
+    with self.lock:
+      self.archive.write(filename, name)
+      self.names.add(name)
+      self.count += 1
+
+  def owns(self, name):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.owned)
+
+  # content of an entry of the previous archive, None if it has none
+  def previousEntry(self, name):
+    if self.previous is None:
+      return None
+    try:
+      return self.previous.read(name)
+    except KeyError:
+      return None
+
+  # copy an entry of the previous archive into this one, for items not produced again
+  def carry(self, name):
+    data = self.previousEntry(name)
+    if data is not None:
+      self.add(name, data)
+    return data is not None
+
+  # drop the archive being built and keep the previous one
+  def abort(self):
+    self.archive.close()
+    self.archiveFile.close()
+    if self.previous is not None:
+      self.previous.close()
+    os.remove(self.path + '.tmp')
+
+  def close(self):
+    # entries other writers put in the archive survive this one
+    if self.previous is not None:
+      for name in self.previous.namelist():
+        if name not in self.names and not self.owns(name):
+          self.add(name, self.previous.read(name))
+    self.archive.close()
+    self.archiveFile.flush()
+    os.fsync(self.archiveFile.fileno())
+    self.archiveFile.close()
+    if self.previous is not None:
+      self.previous.close()
+    os.replace(self.path + '.tmp', self.path)
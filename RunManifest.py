@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+## Run manifest recording the status, input hash and output hash of every item of a run
+
+import hashlib
+import json
+import os
+
+
+class RunManifest():
+  """
+  Append-only JSON Lines manifest, the last line written for a key wins. Input hashes
+  cover the run settings, so changing the backend or algorithm invalidates every entry.
+  Entries are only kept in memory when resuming, a fresh run just appends them
+  """
+  def __init__(self, path, settings, resume=False):
+    self.path = path
+    self.settings = settings
+    self.resume = resume
+    self.entries = {}
+    if resume and os.path.exists(path):
+      with open(path, 'r') as infile:
+        for line in infile:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue  # a line cut short by a crash
+          self.entries[entry['key']] = entry
+    # rewrite the surviving entries so the manifest does not grow across reruns
+    with open(path + '.tmp', 'w') as outfile:
+      for entry in self.entries.values():
+        outfile.write(json.dumps(entry, separators=(',', ':')) + "\n")
+    os.replace(path + '.tmp', path)
+    self.manifestFile = open(path, 'a')
+
+  def inputHash(self, content):
+    return hashlib.sha256(json.dumps([self.settings, content], separators=(',', ':')).encode()).hexdigest()
+
+  def outputHash(self, data):
+    if isinstance(data, str):
+      data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+  def get(self, key):
+    return self.entries.get(key)
+
+  # true when the item was completed with the same input and its output still hashes the same
+  def current(self, key, inputHash, output):
+    entry = self.entries.get(key)
+    return (entry is not None and entry['status'] != 'error' and entry['input'] == inputHash and
+            output is not None and entry['output'] == self.outputHash(output))
+
+  def record(self, key, status, inputHash, outputHash):
+    entry = {'key': key, 'status': status, 'input': inputHash, 'output': outputHash}
+    if self.resume:
+      self.entries[key] = entry
+    self.manifestFile.write(json.dumps(entry, separators=(',', ':')) + "\n")
+
+  def flush(self):
+    self.manifestFile.flush()
+
+  def close(self):
+    self.manifestFile.close()
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+## Per-stage wall and CPU timing, optional cProfile/tracemalloc capture and the JSON run report
+
+import collections
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def percentile(values, fraction):
+  if len(values) == 0:
+    return 0.0
+  return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Stage():
+  """
+  Context manager timing one pass through a stage, items and barcodes may be set inside the block
+  """
+  def __init__(self, timer, name, items=1, barcodes=None):
+    self.timer = timer
+    self.name = name
+    self.items = items
+    self.barcodes = barcodes
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    self.cpuStart = time.thread_time()
+    return self
+
+  def __exit__(self, *exc):
+    self.timer.add(self.name, time.perf_counter() - self.start, time.thread_time() - self.cpuStart, self.items, self.barcodes)
+    return False
+
+
+class RunTimer():
+  """
+  Thread safe wall and CPU time totals per stage. Detailed timing also keeps every
+  sample for the latency percentiles and charges the time of every stage to the
+  barcodes it processed, both grow with the run so they are only collected on request
+  """
+  def __init__(self, detailed=False):
+    self.detailed = detailed
+    self.samples = collections.defaultdict(list)
+    self.count = collections.defaultdict(int)
+    self.wall = collections.defaultdict(float)
+    self.longest = collections.defaultdict(float)
+    self.cpu = collections.defaultdict(float)
+    self.items = collections.defaultdict(int)
+    self.barcodes = collections.defaultdict(float)
+    self.started = time.perf_counter()
+    self.cpuStarted = time.process_time()
+    self.lock = threading.Lock()
+
+  def stage(self, name, items=1, barcodes=None):
+    return Stage(self, name, items, barcodes)
+
+  # start a new reporting window, so a long-lived process does not pile up samples
+  def reset(self):
+    with self.lock:
+      for totals in (self.samples, self.count, self.wall, self.longest, self.cpu, self.items, self.barcodes):
+        totals.clear()
+      self.started = time.perf_counter()
+      self.cpuStarted = time.process_time()
+
+  def add(self, name, wall, cpu=0.0, items=1, barcodes=None):
+    with self.lock:
+      self.count[name] += 1
+      self.wall[name] += wall
+      self.longest[name] = max(self.longest[name], wall)
+      self.cpu[name] += cpu
+      self.items[name] += items
+      if not self.detailed:
+        return
+      self.samples[name].append(wall)
+      if barcodes:
+        for barcode in barcodes:
+          self.barcodes[barcode] += wall / len(barcodes)
+
+  # time every step of an iterator, e.g. each barcode yielded by a streaming parser
+  def timedIterator(self, iterable, name):
+    iterator = iter(iterable)
+    while True:
+      start = time.perf_counter()
+      cpuStart = time.thread_time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      self.add(name, time.perf_counter() - start, time.thread_time() - cpuStart, 1, [item[0]])
+      yield item
+
+  def summary(self):
+    stages = {}
+    with self.lock:
+      for name in self.count:
+        stages[name] = {'count': self.count[name], 'items': self.items[name], 'wall': self.wall[name],
+                        'cpu': self.cpu[name], 'max': self.longest[name]}
+        if self.detailed:
+          ordered = sorted(self.samples[name])
+          stages[name].update({'p50': percentile(ordered, 0.5), 'p95': percentile(ordered, 0.95)})
+      perBarcode = sorted(self.barcodes.items(), key=lambda item: -item[1])
+    summary = {'wall': time.perf_counter() - self.started, 'cpu': time.process_time() - self.cpuStarted, 'stages': stages}
+    if self.detailed:
+      ordered = sorted(seconds for barcode, seconds in perBarcode)
+      summary['barcodes'] = {'count': len(ordered), 'p50': percentile(ordered, 0.5), 'p95': percentile(ordered, 0.95),
+                             'max': ordered[-1] if len(ordered) > 0 else 0.0,
+                             'slowest': [[barcode, seconds] for barcode, seconds in perBarcode[:10]]}
+    return summary
+
+  def report(self, summary):
+    lines = ["%-18s %8s %10s %10s %9s %9s %9s\n" % ("stage", "count", "wall s", "cpu s", "p50 ms", "p95 ms", "max ms")]
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall']):
+      percentiles = ["%9.2f" % (stage[key] * 1000) if key in stage else "%9s" % "-" for key in ('p50', 'p95')]
+      lines.append("%-18s %8d %10.3f %10.3f %s %s %9.2f\n" % (name, stage['count'], stage['wall'], stage['cpu'],
+                   percentiles[0], percentiles[1], stage['max'] * 1000))
+    lines.append("run: %.3fs wall, %.3fs cpu\n" % (summary['wall'], summary['cpu']))
+    return "".join(lines)
+
+
+# samples taken in a worker process, sent back and added to the run timer of the parent
+class TimingList(list):
+  def stage(self, name):
+    return Stage(self, name)
+
+  def add(self, name, wall, cpu=0.0, items=1, barcodes=None):
+    self.append((name, wall, cpu))
+
+
+# shared by every module of a run
+timer = RunTimer()
+
+
+class Instrumentation():
+  """
+  Writes the JSON run report at the end of a run, and optionally profiles it with
+  cProfile (one profiler per thread, merged) and traces allocations with tracemalloc
+  """
+  def __init__(self, timingsFile=None, profileFile=None, traceMemory=False):
+    self.timingsFile = timingsFile
+    self.profileFile = profileFile
+    self.traceMemory = traceMemory
+    self.profilers = []
+    self.local = threading.local()
+    if traceMemory:
+      tracemalloc.start()
+    if profileFile is not None:
+      self.threadProfiler().enable()
+
+  def threadProfiler(self):
+    if getattr(self.local, 'profiler', None) is None:
+      import cProfile
+      self.local.profiler = cProfile.Profile()
+      self.profilers.append(self.local.profiler)
+    return self.local.profiler
+
+  # wrap a function run by a worker thread so it is profiled too
+  def profiled(self, function):
+    if self.profileFile is None:
+      return function
+    def call(*args, **kwargs):
+      profiler = self.threadProfiler()
+      if threading.current_thread() is threading.main_thread():
+        return function(*args, **kwargs)
+      profiler.enable()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        profiler.disable()
+    return call
+
+  def finish(self):
+    summary = timer.summary()
+    if self.profileFile is not None:
+      import pstats
+      for profiler in self.profilers:
+        profiler.disable()
+      stats = pstats.Stats(*self.profilers, stream=sys.stderr)
+      stats.dump_stats(self.profileFile)
+      stats.sort_stats('cumulative').print_stats(15)
+    if self.traceMemory:
+      current, peak = tracemalloc.get_traced_memory()
+      top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+      tracemalloc.stop()
+      summary['memory'] = {'current': current, 'peak': peak,
+                           'top': [[str(stat.traceback), stat.size, stat.count] for stat in top]}
+    if self.timingsFile is not None:
+      with open(self.timingsFile, 'w') as outfile:
+        json.dump(summary, outfile, indent=1)
+        outfile.write("\n")
+      sys.stderr.write(timer.report(summary))
+    return summary
+
+
+def addInstrumentationArguments(parser):
+  parser.add_argument("-timings", help="Write a JSON run report with per-stage wall/CPU time and p50/p95/max latencies",
+                      type=str)
+  parser.add_argument("-profile", help="Profile the run with cProfile and write the stats to this file", type=str)
+  parser.add_argument("-tracemalloc", help="Trace memory allocations and add the top allocation sites to the run report",
+                      action="store_true")
+
+# per-sample latencies and per-barcode times are only collected for the -timings report
+def startInstrumentation(args):
+  timer.detailed = args.timings is not None
+  return Instrumentation(args.timings, args.profile, args.tracemalloc)
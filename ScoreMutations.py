@@ -1,32 +1,42 @@
+## Score called mutations with the hivdb service or the local penalty table. Importable:
+## scoreFile, scoreRows and scoreGroups score in-process, main is the command line.
+## requests, numpy and sqlite3 are only imported once the backend or cache using them is made
+
+import bisect
 import json
-import requests
+import os
+import random
 import re
 import time
 import sys
 import argparse
+import glob
+import threading
+import collections
+import zlib
+from RunManifest import RunManifest
+from RunTimer import timer, addInstrumentationArguments, startInstrumentation
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-file", help="Specify a drug resistance called mutations file", type=str)
-args = parser.parse_args()
+HERE = os.path.dirname(os.path.abspath(__file__))
 
-geneClassDict = {}
+# data files are read from the working directory, falling back to the ones shipped
+# next to this module so the library works from anywhere
+def dataFile(filename):
+  if os.path.exists(filename) or os.path.isabs(filename):
+    return filename
+  return os.path.join(HERE, filename)
 
-# read in the mutation table and make a gene class lookup dict
-with open('HIV_DR_ANNO_REVISED.txt', 'r') as mutationsFile:
-  for line in mutationsFile:
-    lineparts = line.split()
+# mutation annotation table, compiled once and indexed by key, position and coordinate
+annotations = None
 
-    geneClass = lineparts[4]
-    if lineparts[4] == "P":
-      geneClass = "PR"
-    elif lineparts[4] == "I":
-      geneClass = "IN"
-    geneClassDict[lineparts[0]] = geneClass
+def getAnnotations():
+  global annotations
+  if annotations is None:
+    from AnnotationIndex import AnnotationIndex
+    annotations = AnnotationIndex.load(dataFile('HIV_DR_ANNO_REVISED.txt'))
+  return annotations
 
-query = """
-        query score($mutations:[String]!){
-          viewer {
-            mutationsAnalysis(mutations: $mutations) {
+drugResistanceFields = """
               drugResistance {
                 gene { name },
                 drugScores {
@@ -46,52 +56,348 @@ query = """
                 }
 
               }
+"""
 
+query = """
+        query score($mutations:[String]!){
+          viewer {
+            mutationsAnalysis(mutations: $mutations) {""" + drugResistanceFields + """
             }
 
           }
         }
         """
 
+versionQuery = """
+        query version {
+          viewer {
+            currentVersion { text, publishDate }
+          }
+        }
+        """
+
+# one aliased mutationsAnalysis field per barcode, b0 ... bN-1
+def batchQuery(size):
+  variables = ", ".join("$m" + str(i) + ":[String]!" for i in range(size))
+  fields = "".join("\n            b" + str(i) + ": mutationsAnalysis(mutations: $m" + str(i) + ") {" +
+                   drugResistanceFields + "            }" for i in range(size))
+  return "query scoreBatch(" + variables + "){\n          viewer {" + fields + "\n          }\n        }"
+
 #"mutations": [
 #      "PR:V32I",
 #      "PR:L76V",
 #      "RT:69Insertion"
 #    ]
 
-def makeRequest(mutations):
-  muts = [item[0] for item in mutations]
-  freqs = {re.sub(r'\w+:','', d[0]): d[1] for d in mutations}
-  resp = requests.post(
-      'https://hivdb.stanford.edu/graphql',
-      data=json.dumps({
-          'query': query,
-          'variables': {
-            "mutations": muts
-          }
-      }),
-      headers={
-          'Content-Type': 'application/json'
-      }
-  )
-  return [resp, freqs]
+class TokenBucket():
+  """
+  Thread safe token bucket limiting how often requests are sent to the scoring service
+  """
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+# frequencies by mutation text without the gene, deletions also under the text the
+# scoring service reports them as, e.g. D67Deletion for D67d
+def mutationFrequencies(mutations):
+  freqs = {}
+  for d in mutations:
+    text = re.sub(r'\w+:','', d[0])
+    freqs[text] = d[1]
+    if text.endswith('d'):
+      freqs[text[:-1] + 'Deletion'] = d[1]
+  return freqs
+
+# minority variants are parsed as [mutation, frequency, 'minority'] and reported but not scored
+minorityTier = 'minority'
+
+def isMinority(item):
+  return len(item) > 2 and item[2] == minorityTier
+
+def scoredMutations(mutations):
+  return [item for item in mutations if not isMinority(item)]
+
+class CircuitBreaker():
+  """
+  Pauses every scoring worker once the service fails repeatedly, then lets a single
+  trial request through after a cooldown before resuming the pool
+  """
+  def __init__(self, threshold=5, cooldown=30):
+    self.threshold = max(threshold, 1)
+    self.cooldown = cooldown
+    self.failures = 0
+    self.openedAt = None
+    self.trial = False
+    self.lock = threading.Lock()
+
+  def wait(self):
+    while True:
+      with self.lock:
+        if self.openedAt is None:
+          return
+        remaining = self.openedAt + self.cooldown - time.monotonic()
+        if remaining <= 0 and not self.trial:
+          self.trial = True
+          return
+      time.sleep(remaining if remaining > 0 else 0.05)
+
+  def success(self):
+    with self.lock:
+      if self.openedAt is not None:
+        sys.stderr.write("scoring service recovered, resuming requests\n")
+      self.failures = 0
+      self.openedAt = None
+      self.trial = False
+
+  def failure(self):
+    with self.lock:
+      self.failures += 1
+      if self.trial or (self.openedAt is None and self.failures >= self.threshold):
+        sys.stderr.write("scoring service degraded after " + str(self.failures) + " failures, pausing requests for " +
+                         str(self.cooldown) + "s\n")
+        self.openedAt = time.monotonic()
+        self.trial = False
+
+class LatencyHistogram():
+  """
+  Thread safe counts of request latencies in fixed buckets
+  """
+  bounds = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+  def __init__(self):
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.total = 0.0
+    self.longest = 0.0
+    self.lock = threading.Lock()
+
+  def record(self, seconds):
+    with self.lock:
+      self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+      self.total += seconds
+      self.longest = max(self.longest, seconds)
+
+  def report(self):
+    count = sum(self.counts)
+    lines = ["request latency: " + str(count) + " requests, mean %.3fs, max %.3fs\n" %
+             (self.total / max(count, 1), self.longest)]
+    for i, bucketCount in enumerate(self.counts):
+      if bucketCount > 0:
+        label = "<= %gs" % self.bounds[i] if i < len(self.bounds) else " > %gs" % self.bounds[-1]
+        lines.append("  %-8s %6d %s\n" % (label, bucketCount, "#" * int(round(40.0 * bucketCount / count))))
+    return "".join(lines)
+
+# responses worth retrying, everything else is final
+retryStatuses = (429, 500, 502, 503, 504)
+
+# seconds to wait before retry number attempt + 1, the server's Retry-After when it
+# sent one, otherwise exponential backoff with full jitter
+def retryDelay(response, attempt, backoff, maxDelay=60):
+  retryAfter = None if response is None else response.headers.get('Retry-After')
+  if retryAfter is not None:
+    try:
+      return min(float(retryAfter), maxDelay)
+    except ValueError:
+      import email.utils
+      try:
+        when = email.utils.parsedate_to_datetime(retryAfter)
+        return min(max(when.timestamp() - time.time(), 0), maxDelay)
+      except (TypeError, ValueError):
+        pass
+  return random.uniform(0, min(maxDelay, backoff * 2 ** attempt))
+
+class RemoteBackend():
+  """
+  Scores mutation lists through the hivdb GraphQL service, several lists per request when batching
+  """
+  def __init__(self, url, workers=1, rate=0.5, burst=1, timeout=30, retries=4, backoff=1.0, breaker=None):
+    self.url = url
+    self.timeout = timeout
+    self.retries = max(retries, 0)
+    self.backoff = backoff
+    self.breaker = breaker if breaker is not None else CircuitBreaker()
+    self.latencies = LatencyHistogram()
+    self.retried = 0
+    self.failed = 0
+    self.lock = threading.Lock()
+    import requests
+    self.requests = requests
+    # one pooled session shared by every worker thread
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self.rateLimiter = TokenBucket(rate, max(burst, 1))
+
+  # post a query, retrying timeouts, connection errors and 429/5xx responses. Returns
+  # the last response, or None when no attempt got one
+  def post(self, payload):
+    data = json.dumps(payload)
+    response = None
+    for attempt in range(self.retries + 1):
+      with timer.stage('breaker wait'):
+        self.breaker.wait()
+      with timer.stage('rate limit wait'):
+        self.rateLimiter.acquire()
+      with timer.stage('request') as stage:
+        try:
+          response = self.session.post(self.url, data=data, headers={'Content-Type': 'application/json'},
+                                       timeout=self.timeout)
+          reason = "HTTP " + str(response.status_code)
+        except self.requests.exceptions.RequestException as error:
+          response = None
+          reason = error.__class__.__name__
+      self.latencies.record(time.perf_counter() - stage.start)
+      if response is not None and response.status_code not in retryStatuses:
+        self.breaker.success()
+        return response
+      self.breaker.failure()
+      if attempt == self.retries:
+        break
+      delay = retryDelay(response, attempt, self.backoff)
+      with self.lock:
+        self.retried += 1
+      sys.stderr.write("scoring request failed (" + reason + "), retrying in %.1fs\n" % delay)
+      with timer.stage('backoff'):
+        time.sleep(delay)
+    with self.lock:
+      self.failed += 1
+    return response
+
+  def makeRequest(self, muts):
+    return self.post({
+        'query': query,
+        'variables': {
+          "mutations": muts
+        }
+    })
+
+  def makeBatchRequest(self, mutationLists):
+    return self.post({
+        'query': batchQuery(len(mutationLists)),
+        'variables': {"m" + str(i): muts for i, muts in enumerate(mutationLists)}
+    })
+
+  # the HIVdb algorithm version the service currently scores with, None if it cannot be queried
+  def algorithmVersion(self):
+    viewer = self.viewer(self.post({'query': versionQuery}))
+    if viewer is None or viewer.get('currentVersion') is None:
+      return None
+    return viewer['currentVersion'].get('text')
+
+  # the parsed body of a successful response, None for failed requests and malformed bodies
+  def viewer(self, response):
+    if response is None or response.status_code != 200:
+      return None
+    try:
+      return (response.json().get('data') or {}).get('viewer')
+    except ValueError:
+      return None
+
+  def score(self, mutationLists):
+    drugResistances = [None] * len(mutationLists)
+    pending = list(range(len(mutationLists)))
+    if len(pending) > 1:
+      viewer = self.viewer(self.makeBatchRequest(mutationLists))
+      if viewer is not None:
+        # a null alias only fails its own mutation list
+        for i in pending:
+          if viewer.get('b' + str(i)) is not None:
+            drugResistances[i] = viewer['b' + str(i)]['drugResistance']
+        pending = []
+    # single requests, also used when a whole batch is rejected so one bad
+    # mutation list cannot fail the rest of its batch
+    for i in pending:
+      viewer = self.viewer(self.makeRequest(mutationLists[i]))
+      if viewer is not None and viewer.get('mutationsAnalysis') is not None:
+        drugResistances[i] = viewer['mutationsAnalysis']['drugResistance']
+    return drugResistances
+
+  def close(self):
+    sys.stderr.write(self.latencies.report())
+    sys.stderr.write("scoring requests: " + str(self.retried) + " retried, " + str(self.failed) + " failed after retries\n")
+    self.session.close()
+
+# barcode, mutation, codon, [readcount, 'aachange'], frequency
+rowPattern = re.compile(r"(\S+)\s+(\S+)\s+(\S+)\s+\[(\d+),\s*'([^']*)'\]\s+(\S+)")
+mutationBasePattern = re.compile(r'\D+$')
+
+# split a called mutations line into barcode, mutation, codon, readcount, aachange and frequency
+def tokenizeRow(line, lineNumber):
+  match = rowPattern.match(line)
+  if match is None:
+    raise ValueError("malformed called mutation on line " + str(lineNumber) + ": " + line.strip())
+  return match.groups()
+
+class VariantFilter():
+  """
+  Frequency and read depth thresholds applied to called mutations while parsing. Calls
+  below minFrequency (percent) or minReads are dropped as noise, calls below
+  minorityFrequency are kept as minority variants
+  """
+  def __init__(self, minFrequency=0.0, minReads=0, minorityFrequency=0.0):
+    self.minFrequency = minFrequency
+    self.minReads = minReads
+    self.minorityFrequency = minorityFrequency
+    self.dropped = 0
+    self.minority = 0
+
+  # None for a dropped call, otherwise the tier of the call. A frequency that does
+  # not parse is never filtered
+  def tier(self, row):
+    frequency = parseFrequency(row[5])
+    if int(row[3]) < self.minReads or (frequency is not None and frequency < self.minFrequency):
+      self.dropped += 1
+      return None
+    if frequency is not None and frequency < self.minorityFrequency:
+      self.minority += 1
+      return minorityTier
+    return 'majority'
+
+  def report(self):
+    if self.minFrequency > 0 or self.minReads > 0 or self.minorityFrequency > 0:
+      sys.stderr.write(str(self.dropped) + " calls below " + str(self.minFrequency) + "% or " + str(self.minReads) +
+                       " reads dropped, " + str(self.minority) + " minority variants below " +
+                       str(self.minorityFrequency) + "% reported unscored\n")
 
 # convert the called mutations into the mutation string for API query
 def apiMutationString(row):
   barcode = row[0]
   mutation = row[1]
-  readcount = re.sub('[[,]', '', row[3])
-  aachange = re.sub('[]\']', '', row[4])
-  aachange = re.sub(':MUT/RESISTANT', '', aachange)
+  readcount = row[3]
+  aachange = row[4].replace(':MUT/RESISTANT', '')
   frequency = row[5]
-  mutationBase = re.sub(r'\D+$', '', mutation)
+  mutationBase = mutationBasePattern.sub('', mutation)
   mutationString = ""
-  if mutationBase == "T69":
-    mutationString = "RT:69Insertion" # API generic name for T69dDNG
+  if mutationBase in ("T69", "(KW)69"):
+    mutationString = "RT:69Insertion" # API generic name for T69dDNG and the (KW)69 dipeptide insertions
   else:
-    mutationString = geneClassDict[mutation] + ':' + mutationBase + aachange
+    mutationString = getAnnotations().byKey(mutation).gene + ':' + mutationBase + aachange
   return [mutationString, frequency]
 
+# the parsed mutation of a row, None when the row is filtered out
+def parseMutation(row, variants=None):
+  tier = 'majority' if variants is None else variants.tier(row)
+  if tier is None:
+    return None
+  if tier == minorityTier:
+    return apiMutationString(row) + [minorityTier]
+  return apiMutationString(row)
+
 def unpackResponse(json, freqs):
   outputLines = []
   for gene in json:
@@ -122,43 +428,723 @@ def unpackResponse(json, freqs):
         #print()
   return "".join(outputLines)
 
-mutationsDict = {}
-
-with open(args.file, 'r') as mutationsFile:
-  for line in mutationsFile:
-    lineparts = line.split()
-    mutationData = apiMutationString(lineparts)
-    mutString = mutationData[0]
-    frequency = mutationData[1]
-    barcode = lineparts[0]
-    if not barcode in mutationsDict:
-      mutationsDict[barcode] = [[mutString, frequency]]
+# the text view line listing the minority variants of a barcode, read back by ReportGenerator
+def minorityLine(mutations, minorityFrequency):
+  return ("\nminority variants below " + str(minorityFrequency) + "%: " +
+          ",".join(item[0] + ':' + item[1] for item in mutations if isMinority(item)) + ",\n")
+
+def tokenizeRows(lines):
+  for lineNumber, line in enumerate(lines, 1):
+    if line.strip():
+      yield lineNumber, tokenizeRow(line, lineNumber)
+
+def readRows(filename):
+  with open(filename, 'r') as mutationsFile:
+    yield from tokenizeRows(mutationsFile)
+
+# called mutation files named on the command line, glob patterns expanded in sorted order
+def inputFiles(patterns):
+  if isinstance(patterns, str):
+    patterns = [patterns]
+  filenames = []
+  for pattern in patterns:
+    matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    if len(matches) == 0:
+      raise ValueError("no called mutations files match " + pattern)
+    filenames.extend(matches)
+  return filenames
+
+# the rows of several files read one after the other, as if they were one file
+def readFilesRows(filenames):
+  for filename in filenames:
+    try:
+      yield from readRows(filename)
+    except ValueError as error:
+      raise ValueError(filename + ": " + str(error))
+
+# shard i of N holds the barcodes whose stable hash is i modulo N, so every node
+# picks its barcodes from the same inputs without coordination
+def barcodeShard(barcode, count):
+  return zlib.crc32(barcode.encode()) % count
+
+def parseShard(text):
+  try:
+    index, count = [int(part) for part in text.split('/')]
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected i/N, e.g. 0/4")
+  if count < 1 or not 0 <= index < count:
+    raise argparse.ArgumentTypeError("shard index must be between 0 and N - 1")
+  return (index, count)
+
+def shardRows(rows, shard):
+  if shard is None:
+    return rows
+  index, count = shard
+  return ((lineNumber, row) for lineNumber, row in rows if barcodeShard(row[0], count) == index)
+
+def unknownMutation(row, lineNumber):
+  return "unknown mutation " + row[1] + " for barcode " + row[0] + " on line " + str(lineNumber)
+
+# read the whole file first, rows of a barcode may appear anywhere. Every
+# mutation is checked against the annotation table before anything is scored.
+# A barcode whose calls are all filtered out is kept with no mutations
+def readBarcodeGroups(filenames, variants=None, shard=None):
+  return groupRows(shardRows(readFilesRows(inputFiles(filenames)), shard), variants)
+
+# the (barcode, mutations) groups of tokenized rows, e.g. of called mutations posted to the service
+def groupRows(rows, variants=None):
+  annotations = getAnnotations()
+  mutationsDict = {}
+  unknown = []
+  for lineNumber, row in rows:
+    if row[1] not in annotations:
+      unknown.append(unknownMutation(row, lineNumber))
+      continue
+    mutations = mutationsDict.setdefault(row[0], [])
+    mutation = parseMutation(row, variants)
+    if mutation is not None:
+      mutations.append(mutation)
+  if len(unknown) > 0:
+    raise ValueError("mutations missing from the annotation table:\n" + "\n".join(unknown))
+  return list(mutationsDict.items())
+
+# yield each barcode as soon as its rows are complete, which needs the rows of
+# a barcode to be contiguous (grouped or sorted input)
+def streamBarcodeGroups(filenames, variants=None, shard=None):
+  filenames = inputFiles(filenames)
+  annotations = getAnnotations()
+  seen = set()
+  barcode = None
+  mutations = []
+  for lineNumber, row in shardRows(readFilesRows(filenames), shard):
+    if row[1] not in annotations:
+      raise ValueError(unknownMutation(row, lineNumber))
+    if row[0] != barcode:
+      if barcode is not None:
+        yield (barcode, mutations)
+      if row[0] in seen:
+        raise ValueError("barcode " + row[0] + " is not contiguous in " + ", ".join(filenames) + ", rerun without -stream")
+      seen.add(row[0])
+      barcode = row[0]
+      mutations = []
+    mutation = parseMutation(row, variants)
+    if mutation is not None:
+      mutations.append(mutation)
+  if barcode is not None:
+    yield (barcode, mutations)
+
+def batched(groups, size):
+  batch = []
+  for group in groups:
+    batch.append(group)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if len(batch) > 0:
+    yield batch
+
+def parseFrequency(frequency):
+  try:
+    return float(frequency)
+  except ValueError:
+    return None
+
+# typed result for one barcode, written as a line of the JSON Lines results file
+def resultRecord(barcode, mutations, drugResistance, minorityFrequency=0.0):
+  scored = scoredMutations(mutations)
+  freqs = mutationFrequencies(scored)
+  record = {
+    'barcode': barcode,
+    'status': 'scored',
+    'mutations': [{'mutation': item[0], 'frequency': parseFrequency(item[1])} for item in mutations],
+    'genes': []
+  }
+  for item, mutation in zip(mutations, record['mutations']):
+    if isMinority(item):
+      mutation['minority'] = True
+      record['minorityFrequency'] = minorityFrequency
+  if len(scored) == 0:
+    record['status'] = 'no mutations'
+  elif drugResistance is None:
+    record['status'] = 'error'
+  else:
+    for gene in drugResistance:
+      drugScores = []
+      for drugDef in gene['drugScores']:
+        partialScores = []
+        for score in drugDef['partialScores']:
+          texts = [mutation['text'] for mutation in score['mutations']]
+          frequency = freqs.get("69Insertion" if texts[0] == "T69Insertion" else texts[0])
+          partialScores.append({'mutations': texts, 'score': score['score'],
+                                'frequency': None if frequency is None else parseFrequency(frequency)})
+        drugScores.append({'drugClass': drugDef['drugClass']['name'], 'drug': drugDef['drug']['name'],
+                           'score': drugDef['score'], 'level': drugDef['level'], 'SIR': drugDef['SIR'],
+                           'text': drugDef['text'], 'partialScores': partialScores})
+      record['genes'].append({'gene': gene['gene']['name'], 'drugScores': drugScores})
+  return record
+
+# canonical form of a mutation set, the same one the response cache keys on
+def mutationSetKey(mutations):
+  return tuple(sorted(set(item[0] for item in mutations)))
+
+class ScoredSet():
+  """
+  A distinct mutation set of the run, scored once for every barcode carrying it
+  """
+  def __init__(self):
+    self.done = threading.Event()
+    self.drugResistance = None
+
+class MutationScorer():
+  """
+  Scores batches of (barcode, mutations) groups with a backend and an optional response cache.
+  Barcodes with the same mutation set, e.g. replicates and controls, share one scoring
+  request per run; the last dedupSize distinct sets are remembered
+  """
+  def __init__(self, backend, cache=None, refresh=False, minorityFrequency=0.0, dedupSize=20000):
+    self.backend = backend
+    self.cache = cache
+    self.refresh = refresh
+    self.minorityFrequency = minorityFrequency
+    self.dedupSize = dedupSize
+    self.scoredSets = collections.OrderedDict()
+    self.barcodes = 0
+    self.duplicates = 0
+    self.lock = threading.Lock()
+
+  # the ScoredSet of a mutation set and whether this call created it, so the caller has to score it
+  def claim(self, mutations):
+    key = mutationSetKey(mutations)
+    with self.lock:
+      self.barcodes += 1
+      scoredSet = self.scoredSets.get(key)
+      if scoredSet is not None:
+        self.scoredSets.move_to_end(key)
+        self.duplicates += 1
+        return scoredSet, False
+      scoredSet = ScoredSet()
+      if self.dedupSize > 0:
+        self.scoredSets[key] = scoredSet
+        if len(self.scoredSets) > self.dedupSize:
+          self.scoredSets.popitem(last=False)
+      return scoredSet, True
+
+  # failed sets are forgotten so a later barcode with the same mutations tries again
+  def release(self, mutations, scoredSet):
+    with self.lock:
+      key = mutationSetKey(mutations)
+      if scoredSet.drugResistance is None and self.scoredSets.get(key) is scoredSet:
+        del self.scoredSets[key]
+    scoredSet.done.set()
+
+  # returns one (text output, result record) pair per barcode, the text output
+  # being None for barcodes whose query failed. Each barcode keeps its own
+  # frequencies even when its scores were fanned out from another barcode
+  def scoreBatch(self, batch):
+    mutationsDict = {barcode: scoredMutations(mutations) for barcode, mutations in batch}
+    scoredSets = {}
+    owned = []
+    pending = []
+    try:
+      with timer.stage('cache', len(batch)):
+        for barcode, mutations in mutationsDict.items():
+          if len(mutations) == 0:
+            continue
+          scoredSets[barcode], claimed = self.claim(mutations)
+          if not claimed:
+            continue
+          owned.append(barcode)
+          if self.cache is not None and not self.refresh:
+            scoredSets[barcode].drugResistance = self.cache.get([item[0] for item in mutations])
+            if scoredSets[barcode].drugResistance is not None:
+              continue
+          pending.append(barcode)
+
+      if len(pending) > 0:
+        mutationLists = [[item[0] for item in mutationsDict[barcode]] for barcode in pending]
+        with timer.stage('score', len(pending), pending):
+          scored = self.backend.score(mutationLists)
+        for barcode, muts, drugResistance in zip(pending, mutationLists, scored):
+          scoredSets[barcode].drugResistance = drugResistance
+          if self.cache is not None and drugResistance is not None:
+            self.cache.put(muts, drugResistance)
+    finally:
+      # sets are published before waiting on other batches, so two batches never wait on each other
+      for barcode in owned:
+        self.release(mutationsDict[barcode], scoredSets[barcode])
+
+    outputs = []
+    for barcode, mutations in batch:
+      drugResistance = None
+      if barcode in scoredSets:
+        with timer.stage('dedup wait', 1, [barcode]):
+          scoredSets[barcode].done.wait()
+        drugResistance = scoredSets[barcode].drugResistance
+      with timer.stage('unpack', 1, [barcode]):
+        record = resultRecord(barcode, mutations, drugResistance, self.minorityFrequency)
+        if len(mutationsDict[barcode]) == 0:
+          output = "No mutations called for barcode"
+        elif drugResistance is None:
+          output = None
+        else:
+          output = unpackResponse(drugResistance, mutationFrequencies(mutationsDict[barcode]))
+        if output is not None and len(mutationsDict[barcode]) < len(mutations):
+          output += minorityLine(mutations, self.minorityFrequency)
+        outputs.append((output, record))
+    return outputs
+
+  def dedupRatio(self):
+    if self.barcodes == self.duplicates:
+      return 1.0
+    return self.barcodes / float(self.barcodes - self.duplicates)
+
+  def close(self):
+    sys.stderr.write("dedup: " + str(self.barcodes) + " barcodes with mutations, " + str(self.barcodes - self.duplicates) +
+                     " distinct mutation sets scored, ratio %.2f\n" % self.dedupRatio())
+    self.backend.close()
+    if self.cache is not None:
+      sys.stderr.write("response cache: " + str(self.cache.hits) + " hits, " + str(self.cache.misses) + " misses\n")
+      self.cache.close()
+
+
+class ResultWriter():
+  """
+  Writes the JSON Lines results file and the optional <barcode>_scores.txt text view of a run,
+  and adds the records to a results store run when one is given. With a run archive the
+  text views are entries of the archive instead of a file each, and the results file is
+  added to it when the run closes
+  """
+  def __init__(self, outputDir='output', resultsFile=None, text=True, manifest=None, resume=False, store=None, run=None,
+               archive=None):
+    self.outputDir = outputDir
+    self.text = text
+    self.manifest = manifest
+    self.store = store
+    self.run = run
+    self.archive = archive
+    self.errorBarcodes = []
+    self.skipped = []
+    if resultsFile is None:
+      resultsFile = os.path.join(outputDir, 'results.jsonl')
+    # result lines of the previous run, carried over for barcodes that are not scored again
+    self.previous = {}
+    if resume and os.path.exists(resultsFile):
+      with open(resultsFile, 'r') as infile:
+        for line in infile:
+          try:
+            self.previous[json.loads(line)['barcode']] = line
+          except ValueError:
+            continue
+    self.resultsPath = resultsFile
+    self.resultsFile = open(resultsFile, 'w')
+
+  # true when the manifest shows the barcode was scored from the same mutations
+  # and its previous result line is intact
+  def current(self, barcode, mutations):
+    return self.manifest is not None and self.manifest.current(barcode, self.manifest.inputHash(mutations),
+                                                               self.previous.get(barcode))
+
+  # batches must be written in input order, each text view lists the failed
+  # barcodes written so far
+  def writeBatch(self, batch, outputs):
+    with timer.stage('write', len(batch)):
+      self.writeRecords(batch, outputs)
+
+  def writeRecords(self, batch, outputs):
+    for (barcode, mutations), (output, record) in zip(batch, outputs):
+      line = json.dumps(record, separators=(',', ':')) + "\n"
+      self.resultsFile.write(line)
+      if output is None:
+        self.errorBarcodes.append(barcode)
+      if self.text:
+        self.writeTextView(barcode, output)
+      if self.manifest is not None:
+        self.manifest.record(barcode, record['status'], self.manifest.inputHash(mutations), self.manifest.outputHash(line))
+      sys.stderr.write("barcode " + barcode + " scored\n")
+    if self.store is not None:
+      self.store.addRecords(self.run, [record for output, record in outputs])
+    # results reach the disk before the manifest marks them done
+    self.resultsFile.flush()
+    if self.manifest is not None:
+      self.manifest.flush()
+
+  # the whitespace separated _scores.txt view of a result
+  def writeTextView(self, barcode, output):
+    parts = ['barcode: ' + barcode, "\n"]
+    if output is not None:
+      parts.append(output)
     else:
-      mutationsDict[barcode].append([mutString, frequency])
-
-errorBarcodes = []
-
-for barcode in mutationsDict:
-  with open('output/' + barcode + '_scores.txt', 'w') as outfile:
-    outfile.write('barcode: ' + barcode)
-    outfile.write("\n")
-    if len(mutationsDict[barcode]) > 0:
-      req = makeRequest(mutationsDict[barcode])
-      response = req[0]
-      frequencies = req[1]
-      if response.status_code == 200:
-        output = unpackResponse(response.json()['data']['viewer']['mutationsAnalysis']['drugResistance'], frequencies)
-        outfile.write(output)
-      else:
-        outfile.write("Error with query!")
-        errorBarcodes.append(barcode)
+      parts.append("Error with query!")
+
+    parts.append("\n")
+    parts.append("barcodes with errors:")
+    parts.extend(self.errorBarcodes)
+    if self.archive is not None:
+      self.archive.add(barcode + '_scores.txt', "".join(parts))
+    else:
+      with open(os.path.join(self.outputDir, barcode + '_scores.txt'), 'w') as outfile:
+        outfile.write("".join(parts))
+
+  def close(self):
+    for barcode in self.skipped:
+      self.resultsFile.write(self.previous[barcode])
+      if self.archive is not None and self.text:
+        self.archive.carry(barcode + '_scores.txt')
+    if len(self.skipped) > 0:
+      sys.stderr.write(str(len(self.skipped)) + " barcodes unchanged since the last run, results carried over\n")
+    self.resultsFile.close()
+    if self.archive is not None:
+      self.archive.addFile('results.jsonl', self.resultsPath)
+      self.archive.close()
+      sys.stderr.write(str(self.archive.count) + " entries written to " + self.archive.path + "\n")
+    if self.manifest is not None:
+      self.manifest.close()
+    if self.store is not None:
+      self.store.close()
+
+  # close a run stopped by an error. What was written stays for -resume, the previous
+  # run archive is kept instead of being replaced by a partial one
+  def abort(self):
+    self.resultsFile.close()
+    if self.archive is not None:
+      self.archive.abort()
+    if self.manifest is not None:
+      self.manifest.close()
+    if self.store is not None:
+      self.store.close()
+
+
+def addScoringArguments(parser):
+  parser.add_argument("-file", help="Drug resistance called mutations files or glob patterns, read as one input",
+                      type=str, nargs='+')
+  parser.add_argument("-shard", "--shard", help="Score only shard i of N (0 <= i < N), barcodes are split by a stable "
+                      "hash; results and manifest get shard names so shards can share the output directory",
+                      type=parseShard)
+  parser.add_argument("-merge", "--merge", help="Merge the shard results and manifests in the output directory into "
+                      "one run result, in the order of the -file inputs", action="store_true")
+  parser.add_argument("-url", help="GraphQL endpoint used for scoring", type=str,
+                      default="https://hivdb.stanford.edu/graphql")
+  parser.add_argument("-workers", help="Number of scoring requests in flight at once", type=int, default=1)
+  parser.add_argument("-rate", help="Maximum scoring requests per second", type=float, default=0.5)
+  parser.add_argument("-burst", help="Number of requests allowed back to back before rate limiting", type=int, default=1)
+  parser.add_argument("-backend", help="Scoring backend, the remote hivdb service or the local penalty table",
+                      choices=["remote", "local"], default="remote")
+  parser.add_argument("-scores", help="Penalty score table used by the local backend", type=str,
+                      default="HIVDB_PENALTY_SCORES.json")
+  parser.add_argument("-stream", help="Score barcodes while the input is still being read, rows of a barcode must be contiguous",
+                      action="store_true")
+  parser.add_argument("-results", help="JSON Lines file receiving one structured result record per barcode, "
+                      "defaults to results.jsonl in the output directory", type=str)
+  parser.add_argument("-no-text", help="Do not write the <barcode>_scores.txt text view", action="store_true")
+  parser.add_argument("-min-frequency", help="Drop calls below this frequency (percent) while parsing", type=float,
+                      default=0.0)
+  parser.add_argument("-min-reads", help="Drop calls supported by fewer reads while parsing", type=int, default=0)
+  parser.add_argument("-minority-frequency", help="Report calls below this frequency (percent) as minority variants "
+                      "without scoring them, e.g. 20", type=float, default=0.0)
+  parser.add_argument("-dedup-size", help="Distinct mutation sets remembered so barcodes sharing one are scored once, "
+                      "0 scores every barcode", type=int, default=20000)
+  parser.add_argument("-batch", help="Number of barcodes packed into one GraphQL request", type=int, default=1)
+  parser.add_argument("-timeout", help="Seconds before a scoring request times out", type=float, default=30)
+  parser.add_argument("-retries", help="Retries of a failed or timed out scoring request", type=int, default=4)
+  parser.add_argument("-backoff", help="Base delay in seconds of the exponential retry backoff", type=float, default=1.0)
+  parser.add_argument("-breaker-failures", help="Consecutive request failures that pause scoring", type=int, default=5)
+  parser.add_argument("-breaker-cooldown", help="Seconds scoring is paused once the service is degraded", type=float,
+                      default=30)
+  parser.add_argument("-cache", help="Path of the persistent response cache", type=str, default="hivdr_cache.sqlite")
+  parser.add_argument("-cache-size", help="Maximum response cache size in MB", type=float, default=256)
+  parser.add_argument("-cache-age", help="Maximum age of cached responses in days", type=float, default=30)
+  parser.add_argument("-algorithm-version", help="HIVdb algorithm version, part of the cache key and manifest, defaults "
+                      "to the version the scoring service or penalty table reports", type=str)
+  parser.add_argument("-no-cache", "--no-cache", help="Do not read or write the response cache", action="store_true")
+  parser.add_argument("-refresh", "--refresh", help="Ignore cached responses and store fresh ones", action="store_true")
+  parser.add_argument("-output", help="Directory for results.jsonl and the _scores.txt files", type=str, default="output")
+  parser.add_argument("-manifest", help="Run manifest recording the status and hashes of every barcode, "
+                      "defaults to manifest.jsonl in the output directory", type=str)
+  parser.add_argument("-store", help="Results store the scored records are also added to, see ResultsStore.py", type=str)
+  parser.add_argument("-archive", help="Zip archive receiving the _scores.txt text views and results of the run instead "
+                      "of a file per barcode", type=str)
+  parser.add_argument("-compress", help="Deflate the entries of -archive", action="store_true")
+  parser.add_argument("-run-name", help="Name of the run in the results store, defaults to the results file path", type=str)
+  parser.add_argument("-resume", "--resume", help="Skip barcodes already scored from unchanged mutations in the previous run",
+                      action="store_true")
+  parser.add_argument("-retry-failed", "--retry-failed", help="Only rescore barcodes that failed or changed since the "
+                      "previous run", action="store_true")
+
+def makeScorer(args):
+  # the local backend is faster than the response cache, so only remote scoring uses it
+  if args.backend == "local":
+    from LocalScorer import LocalScorer
+    backend = LocalScorer(dataFile(args.scores))
+  else:
+    backend = RemoteBackend(args.url, args.workers, args.rate, args.burst, args.timeout, args.retries, args.backoff,
+                            CircuitBreaker(args.breaker_failures, args.breaker_cooldown))
+  # cached responses and manifest entries are only reused for the same algorithm version
+  if args.algorithm_version is None:
+    args.algorithm_version = backend.version if args.backend == "local" else backend.algorithmVersion()
+    if args.algorithm_version is None:
+      backend.close()
+      raise ValueError("could not query the algorithm version of " + args.url + ", give -algorithm-version")
+
+  cache = None
+  if not args.no_cache and args.backend == "remote":
+    from ResponseCache import ResponseCache
+    cache = ResponseCache(args.cache, query, args.algorithm_version,
+                          maxBytes=int(args.cache_size * 1024 * 1024), maxAge=args.cache_age * 86400)
+  return MutationScorer(backend, cache, args.refresh, args.minority_frequency, args.dedup_size)
+
+# the local backend multiplies whole chunks of barcodes at once
+def batchSize(args):
+  if args.backend == "local" and args.batch == 1:
+    return 4096
+  return max(args.batch, 1)
+
+def makeVariantFilter(args):
+  return VariantFilter(args.min_frequency, args.min_reads, args.minority_frequency)
+
+def readGroups(args, variants=None):
+  if args.stream:
+    return timer.timedIterator(streamBarcodeGroups(args.file, variants, args.shard), 'parse')
+  with timer.stage('parse') as stage:
+    groups = readBarcodeGroups(args.file, variants, args.shard)
+    stage.items = len(groups)
+  return groups
+
+# settings that change the result of scoring the same mutations
+def scoringSettings(args):
+  return [args.backend, args.url if args.backend == "remote" else args.scores, args.algorithm_version]
+
+# results.jsonl or manifest.jsonl in the output directory
+def runFile(args, name):
+  return os.path.join(args.output, name + '.jsonl')
+
+# a path with .shard-i-of-N inserted before its extension for a shard
+def shardFile(path, shard=None):
+  if shard is None:
+    return path
+  base, extension = os.path.splitext(path)
+  return base + '.shard-%d-of-%d' % shard + extension
+
+# the results and manifest files of the run, -results and -manifest or the defaults in
+# the output directory, with shard names for a shard
+def resultsFiles(args, shard=None):
+  resultsFile = args.results if args.results is not None else runFile(args, 'results')
+  manifestFile = args.manifest if args.manifest is not None else runFile(args, 'manifest')
+  return shardFile(resultsFile, shard), shardFile(manifestFile, shard)
+
+# run archive entries a scoring run writes, the rest of an existing archive is kept
+scoringEntries = ('*_scores.txt', 'results.jsonl')
+
+def makeWriter(args):
+  resultsFile, manifestFile = resultsFiles(args, args.shard)
+  resume = args.resume or args.retry_failed
+  manifest = RunManifest(manifestFile, scoringSettings(args), resume)
+  store = None
+  run = None
+  if args.store is not None:
+    from ResultsStore import ResultsStore
+    store = ResultsStore(args.store)
+    run = store.addRun(args.run_name or os.path.normpath(resultsFile), os.path.abspath(resultsFile))
+  archive = None
+  if args.archive is not None:
+    from RunArchive import RunArchive
+    archive = RunArchive(shardFile(args.archive, args.shard), args.compress, scoringEntries)
+  return ResultWriter(args.output, resultsFile, not args.no_text, manifest, resume, store, run, archive)
+
+# combine the results and manifests of every shard into the results and manifest files
+# a single run over the same inputs writes, with barcodes in the order they first
+# appear in the inputs
+def mergeShards(args):
+  resultsFile, manifestFile = resultsFiles(args)
+  base, extension = os.path.splitext(resultsFile)
+  shardPattern = re.compile(re.escape(base) + r'\.shard-(\d+)-of-(\d+)' + re.escape(extension) + '$')
+  shards = {}
+  for filename in glob.glob(glob.escape(base) + '.shard-*-of-*' + glob.escape(extension)):
+    match = shardPattern.match(filename)
+    if match is not None:
+      shards[(int(match.group(1)), int(match.group(2)))] = filename
+  counts = set(count for index, count in shards)
+  if len(counts) != 1:
+    raise ValueError("expected the results of one set of shards next to " + resultsFile + ", found " +
+                     (", ".join(sorted(os.path.basename(filename) for filename in shards.values())) or "none"))
+  count = counts.pop()
+  missing = [str(index) for index in range(count) if (index, count) not in shards]
+  if len(missing) > 0:
+    raise ValueError("no results for shards " + ", ".join(missing) + " of " + str(count))
+
+  lines = {}
+  entries = {}
+  for shard in sorted(shards):
+    with open(shards[shard], 'r') as infile:
+      for line in infile:
+        try:
+          lines[json.loads(line)['barcode']] = line
+        except ValueError:
+          continue  # a line cut short by a crash
+    shardManifest = shardFile(manifestFile, shard)
+    if os.path.exists(shardManifest):
+      with open(shardManifest, 'r') as infile:
+        for line in infile:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue
+          entries[entry['key']] = entry
+
+  order = list(collections.OrderedDict.fromkeys(row[0] for lineNumber, row in readFilesRows(inputFiles(args.file))))
+  unscored = [barcode for barcode in order if barcode not in lines]
+  if len(unscored) > 0:
+    raise ValueError(str(len(unscored)) + " barcodes have no result in any shard, e.g. " + unscored[0])
+  if args.archive is not None:
+    missing = [str(index) for index in range(count) if not os.path.exists(shardFile(args.archive, (index, count)))]
+    if len(missing) > 0:
+      raise ValueError("no run archive for shards " + ", ".join(missing) + " of " + str(count))
+
+  with open(resultsFile + '.tmp', 'w') as outfile:
+    for barcode in order:
+      outfile.write(lines[barcode])
+  with open(manifestFile + '.tmp', 'w') as outfile:
+    for barcode in order:
+      if barcode in entries:
+        outfile.write(json.dumps(entries[barcode], separators=(',', ':')) + "\n")
+  os.replace(resultsFile + '.tmp', resultsFile)
+  os.replace(manifestFile + '.tmp', manifestFile)
+  sys.stderr.write("merged " + str(count) + " shards, " + str(len(order)) + " barcodes into " + resultsFile + "\n")
+  if args.archive is not None:
+    mergeShardArchives(args, count, order, resultsFile)
+
+# the text views of the shard archives in input order and the merged results, as the
+# archive of a single run
+def mergeShardArchives(args, count, order, resultsFile):
+  import zipfile
+  from RunArchive import RunArchive
+  shardArchives = [zipfile.ZipFile(shardFile(args.archive, (index, count)), 'r') for index in range(count)]
+  located = {}
+  for shardArchive in shardArchives:
+    for name in shardArchive.namelist():
+      if name.endswith('_scores.txt'):
+        located[name] = shardArchive
+  archive = RunArchive(args.archive, args.compress, scoringEntries)
+  for barcode in order:
+    name = barcode + '_scores.txt'
+    if name in located:
+      archive.add(name, located[name].read(name))
+  archive.addFile('results.jsonl', resultsFile)
+  archive.close()
+  for shardArchive in shardArchives:
+    shardArchive.close()
+  sys.stderr.write(str(archive.count) + " entries written to " + args.archive + "\n")
+
+# drop barcodes whose previous result is still current, with -retry-failed also
+# the barcodes the previous run never reached
+def pendingGroups(groups, writer, retryFailed=False):
+  for barcode, mutations in groups:
+    if writer.current(barcode, mutations):
+      writer.skipped.append(barcode)
+    elif not retryFailed or writer.manifest.get(barcode) is not None:
+      yield (barcode, mutations)
+
+# options of the library entry points: the command line defaults with keyword
+# overrides, e.g. scoringOptions(backend='local', minority_frequency=20)
+def scoringOptions(**overrides):
+  parser = argparse.ArgumentParser()
+  addScoringArguments(parser)
+  options = parser.parse_args([])
+  for name, value in overrides.items():
+    if not hasattr(options, name):
+      raise TypeError("unknown scoring option " + name)
+    setattr(options, name, value)
+  return options
+
+# score (barcode, mutations) groups in-process, returning the result record of every
+# barcode in input order. A scorer passed in stays open so it can be reused
+def scoreGroups(groups, options=None, scorer=None):
+  if options is None:
+    options = scoringOptions()
+  ownScorer = scorer is None
+  if ownScorer:
+    scorer = makeScorer(options)
+  try:
+    batches = list(batched(groups, batchSize(options)))
+    if options.workers > 1 and len(batches) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=options.workers) as executor:
+        outputs = list(executor.map(scorer.scoreBatch, batches))
     else:
-      outfile.write("No mutations called for barcode")
-    time.sleep(2)
+      outputs = [scorer.scoreBatch(batch) for batch in batches]
+  finally:
+    if ownScorer:
+      scorer.close()
+  return [record for batchOutputs in outputs for output, record in batchOutputs]
+
+# score called mutation lines in the -file format
+def scoreRows(lines, options=None, scorer=None):
+  if options is None:
+    options = scoringOptions()
+  return scoreGroups(groupRows(tokenizeRows(lines), makeVariantFilter(options)), options, scorer)
+
+def scoreFile(filename, options=None, scorer=None):
+  with open(filename, 'r') as mutationsFile:
+    return scoreRows(mutationsFile, options, scorer)
+
+def main(argv=None):
+  from concurrent.futures import ThreadPoolExecutor
+  parser = argparse.ArgumentParser()
+  addScoringArguments(parser)
+  addInstrumentationArguments(parser)
+  args = parser.parse_args(argv)
+  if args.file is None:
+    parser.error("-file is required" + (", -merge orders the barcodes as the inputs do" if args.merge else ""))
+
+  if args.merge:
+    try:
+      mergeShards(args)
+    except ValueError as error:
+      sys.stderr.write(str(error) + "\n")
+      sys.exit(1)
+    return
+
+  instrumentation = startInstrumentation(args)
+  variants = makeVariantFilter(args)
+  try:
+    groups = readGroups(args, variants)
+  except ValueError as error:
+    sys.stderr.write(str(error) + "\n")
+    sys.exit(1)
+
+  os.makedirs(args.output, exist_ok=True)
+  try:
+    scorer = makeScorer(args)
+  except ValueError as error:
+    sys.stderr.write(str(error) + "\n")
+    sys.exit(1)
+  writer = makeWriter(args)
+  if args.resume or args.retry_failed:
+    groups = pendingGroups(groups, writer, args.retry_failed)
 
-    outfile.write("\n")
-    outfile.write("barcodes with errors:")
-    for barcode in errorBarcodes:
-      outfile.write(barcode)
-  sys.stderr.write("barcode " + barcode + " scored\n")
+  # batches run concurrently but are written in input order so every output file
+  # is written exactly as it would be by a sequential run. Only a bounded number
+  # of batches is in flight, so parsing overlaps with scoring without reading ahead
+  inFlight = collections.deque()
+  try:
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+      for batch in batched(groups, batchSize(args)):
+        inFlight.append((batch, executor.submit(instrumentation.profiled(scorer.scoreBatch), batch)))
+        if len(inFlight) >= 2 * max(args.workers, 1):
+          batch, future = inFlight.popleft()
+          writer.writeBatch(batch, future.result())
+      while len(inFlight) > 0:
+        batch, future = inFlight.popleft()
+        writer.writeBatch(batch, future.result())
+  except ValueError as error:
+    # with -stream the input is only parsed while scoring
+    writer.abort()
+    scorer.close()
+    sys.stderr.write(str(error) + "\n")
+    sys.exit(1)
+  writer.close()
+  scorer.close()
+  variants.report()
+  instrumentation.finish()
 
+if __name__ == "__main__":
+  main()
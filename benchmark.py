@@ -0,0 +1,558 @@
+#!/usr/bin/python
+
+## Throughput benchmarks for the scoring pipeline against a local stand-in GraphQL server
+
+import collections
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from AnnotationIndex import AnnotationIndex
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class StubGraphQLHandler(BaseHTTPRequestHandler):
+  """
+  Answers mutationsAnalysis queries with a fixed score per mutation after a simulated network latency
+  """
+  latency = 0.05
+
+  def do_POST(self):
+    body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    viewer = {}
+    # plain and aliased (batched) mutationsAnalysis fields
+    for alias, variable in re.findall(r'(?:(\w+): )?mutationsAnalysis\(mutations: \$(\w+)\)', body['query']):
+      viewer[alias or 'mutationsAnalysis'] = {'drugResistance': self.drugResistance(body['variables'][variable])}
+    if 'currentVersion' in body['query']:
+      viewer['currentVersion'] = {'text': 'stub', 'publishDate': '2020-01-01'}
+    time.sleep(self.latency)
+    payload = json.dumps({'data': {'viewer': viewer}})
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload.encode())
+
+  def drugResistance(self, mutations):
+    genes = {}
+    for mutation in mutations:
+      gene, text = mutation.split(':')
+      if text == "69Insertion":
+        text = "T69Insertion"
+      genes.setdefault(gene, []).append({'mutations': [{'text': text}], 'score': 5.0})
+    output = []
+    for gene in genes:
+      score = 5.0 * len(genes[gene])
+      output.append({'gene': {'name': gene},
+                     'drugScores': [{'drugClass': {'name': 'NRTI'}, 'drug': {'name': 'ABC', 'displayAbbr': 'ABC'},
+                                     'SIR': 'S', 'score': score, 'level': 1, 'text': 'Susceptible',
+                                     'partialScores': genes[gene]}]})
+    return output
+
+  def log_message(self, format, *args):
+    pass
+
+
+def startStubServer(latency, handler=StubGraphQLHandler):
+  handler.latency = latency
+  server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server, 'http://127.0.0.1:' + str(server.server_address[1]) + '/graphql'
+
+
+# working directory with the annotation table and an empty output folder, so a
+# benchmark run never touches the real output/ directory
+def makeWorkdir():
+  workdir = tempfile.mkdtemp(prefix='hivdr_bench_')
+  for filename in ('HIV_DR_ANNO_REVISED.txt', 'HIVDB_PENALTY_SCORES.json'):
+    os.symlink(os.path.join(HERE, filename), os.path.join(workdir, filename))
+  os.mkdir(os.path.join(workdir, 'output'))
+  return workdir
+
+
+def countBarcodes(filename):
+  with open(filename, 'r') as infile:
+    return len(set(line.split()[0] for line in infile if line.strip()))
+
+
+def benchScoring(mutationsFile, url, workers, rate, batch=1):
+  workdir = makeWorkdir()
+  start = time.perf_counter()
+  subprocess.run([sys.executable, os.path.join(HERE, 'ScoreMutations.py'), '-file', os.path.abspath(mutationsFile),
+                  '-url', url, '-workers', str(workers), '-rate', str(rate), '-burst', str(workers),
+                  '-batch', str(batch), '-no-cache'],
+                 cwd=workdir, check=True, stderr=subprocess.DEVNULL)
+  elapsed = time.perf_counter() - start
+  shutil.rmtree(workdir)
+  return elapsed
+
+
+# replicate the barcode groups of a called mutations file until it has at least
+# the requested number of rows, keeping every barcode contiguous
+def makeSyntheticFile(source, rows, filename):
+  groups = {}
+  with open(source, 'r') as infile:
+    for line in infile:
+      if line.strip():
+        groups.setdefault(line.split()[0], []).append(line)
+  written = 0
+  copy = 0
+  with open(filename, 'w') as outfile:
+    while written < rows:
+      for barcode in groups:
+        for line in groups[barcode]:
+          outfile.write(barcode + '-' + str(copy) + line[len(barcode):])
+        written += len(groups[barcode])
+      copy += 1
+  return written
+
+
+# run a command to completion, returning the elapsed time and the peak RSS of the
+# process in MB (worker processes it starts are not included)
+def runMeasured(command, cwd):
+  start = time.perf_counter()
+  process = subprocess.Popen(command, cwd=cwd, stderr=subprocess.DEVNULL)
+  pid, status, usage = os.wait4(process.pid, 0)
+  elapsed = time.perf_counter() - start
+  if status != 0:
+    raise RuntimeError(" ".join(command) + " failed")
+  return elapsed, usage.ru_maxrss / 1024.0
+
+
+# parse and score a large file with the local backend, returning the elapsed time
+# and the peak RSS of the scoring process in MB
+def benchParsing(mutationsFile, stream):
+  workdir = makeWorkdir()
+  command = [sys.executable, os.path.join(HERE, 'ScoreMutations.py'), '-file', os.path.abspath(mutationsFile), '-backend', 'local']
+  if stream:
+    command.append('-stream')
+  try:
+    return runMeasured(command, workdir)
+  finally:
+    shutil.rmtree(workdir)
+
+
+# (annotation key, amino acid) pairs a synthetic barcode can carry, the substitutions
+# of the annotation table that the scoring input format can express
+def syntheticMutations():
+  choices = []
+  for entry in AnnotationIndex.parse(os.path.join(HERE, 'HIV_DR_ANNO_REVISED.txt')).entries:
+    if re.match(r'^[A-Z]?\d+[A-Za-z]+$', entry.key):
+      choices.extend((entry.key, alternate) for alternate in entry.alternates if alternate != 'd')
+  return choices
+
+
+# a called mutations file for a plate of synthetic barcodes, each with 1 to 12
+# distinct resistance mutations, rows of a barcode kept contiguous
+def makePlateFile(barcodes, filename, seed=1):
+  rng = random.Random(seed)
+  choices = syntheticMutations()
+  rows = 0
+  with open(filename, 'w') as outfile:
+    for i in range(barcodes):
+      code = "".join("ACGT"[(i >> (2 * digit)) & 3] for digit in range(16))
+      barcode = code[:8] + '+' + code[8:]
+      keys = set()
+      for key, alternate in rng.sample(choices, rng.randint(1, 12)):
+        if key in keys:
+          continue
+        keys.add(key)
+        codon = "".join(rng.choice("ACGT") for j in range(3))
+        outfile.write("%s\t%s\t%s\t[%d, '%s:MUT/RESISTANT']\t%.2f\tMUT/RESISTANT\n" %
+                      (barcode, key, codon, rng.randint(20, 5000), alternate, rng.uniform(1, 100)))
+        rows += 1
+  return rows
+
+
+# score called_mutations.txt plus a synthetic plate once unsharded and once as shards
+# run side by side, returning both wall times. tests/test_shards.py checks the merged outputs
+def benchShards(mutationsFile, count, barcodes=400):
+  workdir = makeWorkdir()
+  plateFile = os.path.join(workdir, 'plate.txt')
+  makePlateFile(barcodes, plateFile)
+  command = [sys.executable, os.path.join(HERE, 'ScoreMutations.py'), '-file', os.path.abspath(mutationsFile), plateFile,
+             '-backend', 'local']
+  start = time.perf_counter()
+  subprocess.run(command + ['-output', 'single'], cwd=workdir, stderr=subprocess.DEVNULL, check=True)
+  single = time.perf_counter() - start
+  start = time.perf_counter()
+  shards = [subprocess.Popen(command + ['-output', 'sharded', '-stream', '-shard', '%d/%d' % (index, count)], cwd=workdir,
+                             stderr=subprocess.DEVNULL) for index in range(count)]
+  for process in shards:
+    if process.wait() != 0:
+      raise RuntimeError("a shard failed")
+  sharded = time.perf_counter() - start
+  shutil.rmtree(workdir)
+  return single, sharded
+
+
+# score a synthetic plate once, import its results copies times so the store holds
+# barcodes * copies samples, then time each kind of lookup against the budget
+def benchStore(barcodes, copies, budget=1.0):
+  from ResultsStore import ResultsStore, importPaths
+  workdir = makeWorkdir()
+  plateFile = os.path.join(workdir, 'plate.txt')
+  makePlateFile(barcodes, plateFile)
+  subprocess.run([sys.executable, os.path.join(HERE, 'ScoreMutations.py'), '-file', plateFile, '-backend', 'local',
+                  '-no-text', '-output', 'output'], cwd=workdir, stderr=subprocess.DEVNULL, check=True)
+  store = ResultsStore(os.path.join(workdir, 'store.sqlite'))
+  start = time.perf_counter()
+  for copy in range(copies):
+    importPaths(store, [os.path.join(workdir, 'output')], 'plate %d' % copy)
+  sys.stdout.write("imported %d results in %.1fs\n" % (barcodes * copies, time.perf_counter() - start))
+
+  with open(os.path.join(workdir, 'output', 'results.jsonl'), 'r') as infile:
+    barcode = json.loads(infile.readline())['barcode']
+  lookups = (("history of one barcode", lambda: store.history(barcode)),
+             ("K103N at >= 20%", lambda: store.withMutation('K103N', 20.0)),
+             ("RT:M184V", lambda: store.withMutation('RT:M184V')),
+             ("EFV high-level resistance", lambda: store.atLevel('EFV', 5)))
+  problems = []
+  for name, lookup in lookups:
+    timings = []
+    for run in range(5):
+      start = time.perf_counter()
+      rows = lookup()
+      timings.append(time.perf_counter() - start)
+    elapsed = sorted(timings)[len(timings) // 2]
+    sys.stdout.write("%-26s %8d rows %8.1f ms\n" % (name, len(rows), elapsed * 1000))
+    if elapsed > budget:
+      problems.append("%s took %.2fs" % (name, elapsed))
+  store.close()
+  shutil.rmtree(workdir)
+  return problems
+
+
+# score a synthetic plate once writing a text view file per barcode and once into a
+# run archive and compare the wall times. tests/test_archive.py checks the entries
+def benchArchive(barcodes):
+  workdir = makeWorkdir()
+  plateFile = os.path.join(workdir, 'plate.txt')
+  makePlateFile(barcodes, plateFile)
+  command = [sys.executable, os.path.join(HERE, 'ScoreMutations.py'), '-file', plateFile, '-backend', 'local']
+  timings = {}
+  for name, extra in (('loose', []), ('archive', ['-archive', 'run.zip'])):
+    start = time.perf_counter()
+    subprocess.run(command + ['-output', name] + extra, cwd=workdir, stderr=subprocess.DEVNULL, check=True)
+    timings[name] = time.perf_counter() - start
+  shutil.rmtree(workdir)
+  return timings
+
+
+def readTimings(filename):
+  with open(filename, 'r') as infile:
+    return json.load(infile)['stages']
+
+
+# parse, score, render and measure one plate, in a working directory holding the plate
+def benchPlate(barcodes, latency, workers, batch, renderLimit):
+  workdir = makeWorkdir()
+  for filename in ('CFAR-logo.jpg', 'jcrc_logo-1.jpg'):
+    os.symlink(os.path.join(HERE, filename), os.path.join(workdir, filename))
+  plateFile = os.path.join(workdir, 'plate.txt')
+  rows = makePlateFile(barcodes, plateFile)
+  scoreCommand = [sys.executable, os.path.join(HERE, 'ScoreMutations.py'), '-file', plateFile, '-stream']
+  metrics = {'barcodes': barcodes, 'rows': rows}
+
+  # the offline engine also writes the _scores.txt profiles rendered below
+  elapsed, peakRss = runMeasured(scoreCommand + ['-backend', 'local', '-timings', 'local.json'], workdir)
+  stages = readTimings(os.path.join(workdir, 'local.json'))
+  metrics['local'] = {'wall': elapsed, 'barcodesPerSecond': barcodes / elapsed, 'peakRssMB': peakRss}
+  for stage in ('parse', 'score', 'unpack', 'write'):
+    metrics['local'][stage] = stages[stage]['wall']
+
+  server, url = startStubServer(latency)
+  elapsed, peakRss = runMeasured(scoreCommand + ['-url', url, '-workers', str(workers), '-rate', '100000', '-burst',
+                                                 str(workers), '-batch', str(batch), '-no-cache', '-no-text',
+                                                 '-output', 'remote'], workdir)
+  server.shutdown()
+  metrics['remote'] = {'wall': elapsed, 'barcodesPerSecond': barcodes / elapsed, 'peakRssMB': peakRss}
+
+  profiles = sorted(glob.glob(os.path.join(workdir, 'output', '*_scores.txt')))[:renderLimit]
+  elapsed, peakRss = runMeasured([sys.executable, os.path.join(HERE, 'looper.py')] + profiles +
+                                 ['-workers', '1', '-manifest', 'render.jsonl', '-timings', 'render.json'], workdir)
+  stages = readTimings(os.path.join(workdir, 'render.json'))
+  metrics['render'] = {'profiles': len(profiles), 'wall': elapsed, 'profilesPerSecond': len(profiles) / elapsed,
+                       'peakRssMB': peakRss}
+  for stage in ('render load', 'render pdf', 'render xlsx'):
+    metrics['render'][stage.split()[1]] = stages[stage]['wall']
+  shutil.rmtree(workdir)
+  return metrics
+
+
+# start ReportService on a free port, returning the process and its base url
+def startService(workdir, limit, queue):
+  process = subprocess.Popen([sys.executable, os.path.join(HERE, 'ReportService.py'), '-backend', 'local', '-port', '0',
+                              '-limit', str(limit), '-queue', str(queue)], cwd=workdir, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+  for line in process.stderr:
+    match = re.search(r'listening on (\S+)', line)
+    if match is not None:
+      # keep draining the log so the service never blocks on a full pipe
+      threading.Thread(target=process.stderr.read, daemon=True).start()
+      return process, match.group(1)
+  raise RuntimeError("ReportService did not start")
+
+
+# one barcode scored and rendered by fresh ScoreMutations and looper runs, against
+# the same barcode posted to a warm ReportService. tests/test_report_service.py checks
+# the responses and the backpressure
+def benchService(mutationsFile, requestCount, limit, queue):
+  import requests
+  workdir = makeWorkdir()
+  for filename in ('CFAR-logo.jpg', 'jcrc_logo-1.jpg'):
+    os.symlink(os.path.join(HERE, filename), os.path.join(workdir, filename))
+  with open(mutationsFile, 'r') as infile:
+    rows = [line for line in infile if line.strip()]
+  barcode = rows[0].split()[0]
+  single = "".join(line for line in rows if line.split()[0] == barcode)
+  singleFile = os.path.join(workdir, 'single.txt')
+  with open(singleFile, 'w') as outfile:
+    outfile.write(single)
+
+  metrics = {}
+  cold = []
+  for i in range(3):
+    scoreTime, peakRss = runMeasured([sys.executable, os.path.join(HERE, 'ScoreMutations.py'), '-file', singleFile,
+                                      '-backend', 'local'], workdir)
+    renderTime, peakRss = runMeasured([sys.executable, os.path.join(HERE, 'looper.py'),
+                                       os.path.join('output', 'results.jsonl'), '-workers', '1', '-force'], workdir)
+    cold.append(scoreTime + renderTime)
+  metrics['cold'] = sorted(cold)[1]
+
+  process, url = startService(workdir, limit, queue)
+  try:
+    session = requests.Session()
+    warm = []
+    for i in range(requestCount):
+      start = time.perf_counter()
+      response = session.post(url + '/score', data=single)
+      warm.append(time.perf_counter() - start)
+      if response.status_code != 200 or 'pdf' not in response.json()['results'][0]:
+        raise RuntimeError("service answered " + str(response.status_code))
+    warm.sort()
+    metrics['warm p50'] = warm[len(warm) // 2]
+    metrics['warm max'] = warm[-1]
+  finally:
+    process.terminate()
+    process.wait()
+    shutil.rmtree(workdir)
+  return metrics
+
+
+# import time budget in ms of each entry point, measured with -X importtime once the
+# bytecode is compiled. Heavy dependencies are imported by the code paths using them
+startupBudgets = collections.OrderedDict([('ScoreMutations', 50), ('ReportGenerator', 30), ('looper', 60),
+                                          ('pipeline', 75), ('ReportService', 100)])
+
+# median cumulative import time of a module in ms over several fresh interpreters,
+# and its direct imports as [(ms, name)] heaviest first
+def importTime(module, runs=5):
+  totals = []
+  children = []
+  for i in range(runs + 1):
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=HERE,
+                            stderr=subprocess.PIPE, universal_newlines=True).stderr
+    direct = []
+    for line in output.splitlines():
+      match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+      if match is None:
+        continue
+      depth = len(match.group(3)) // 2
+      if depth == 0 and match.group(4) != module:
+        direct = []
+      elif depth == 1:
+        direct.append((int(match.group(2)) / 1000.0, match.group(4)))
+      elif depth == 0:
+        # the first run compiles the bytecode and is not counted
+        if i > 0:
+          totals.append(int(match.group(2)) / 1000.0)
+          children = sorted(direct, reverse=True)
+  totals.sort()
+  return totals[len(totals) // 2], children
+
+
+# median wall time in ms of a command run in a fresh interpreter
+def commandTime(command, runs=5):
+  times = []
+  for i in range(runs):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    times.append((time.perf_counter() - start) * 1000)
+  times.sort()
+  return times[len(times) // 2]
+
+
+def benchStartup():
+  overBudget = []
+  baseline = commandTime([sys.executable, '-c', 'pass'])
+  sys.stdout.write("interpreter start %.1f ms\n" % baseline)
+  for module, budget in startupBudgets.items():
+    total, children = importTime(module)
+    sys.stdout.write("%-16s %6.1f ms (budget %d ms)  %s\n" % (module, total, budget,
+                     ", ".join("%s %.1f" % (name, ms) for ms, name in children[:3])))
+    if total > budget:
+      overBudget.append("%s imports in %.1f ms, over its %d ms budget" % (module, total, budget))
+  sys.stdout.write("ScoreMutations.py -h %.1f ms\n" % commandTime([sys.executable, 'ScoreMutations.py', '-h']))
+  return overBudget
+
+
+def gitVersion():
+  try:
+    version = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=HERE, stderr=subprocess.DEVNULL)
+    return version.decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+
+def readStoredResults(filename):
+  if not os.path.exists(filename):
+    return []
+  with open(filename, 'r') as infile:
+    return [json.loads(line) for line in infile if line.strip()]
+
+
+# compare throughput and memory of every plate size with a stored run,
+# returns the metrics that got worse by more than the threshold
+def findRegressions(run, baseline, threshold):
+  regressions = []
+  for size, metrics in run['plates'].items():
+    for section, values in metrics.items():
+      if not isinstance(values, dict) or section not in baseline['plates'].get(size, {}):
+        continue
+      for name, value in values.items():
+        previous = baseline['plates'][size][section].get(name)
+        if previous is None or previous <= 0:
+          continue
+        if name.endswith('PerSecond'):
+          change = previous / value - 1 if value > 0 else float('inf')
+        elif name == 'peakRssMB':
+          change = value / previous - 1
+        else:
+          continue
+        if change > threshold:
+          regressions.append("%s barcodes %s %s: %.4g -> %.4g (%+.0f%%)" % (size, section, name, previous, value, change * 100))
+  return regressions
+
+
+def benchPlates(sizes, latency, workers, batch, renderLimit, resultsFile, label, compare, threshold):
+  run = {'version': label or gitVersion(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+         'plates': {}}
+  sys.stdout.write("%9s %8s  %10s %8s %8s  %10s %8s  %8s %8s %8s\n" % ("barcodes", "rows", "local bc/s", "parse s",
+                   "RSS MB", "remote bc/s", "RSS MB", "render/s", "pdf s", "xlsx s"))
+  for size in sizes:
+    metrics = benchPlate(size, latency, workers, batch, renderLimit)
+    run['plates'][str(size)] = metrics
+    sys.stdout.write("%9d %8d  %10.0f %8.2f %8.1f  %10.0f %8.1f  %8.1f %8.2f %8.2f\n" % (size, metrics['rows'],
+                     metrics['local']['barcodesPerSecond'], metrics['local']['parse'], metrics['local']['peakRssMB'],
+                     metrics['remote']['barcodesPerSecond'], metrics['remote']['peakRssMB'],
+                     metrics['render']['profilesPerSecond'], metrics['render']['pdf'], metrics['render']['xlsx']))
+
+  stored = readStoredResults(resultsFile)
+  with open(resultsFile, 'a') as outfile:
+    outfile.write(json.dumps(run) + "\n")
+  sys.stdout.write("results appended to " + resultsFile + " as " + run['version'] + "\n")
+  if compare is None:
+    return []
+  baselines = [previous for previous in stored if compare == 'last' or previous['version'] == compare]
+  if len(baselines) == 0:
+    sys.stdout.write("no stored run " + compare + " to compare with\n")
+    return []
+  sys.stdout.write("compared with " + baselines[-1]['version'] + " from " + baselines[-1]['date'] + "\n")
+  return findRegressions(run, baselines[-1], threshold)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-suite", help="Benchmark to run, plate measures synthetic plates end to end, service compares "
+                      "fresh CLI runs with a warm ReportService, startup checks import times against their budgets, shards "
+                      "times a sharded run against an unsharded one, store times results store lookups, archive times a "
+                      "run archive against a file per barcode. Correctness checks are in tests/",
+                      choices=["scoring", "parsing", "plate", "service", "startup", "shards", "store", "archive"],
+                      default="scoring")
+  parser.add_argument("-rows", help="Rows in the synthetic file used by the parsing benchmark", type=int, default=200000)
+  parser.add_argument("-file", help="Called mutations file to score", type=str,
+                      default=os.path.join(HERE, 'called_mutations.txt'))
+  parser.add_argument("-latency", help="Simulated server latency in seconds", type=float, default=0.05)
+  parser.add_argument("-rate", help="Rate limit passed to the scorer (requests per second)", type=float, default=1000)
+  parser.add_argument("-workers", help="Comma separated worker counts to compare", type=str, default="1,4,16")
+  parser.add_argument("-batch", help="Comma separated batch sizes to compare", type=str, default="1")
+  parser.add_argument("-sizes", help="Comma separated plate sizes in barcodes", type=str, default="10,1000,100000")
+  parser.add_argument("-store-size", help="Plate size and import count of the store benchmark", type=str,
+                      default="20000,10")
+  parser.add_argument("-render-limit", help="Profiles rendered per plate", type=int, default=200)
+  parser.add_argument("-results", help="JSON Lines file the plate results are appended to", type=str,
+                      default=os.path.join(HERE, 'benchmark_results.jsonl'))
+  parser.add_argument("-label", help="Version label stored with the plate results, defaults to git describe", type=str)
+  parser.add_argument("-compare", help="Compare the plate results with the stored run of this version, or 'last'", type=str)
+  parser.add_argument("-threshold", help="Relative slowdown reported as a regression", type=float, default=0.2)
+  args = parser.parse_args()
+
+  if args.suite == "plate":
+    regressions = benchPlates([int(size) for size in args.sizes.split(',')], args.latency,
+                              max(int(w) for w in args.workers.split(',')), max(int(b) for b in args.batch.split(',')),
+                              args.render_limit, args.results, args.label, args.compare, args.threshold)
+    for regression in regressions:
+      sys.stdout.write("REGRESSION " + regression + "\n")
+    sys.exit(1 if len(regressions) > 0 else 0)
+
+  if args.suite == "parsing":
+    syntheticFile = tempfile.mkstemp(prefix='hivdr_bench_', suffix='.txt')[1]
+    rows = makeSyntheticFile(args.file, args.rows, syntheticFile)
+    sys.stdout.write("parsing and locally scoring " + str(rows) + " rows\n")
+    for stream in (False, True):
+      elapsed, peakRss = benchParsing(syntheticFile, stream)
+      sys.stdout.write("%-8s  %7.2fs  %10.0f rows/s  peak RSS %7.1f MB\n" %
+                       ("stream" if stream else "read all", elapsed, rows / elapsed, peakRss))
+    os.remove(syntheticFile)
+    sys.exit(0)
+
+  if args.suite == "shards":
+    single, sharded = benchShards(args.file, 3)
+    sys.stdout.write("unsharded %.2fs, 3 shards side by side %.2fs\n" % (single, sharded))
+    sys.exit(0)
+
+  if args.suite == "store":
+    barcodes, copies = [int(value) for value in args.store_size.split(',')]
+    problems = benchStore(barcodes, copies)
+    for problem in problems:
+      sys.stdout.write("OVER BUDGET " + problem + "\n")
+    sys.exit(1 if len(problems) > 0 else 0)
+
+  if args.suite == "archive":
+    timings = benchArchive(20000)
+    sys.stdout.write("20000 barcodes: a file per barcode %.2fs, run archive %.2fs\n" % (timings['loose'], timings['archive']))
+    sys.exit(0)
+
+  if args.suite == "startup":
+    problems = benchStartup()
+    for problem in problems:
+      sys.stdout.write("OVER BUDGET " + problem + "\n")
+    sys.exit(1 if len(problems) > 0 else 0)
+
+  if args.suite == "service":
+    metrics = benchService(args.file, 20, 2, 4)
+    sys.stdout.write("one barcode, fresh CLI runs   %8.1f ms\n" % (metrics['cold'] * 1000))
+    sys.stdout.write("one barcode, warm service p50 %8.1f ms (max %.1f ms)\n" % (metrics['warm p50'] * 1000,
+                     metrics['warm max'] * 1000))
+    sys.exit(0)
+
+  server, url = startStubServer(args.latency)
+  barcodes = countBarcodes(args.file)
+  sys.stdout.write("scoring " + str(barcodes) + " barcodes, server latency " + str(args.latency) + "s\n")
+  for batch in [int(b) for b in args.batch.split(',')]:
+    for workers in [int(w) for w in args.workers.split(',')]:
+      elapsed = benchScoring(args.file, url, workers, args.rate, batch)
+      sys.stdout.write("workers %3d  batch %3d  %7.2fs  %8.1f barcodes/s\n" % (workers, batch, elapsed, barcodes / elapsed))
+  server.shutdown()
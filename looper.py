@@ -1,10 +1,246 @@
 #!/usr/bin/python
 
+## Render PDF and Excel reports for every scored profile across a process pool
+
+import argparse
 import glob
-from ReportGenerator import ReportGenerator
+import json
+import os
+import re
+import sys
+import time
+import traceback
+from ReportGenerator import (ReportGenerator, generateCombinedPDFReport, generateExcelWorkbook, sheetsPerWorkbook, readResults,
+                             readArchive)
+from RunManifest import RunManifest
+from RunTimer import TimingList, timer, addInstrumentationArguments, startInstrumentation
+
+
+# a profile is either a _scores.txt file, a result record from a JSON Lines results file
+# or the (entry name, text) of a _scores.txt entry of a run archive
+def loadProfile(profile, title):
+  if isinstance(profile, dict):
+    reporter = ReportGenerator(title, None)
+    reporter.loadRecord(profile)
+  elif isinstance(profile, tuple):
+    reporter = ReportGenerator(title, profile[0])
+    reporter.parseText(profile[1])
+  else:
+    reporter = ReportGenerator(title, profile)
+    reporter.parseFile(reporter.profileFile)
+  if title is None:
+    reporter.reportTitle = reporter.barcode
+  return reporter
+
+def profileName(profile):
+  if isinstance(profile, dict):
+    return profile['barcode']
+  if isinstance(profile, tuple):
+    return profile[0]
+  return profile
+
+# profile content as hashed by the render manifest, and its barcode
+def profileContent(profile):
+  if isinstance(profile, dict):
+    return json.dumps(profile, sort_keys=True), profile['barcode']
+  if isinstance(profile, tuple):
+    content = profile[1]
+  else:
+    with open(profile, 'r') as infile:
+      content = infile.read()
+  match = re.search(r'^barcode:\s+(\S+)', content, re.MULTILINE)
+  return content, None if match is None else match.group(1)
+
+def reportFiles(barcode, formats, pdfDir, excelDir):
+  files = []
+  if 'pdf' in formats:
+    files.append(os.path.join(pdfDir, barcode + ".pdf"))
+  if 'xlsx' in formats:
+    files.append(os.path.join(excelDir, barcode + ".xlsx"))
+  return files
+
+# run archive entries of the rendered reports, the rest of an existing archive is kept
+def reportEntries(pdfDir, excelDir):
+  return (os.path.join(pdfDir, '*'), os.path.join(excelDir, '*'))
+
+# the rendered reports of a barcode read back as one byte string, None if any is missing.
+# With a run archive they are read from the archive the previous run wrote
+def reportData(barcode, formats, pdfDir, excelDir, archive=None):
+  data = []
+  for filename in reportFiles(barcode, formats, pdfDir, excelDir):
+    if archive is not None:
+      data.append(archive.previousEntry(filename))
+      if data[-1] is None:
+        return None
+      continue
+    if not os.path.exists(filename):
+      return None
+    with open(filename, 'rb') as infile:
+      data.append(infile.read())
+  return b"".join(data)
+
+# render the requested formats for one profile, returns (profile name, barcode, error,
+# [(stage, wall, cpu)] timings, [(report file, data)]). Reports are written to their
+# files, or returned as data for the run archive when archived
+def renderProfile(profile, title, formats, pdfDir, excelDir, archived=False):
+  timings = TimingList()
+  reports = []
+  try:
+    with timings.stage('render load'):
+      reporter = loadProfile(profile, title)
+    for filename in reportFiles(reporter.barcode, formats, pdfDir, excelDir):
+      if filename.endswith(".pdf"):
+        with timings.stage('render pdf'):
+          if archived:
+            reports.append((filename, reporter.pdfData()))
+          else:
+            reporter.generatePDFReport(filename)
+      else:
+        with timings.stage('render xlsx'):
+          if archived:
+            reports.append((filename, reporter.excelData()))
+          else:
+            reporter.generateExcelReport(filename)
+    return (profileName(profile), reporter.barcode, None, timings, reports)
+  except Exception:
+    return (profileName(profile), None, traceback.format_exc(), timings, reports)
+
+def addRenderTimings(barcode, timings):
+  for name, wall, cpu in timings:
+    timer.add(name, wall, cpu, 1, [barcode])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("profiles", help="Scored profile files, .jsonl results files or .zip run archives, defaults to "
+                      "output/results.jsonl or output/*.txt", nargs='*')
+  parser.add_argument("-workers", help="Number of report rendering processes", type=int, default=os.cpu_count())
+  parser.add_argument("-formats", help="Comma separated report formats", type=str, default="pdf,xlsx")
+  parser.add_argument("-title", help="Report title, defaults to the barcode of each profile", type=str)
+  parser.add_argument("-pdfs", help="Directory for PDF reports", type=str, default="pdfs")
+  parser.add_argument("-xlsx", help="Directory for Excel reports", type=str, default="xlsx")
+  parser.add_argument("-archive", help="Zip archive receiving the reports as pdfs/<barcode>.pdf and xlsx/<barcode>.xlsx "
+                      "entries instead of a file each", type=str)
+  parser.add_argument("-compress", help="Deflate the entries of -archive", action="store_true")
+  parser.add_argument("-combined", help="Write one multi-sample PDF with a page per barcode instead of a PDF per sample", type=str)
+  parser.add_argument("-workbook", help="Write one multi-sample Excel workbook instead of a workbook per sample, split "
+                      "into <name>-2.xlsx, <name>-3.xlsx, ... beyond -sheets samples", type=str)
+  parser.add_argument("-sheets", help="Sample worksheets per -workbook file, each keeps a file open while it is written",
+                      type=int, default=sheetsPerWorkbook)
+  parser.add_argument("-manifest", help="Render manifest used to skip profiles whose reports are up to date", type=str,
+                      default="reports_manifest.jsonl")
+  parser.add_argument("-force", help="Render every profile even if its reports are up to date", action="store_true")
+  parser.add_argument("-store", help="Results store the rendered profiles are added to as one run, see ResultsStore.py",
+                      type=str)
+  parser.add_argument("-run-name", help="Name of the run in the results store, defaults to the first input", type=str)
+  addInstrumentationArguments(parser)
+  args = parser.parse_args()
+
+  instrumentation = startInstrumentation(args)
+  inputs = args.profiles
+  if len(inputs) == 0 and os.path.exists('output/results.jsonl'):
+    inputs = ['output/results.jsonl']
+  elif len(inputs) == 0:
+    inputs = sorted(glob.glob('output/*.txt'))
+  # results files are expanded into their records, text profiles are parsed by the workers
+  profiles = []
+  for input in inputs:
+    if input.endswith('.jsonl'):
+      profiles.extend(readResults(input))
+    elif input.endswith('.zip'):
+      profiles.extend(readArchive(input))
+    else:
+      profiles.append(input)
+  formats = args.formats.split(',')
+  reporters = []
+  if (args.combined is not None and 'pdf' in formats) or (args.workbook is not None and 'xlsx' in formats):
+    reporters = [loadProfile(profile, args.title) for profile in profiles]
+  if args.combined is not None and 'pdf' in formats:
+    formats.remove('pdf')
+    generateCombinedPDFReport(reporters, args.combined)
+    sys.stderr.write(str(len(profiles)) + " profiles written to " + args.combined + "\n")
+  if args.workbook is not None and 'xlsx' in formats:
+    formats.remove('xlsx')
+    try:
+      workbooks = generateExcelWorkbook(reporters, args.workbook, args.sheets)
+    except ValueError as error:
+      sys.stderr.write(str(error) + "\n")
+      sys.exit(1)
+    sys.stderr.write(str(len(profiles)) + " profiles written to " + ", ".join(workbooks) + "\n")
+  archive = None
+  if args.archive is not None and len(formats) > 0:
+    from RunArchive import RunArchive
+    archive = RunArchive(args.archive, args.compress, reportEntries(args.pdfs, args.xlsx))
+  for directory, format in ((args.pdfs, 'pdf'), (args.xlsx, 'xlsx')):
+    if format in formats and archive is None:
+      os.makedirs(directory, exist_ok=True)
+
+  # profiles still needing per-sample reports once combined outputs are written
+  if len(formats) == 0:
+    profiles = []
+
+  # only profiles whose content changed or whose reports are missing or modified are rendered again
+  manifest = RunManifest(args.manifest, [args.title, sorted(formats)], not args.force)
+  inputHashes = {}
+  pending = []
+  for profile in profiles:
+    content, barcode = profileContent(profile)
+    inputHash = manifest.inputHash(content)
+    if barcode is not None and manifest.current(profileName(profile), inputHash,
+                                                reportData(barcode, formats, args.pdfs, args.xlsx, archive)):
+      # reports of the previous archive are carried into the new one
+      if archive is not None:
+        for filename in reportFiles(barcode, formats, args.pdfs, args.xlsx):
+          archive.carry(filename)
+      continue
+    inputHashes[profileName(profile)] = inputHash
+    pending.append(profile)
+  if len(profiles) > len(pending):
+    sys.stderr.write(str(len(profiles) - len(pending)) + " profiles unchanged since the last run, not rendered\n")
+  profiles = pending
+
+  store = None
+  if args.store is not None and len(profiles) > 0:
+    from ResultsStore import ResultsStore, anyProfileRecord
+    store = ResultsStore(args.store)
+    run = store.addRun(args.run_name or inputs[0], os.path.abspath(inputs[0]))
+    stored = []
+
+  from concurrent.futures import ProcessPoolExecutor, as_completed
+  failures = []
+  start = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+    futures = {executor.submit(renderProfile, profile, args.title, formats, args.pdfs, args.xlsx, archive is not None):
+               profile for profile in profiles}
+    for count, future in enumerate(as_completed(futures), 1):
+      name, barcode, error, timings, reports = future.result()
+      addRenderTimings(barcode or name, timings)
+      if error is None:
+        if store is not None:
+          stored.append(anyProfileRecord(futures[future]))
+        if archive is not None:
+          for filename, data in reports:
+            archive.add(filename, data)
+          output = b"".join(data for filename, data in reports)
+        else:
+          output = reportData(barcode, formats, args.pdfs, args.xlsx)
+        manifest.record(name, 'rendered', inputHashes[name], manifest.outputHash(output))
+        sys.stderr.write("[" + str(count) + "/" + str(len(profiles)) + "] " + barcode + " rendered\n")
+      else:
+        manifest.record(name, 'error', inputHashes[name], None)
+        failures.append((name, error))
+        sys.stderr.write("[" + str(count) + "/" + str(len(profiles)) + "] " + name + " failed\n")
+  manifest.close()
+  if archive is not None:
+    archive.close()
+    sys.stderr.write(str(archive.count) + " reports written to " + args.archive + "\n")
+  if store is not None:
+    store.addRecords(run, stored)
+    store.close()
+  instrumentation.finish()
 
-files = glob.glob('output/*.txt')
-for file in files:
-  reporter = ReportGenerator('SAMPLE1', file)
-  reporter.parseFile(reporter.profileFile)
-  reporter.generateReport()
+  sys.stderr.write(str(len(profiles) - len(failures)) + " of " + str(len(profiles)) + " profiles rendered in " +
+                   "%.1fs" % (time.perf_counter() - start) + "\n")
+  for name, error in failures:
+    sys.stderr.write("\n" + name + ":\n" + error)
+  sys.exit(1 if len(failures) > 0 else 0)
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+## End to end pipeline: parse -> score -> unpack -> render, with bounded queues between the stages
+
+import argparse
+import collections
+import os
+import queue
+import sys
+import threading
+import time
+import ScoreMutations
+from looper import renderProfile, addRenderTimings, reportEntries
+from RunTimer import addInstrumentationArguments, startInstrumentation
+
+STOP = object()
+
+
+class Pipeline():
+  """
+  Streams barcodes through scoring and report rendering so reports for the first
+  barcodes are rendered while later ones are still being scored
+  """
+  def __init__(self, scorer, writer, batchSize, scoreWorkers=1, renderWorkers=1, queueSize=8,
+               formats=('pdf', 'xlsx'), pdfDir='pdfs', excelDir='xlsx', title=None, instrumentation=None):
+    self.scorer = scorer
+    self.writer = writer
+    self.batchSize = batchSize
+    self.scoreWorkers = max(scoreWorkers, 1)
+    self.renderWorkers = max(renderWorkers, 1)
+    self.queueSize = max(queueSize, 1)
+    self.formats = formats
+    self.pdfDir = pdfDir
+    self.excelDir = excelDir
+    self.title = title
+    self.instrumentation = instrumentation
+    self.failures = []
+    self.rendered = 0
+
+  # parse stage: batches are only read ahead while fewer than queueSize batches
+  # are waiting to be scored or written
+  def parseStage(self, groups, slots, scoreQueue, writeQueue):
+    try:
+      for sequence, batch in enumerate(ScoreMutations.batched(groups, self.batchSize)):
+        slots.acquire()
+        scoreQueue.put((sequence, batch))
+    except Exception as error:
+      writeQueue.put(error)
+    finally:
+      for i in range(self.scoreWorkers):
+        scoreQueue.put(STOP)
+
+  def scoreStage(self, scoreQueue, writeQueue):
+    while True:
+      item = scoreQueue.get()
+      if item is STOP:
+        writeQueue.put(STOP)
+        return
+      sequence, batch = item
+      try:
+        writeQueue.put((sequence, batch, self.scorer.scoreBatch(batch)))
+      except Exception as error:
+        writeQueue.put(error)
+
+  def collectRender(self, future):
+    name, barcode, error, timings, reports = future.result()
+    addRenderTimings(barcode or name, timings)
+    if error is None:
+      for filename, data in reports:
+        self.writer.archive.add(filename, data)
+      self.rendered += 1
+      sys.stderr.write("barcode " + barcode + " rendered\n")
+    else:
+      self.failures.append((name, error))
+
+  def run(self, groups):
+    slots = threading.Semaphore(self.queueSize)
+    scoreQueue = queue.Queue(maxsize=self.queueSize)
+    writeQueue = queue.Queue()
+    parseStage, scoreStage = self.parseStage, self.scoreStage
+    if self.instrumentation is not None:
+      parseStage, scoreStage = self.instrumentation.profiled(parseStage), self.instrumentation.profiled(scoreStage)
+    threads = [threading.Thread(target=parseStage, args=(groups, slots, scoreQueue, writeQueue), daemon=True)]
+    for i in range(self.scoreWorkers):
+      threads.append(threading.Thread(target=scoreStage, args=(scoreQueue, writeQueue), daemon=True))
+    for thread in threads:
+      thread.start()
+
+    # with a run archive the reports are entries of it next to the text views
+    archive = self.writer.archive
+    if archive is not None:
+      archive.owned.extend(reportEntries(self.pdfDir, self.excelDir))
+
+    # write stage: scored batches are written in input order, then their records
+    # are handed to the render pool, which holds at most queueSize pending reports
+    finished = 0
+    nextSequence = 0
+    scored = {}
+    renders = collections.deque()
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+      with ProcessPoolExecutor(max_workers=self.renderWorkers) as pool:
+        while finished < self.scoreWorkers:
+          item = writeQueue.get()
+          if item is STOP:
+            finished += 1
+            continue
+          if isinstance(item, Exception):
+            raise item
+          scored[item[0]] = item[1:]
+          while nextSequence in scored:
+            batch, outputs = scored.pop(nextSequence)
+            self.writer.writeBatch(batch, outputs)
+            slots.release()
+            nextSequence += 1
+            for output, record in outputs:
+              if record['status'] == 'error':
+                self.failures.append((record['barcode'], "scoring failed, no report rendered\n"))
+                continue
+              renders.append(pool.submit(renderProfile, record, self.title, self.formats, self.pdfDir, self.excelDir,
+                                         archive is not None))
+              while len(renders) >= self.queueSize * self.renderWorkers:
+                self.collectRender(renders.popleft())
+        while len(renders) > 0:
+          self.collectRender(renders.popleft())
+    except Exception:
+      # a failed run keeps the previous run archive
+      self.writer.abort()
+      self.scorer.close()
+      raise
+    self.writer.close()
+    self.scorer.close()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  ScoreMutations.addScoringArguments(parser)
+  addInstrumentationArguments(parser)
+  parser.add_argument("-render-workers", help="Number of report rendering processes", type=int, default=os.cpu_count())
+  parser.add_argument("-queue", help="Batches buffered between stages", type=int, default=8)
+  parser.add_argument("-formats", help="Comma separated report formats", type=str, default="pdf,xlsx")
+  parser.add_argument("-title", help="Report title, defaults to the barcode of each profile", type=str)
+  parser.add_argument("-pdfs", help="Directory for PDF reports", type=str, default="pdfs")
+  parser.add_argument("-xlsx", help="Directory for Excel reports", type=str, default="xlsx")
+  args = parser.parse_args()
+  if args.file is None:
+    parser.error("-file is required")
+
+  formats = args.formats.split(',')
+  os.makedirs(args.output, exist_ok=True)
+  if args.archive is None:
+    for directory in (args.pdfs, args.xlsx):
+      os.makedirs(directory, exist_ok=True)
+
+  start = time.perf_counter()
+  instrumentation = startInstrumentation(args)
+  try:
+    variants = ScoreMutations.makeVariantFilter(args)
+    groups = ScoreMutations.readGroups(args, variants)
+    # the scorer settles the algorithm version the manifest entries are hashed with
+    scorer = ScoreMutations.makeScorer(args)
+    writer = ScoreMutations.makeWriter(args)
+    if args.resume or args.retry_failed:
+      groups = ScoreMutations.pendingGroups(groups, writer, args.retry_failed)
+    pipeline = Pipeline(scorer, writer, ScoreMutations.batchSize(args), args.workers,
+                        args.render_workers, args.queue, formats, args.pdfs, args.xlsx, args.title, instrumentation)
+    pipeline.run(groups)
+  except ValueError as error:
+    sys.stderr.write(str(error) + "\n")
+    sys.exit(1)
+  variants.report()
+  instrumentation.finish()
+
+  sys.stderr.write(str(pipeline.rendered) + " reports rendered, " + str(len(pipeline.failures)) + " failed in " +
+                   "%.1fs" % (time.perf_counter() - start) + "\n")
+  for name, error in pipeline.failures:
+    sys.stderr.write("\n" + name + ":\n" + error)
+  sys.exit(1 if len(pipeline.failures) > 0 else 0)
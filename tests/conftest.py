@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+import pytest
+
+# the modules live at the top of the repository
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+# working directory with the annotation table, the penalty table and the report logos,
+# so a test run never touches the real output/ directory
+@pytest.fixture
+def workdir(tmp_path):
+  for filename in ('HIV_DR_ANNO_REVISED.txt', 'HIVDB_PENALTY_SCORES.json', 'CFAR-logo.jpg', 'jcrc_logo-1.jpg'):
+    os.symlink(os.path.join(REPO, filename), str(tmp_path / filename))
+  return tmp_path
+
+
+# run one of the command line scripts in a directory, returns the finished process
+def runScript(script, arguments, cwd):
+  return subprocess.run([sys.executable, os.path.join(REPO, script)] + arguments, cwd=str(cwd),
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
@@ -0,0 +1,44 @@
+import pytest
+import ScoreMutations
+from benchmark import StubGraphQLHandler, startStubServer
+
+
+class VersionlessHandler(StubGraphQLHandler):
+  def do_POST(self):
+    self.rfile.read(int(self.headers['Content-Length']))
+    self.send_response(500)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+
+def remoteOptions(url, tmp_path, **overrides):
+  return ScoreMutations.scoringOptions(url=url, cache=str(tmp_path / 'cache.sqlite'), retries=0, **overrides)
+
+
+# cached responses are keyed by the version the service reports, not a fixed default
+def testCacheKeyHasServiceVersion(tmp_path):
+  server, url = startStubServer(0)
+  try:
+    scorer = ScoreMutations.makeScorer(remoteOptions(url, tmp_path))
+    assert scorer.cache.algorithmVersion == 'stub'
+    scorer.close()
+    scorer = ScoreMutations.makeScorer(remoteOptions(url, tmp_path, algorithm_version='HIVDB 9.4'))
+    assert scorer.cache.algorithmVersion == 'HIVDB 9.4'
+    scorer.close()
+  finally:
+    server.shutdown()
+
+
+def testUnknownVersionFails(tmp_path):
+  server, url = startStubServer(0, VersionlessHandler)
+  try:
+    with pytest.raises(ValueError, match="-algorithm-version"):
+      ScoreMutations.makeScorer(remoteOptions(url, tmp_path))
+  finally:
+    server.shutdown()
+
+
+def testLocalVersionIsTableVersion():
+  options = ScoreMutations.scoringOptions(backend='local')
+  ScoreMutations.makeScorer(options).close()
+  assert options.algorithm_version == 'HIVDB 9.4'
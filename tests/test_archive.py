@@ -0,0 +1,64 @@
+import os
+import zipfile
+from benchmark import makePlateFile
+from conftest import REPO, runScript
+
+mutationsFile = os.path.join(REPO, 'called_mutations.txt')
+
+
+def archiveEntries(path):
+  with zipfile.ZipFile(str(path), 'r') as archive:
+    return {name: archive.read(name) for name in archive.namelist()}
+
+
+# every archive entry matches the file written by a run without the archive
+def testArchiveMatchesFiles(workdir):
+  makePlateFile(300, str(workdir / 'plate.txt'))
+  command = ['-file', 'plate.txt', '-backend', 'local']
+  assert runScript('ScoreMutations.py', command + ['-output', 'loose'], workdir).returncode == 0
+  assert runScript('ScoreMutations.py', command + ['-output', 'archived', '-archive', 'run.zip'], workdir).returncode == 0
+
+  entries = archiveEntries(workdir / 'run.zip')
+  loose = [name for name in os.listdir(str(workdir / 'loose')) if name.endswith('_scores.txt')]
+  assert len(entries) == len(loose) + 1
+  for name, data in entries.items():
+    assert data == (workdir / 'loose' / name).read_bytes(), name
+  assert not any(name.endswith('_scores.txt') for name in os.listdir(str(workdir / 'archived')))
+
+
+def reportNames(barcodes):
+  return sorted(['pdfs/' + barcode + '.pdf' for barcode in barcodes] + ['xlsx/' + barcode + '.xlsx' for barcode in barcodes])
+
+
+# the pipeline writes the text views of ScoreMutations.py and a report per scored barcode into its archive
+def testPipelineArchive(workdir):
+  command = ['-file', mutationsFile, '-backend', 'local']
+  assert runScript('ScoreMutations.py', command + ['-output', 'scored', '-archive', 'scored.zip'], workdir).returncode == 0
+  expected = archiveEntries(workdir / 'scored.zip')
+  process = runScript('pipeline.py', command + ['-output', 'piped', '-archive', 'piped.zip', '-render-workers', '2'], workdir)
+  assert process.returncode == 0, process.stderr
+
+  entries = archiveEntries(workdir / 'piped.zip')
+  barcodes = [name[:-len('_scores.txt')] for name in expected if name.endswith('_scores.txt')]
+  assert sorted(name for name in entries if name not in expected) == reportNames(barcodes)
+  assert {name: data for name, data in entries.items() if name in expected} == expected
+  assert all(entries[name][:4] == b'%PDF' for name in entries if name.endswith('.pdf'))
+  assert not (workdir / 'pdfs').exists() and not (workdir / 'xlsx').exists()
+
+
+# scoring and rendering into the same archive keeps the entries of both
+def testScoreAndRenderIntoOneArchive(workdir):
+  scoring = ['-file', mutationsFile, '-backend', 'local', '-archive', 'run.zip']
+  assert runScript('ScoreMutations.py', scoring, workdir).returncode == 0
+  scored = archiveEntries(workdir / 'run.zip')
+  process = runScript('looper.py', ['run.zip', '-archive', 'run.zip', '-workers', '2'], workdir)
+  assert process.returncode == 0, process.stderr
+
+  entries = archiveEntries(workdir / 'run.zip')
+  barcodes = [name[:-len('_scores.txt')] for name in scored if name.endswith('_scores.txt')]
+  assert {name: data for name, data in entries.items() if name in scored} == scored
+  assert sorted(name for name in entries if name not in scored) == reportNames(barcodes)
+
+  # scoring again replaces the text views and results and keeps the reports
+  assert runScript('ScoreMutations.py', scoring, workdir).returncode == 0
+  assert sorted(archiveEntries(workdir / 'run.zip')) == sorted(entries)
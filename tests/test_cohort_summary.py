@@ -0,0 +1,19 @@
+import numpy as np
+from CohortSummary import CohortMatrix
+
+
+def cohort():
+  return CohortMatrix.build({'A+A': {'EFV': (60.0, 5)}, 'C+C': {'EFV': (10.0, 2)}}, {'A+A': {}, 'C+C': {}})
+
+
+def testAtLevel():
+  assert cohort().countAtLevel('EFV') == 1
+  assert list(cohort().barcodesAtLevel('EFV', 2)) == ['A+A', 'C+C']
+
+
+# a drug the cohort was not scored for has no barcodes at any level
+def testDrugNotInCohort():
+  assert not cohort().hasDrug('CAB')
+  assert cohort().countAtLevel('CAB') == 0
+  assert len(cohort().barcodesAtLevel('CAB', 0)) == 0
+  assert isinstance(cohort().barcodesAtLevel('CAB'), np.ndarray)
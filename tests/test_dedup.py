@@ -0,0 +1,64 @@
+import os
+from LocalScorer import LocalScorer
+from ScoreMutations import MutationScorer
+from conftest import REPO
+
+
+# the local scorer, counting the scoring calls and failing the first ones when asked
+class CountingBackend():
+  def __init__(self, failures=0):
+    self.scorer = LocalScorer(os.path.join(REPO, 'HIVDB_PENALTY_SCORES.json'))
+    self.failures = failures
+    self.calls = []
+
+  def score(self, mutationLists):
+    self.calls.append(mutationLists)
+    if len(self.calls) <= self.failures:
+      return [None for mutations in mutationLists]
+    return self.scorer.score(mutationLists)
+
+  def close(self):
+    pass
+
+
+def mutations(frequency):
+  return [['RT:K103N', frequency], ['RT:M184V', frequency]]
+
+def partialFrequencies(record):
+  return set(partial['frequency'] for gene in record['genes'] for drugScore in gene['drugScores']
+             for partial in drugScore['partialScores'])
+
+
+# two barcodes with one mutation set are scored once, each keeps its own frequencies
+def testSameMutationsScoredOnce():
+  backend = CountingBackend()
+  scorer = MutationScorer(backend)
+  (highText, highRecord), (lowText, lowRecord) = scorer.scoreBatch([('AAAAAAAA+CCCCCCCC', mutations('97.5')),
+                                                                    ('GGGGGGGG+TTTTTTTT', mutations('12.25'))])
+  assert len(backend.calls) == 1 and len(backend.calls[0]) == 1
+  assert scorer.dedupRatio() == 2.0
+
+  assert 'K103N:60.0:97.5,' in highText and ':12.25,' not in highText
+  assert 'K103N:60.0:12.25,' in lowText and ':97.5,' not in lowText
+  assert highText.replace('97.5', '12.25') == lowText
+  assert [mutation['frequency'] for mutation in highRecord['mutations']] == [97.5, 97.5]
+  assert [mutation['frequency'] for mutation in lowRecord['mutations']] == [12.25, 12.25]
+  assert partialFrequencies(highRecord) == set([97.5]) and partialFrequencies(lowRecord) == set([12.25])
+  assert highRecord['genes'] == [dict(gene, drugScores=[dict(drugScore, partialScores=[dict(partial, frequency=97.5)
+                                 for partial in drugScore['partialScores']]) for drugScore in gene['drugScores']])
+                                 for gene in lowRecord['genes']]
+
+
+# a failed set is forgotten, the next barcode with the same mutations scores it again
+def testFailedSetIsRetried():
+  backend = CountingBackend(failures=1)
+  scorer = MutationScorer(backend)
+  [(failedText, failedRecord)] = scorer.scoreBatch([('AAAAAAAA+CCCCCCCC', mutations('97.5'))])
+  assert failedText is None and failedRecord['genes'] == []
+  assert scorer.scoredSets == {}
+
+  [(text, record)] = scorer.scoreBatch([('GGGGGGGG+TTTTTTTT', mutations('12.25'))])
+  assert len(backend.calls) == 2
+  assert 'K103N:60.0:12.25,' in text and partialFrequencies(record) == set([12.25])
+  [(again, record)] = scorer.scoreBatch([('CCCCCCCC+AAAAAAAA', mutations('50'))])
+  assert len(backend.calls) == 2 and 'K103N:60.0:50,' in again
@@ -0,0 +1,75 @@
+import collections
+import json
+import os
+import threading
+import time
+import pytest
+from benchmark import StubGraphQLHandler, startStubServer
+from conftest import REPO, runScript
+
+
+class FaultyGraphQLHandler(StubGraphQLHandler):
+  """
+  Stub server injecting faults: every failEvery-th request gets the next of a 500, a 503
+  or 429 with Retry-After, a dropped connection or a response slower than the client
+  timeout. Every request fails while an outage is running
+  """
+  failEvery = 3
+  faults = ['500', '503', '429', 'drop', 'slow']
+  slowDelay = 2.0
+  outageUntil = 0.0
+  requests = 0
+  injected = collections.Counter()
+  lock = threading.Lock()
+
+  def do_POST(self):
+    with FaultyGraphQLHandler.lock:
+      FaultyGraphQLHandler.requests += 1
+      number = FaultyGraphQLHandler.requests
+      fault = None
+      if time.time() < self.outageUntil:
+        fault = '503'
+      elif number % self.failEvery == 0:
+        fault = self.faults[(number // self.failEvery) % len(self.faults)]
+      if fault is not None:
+        FaultyGraphQLHandler.injected[fault] += 1
+    if fault is None:
+      return StubGraphQLHandler.do_POST(self)
+    if fault == 'slow':
+      time.sleep(self.slowDelay)
+      try:
+        StubGraphQLHandler.do_POST(self)
+      except OSError:
+        pass  # the client timed out and closed the connection
+      return
+    self.rfile.read(int(self.headers['Content-Length']))
+    if fault == 'drop':
+      self.close_connection = True
+      return
+    self.send_response(int(fault))
+    if fault in ('503', '429'):
+      self.send_header('Retry-After', '1')
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+
+# score called_mutations.txt against the faulty stub server, once with scattered faults and
+# once through an outage long enough to trip the circuit breaker. Every barcode has to end up scored
+@pytest.mark.parametrize("outage", [0, 3], ids=["scattered faults", "outage"])
+def testFaults(workdir, outage):
+  server, url = startStubServer(0.05, FaultyGraphQLHandler)
+  FaultyGraphQLHandler.injected.clear()
+  FaultyGraphQLHandler.outageUntil = time.time() + outage
+  try:
+    process = runScript('ScoreMutations.py', ['-file', os.path.join(REPO, 'called_mutations.txt'), '-url', url, '-workers', '4',
+                                              '-rate', '1000', '-burst', '4', '-no-cache', '-timeout', '0.5', '-retries', '8',
+                                              '-backoff', '0.1', '-breaker-failures', '3', '-breaker-cooldown', '1'], workdir)
+  finally:
+    server.shutdown()
+  assert process.returncode == 0, process.stderr
+  with open(str(workdir / 'output' / 'results.jsonl'), 'r') as infile:
+    statuses = collections.Counter(json.loads(line)['status'] for line in infile)
+  assert statuses['error'] == 0 and statuses['scored'] > 0
+  assert set(FaultyGraphQLHandler.injected) == set(FaultyGraphQLHandler.faults)
+  if outage > 0:
+    assert "scoring service degraded" in process.stderr
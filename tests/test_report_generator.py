@@ -0,0 +1,42 @@
+import os
+from ReportGenerator import ReportGenerator, readResults
+from conftest import REPO, runScript
+
+
+# records and text views of the same run render the same drug scores and frequencies
+def testRecordMatchesTextView(workdir):
+  arguments = ['-file', os.path.join(REPO, 'called_mutations.txt'), '-backend', 'local', '-minority-frequency', '20']
+  assert runScript('ScoreMutations.py', arguments, workdir).returncode == 0
+  compared = 0
+  for record in readResults(str(workdir / 'output' / 'results.jsonl')):
+    if record['status'] != 'scored':
+      continue
+    fromRecord = ReportGenerator(None, None)
+    fromRecord.loadRecord(record)
+    fromText = ReportGenerator(None, None)
+    fromText.parseFile(str(workdir / 'output' / (record['barcode'] + '_scores.txt')))
+    for gene in fromRecord.profile:
+      assert [(drugScore['drug'], drugScore['text'], fromRecord.frequencies(drugScore)) for drugScore in fromRecord.profile[gene]] == \
+             [(drugScore['drug'], drugScore['text'], fromText.frequencies(drugScore)) for drugScore in fromText.profile[gene]]
+      assert fromRecord.minorityVariants(gene) == fromText.minorityVariants(gene)
+      compared += len(fromRecord.profile[gene])
+  assert compared > 500
+
+
+# the record's drug scores are rendered as they are, not rebuilt from text
+def testRecordDrugScoresAreKept():
+  drugScore = {'drugClass': 'NRTI', 'drug': 'ABC', 'score': 15.0, 'level': 3, 'SIR': 'I', 'text': 'Low-Level Resistance',
+               'partialScores': [{'mutations': ['M184V'], 'score': 15.0, 'frequency': 54.2}]}
+  reporter = ReportGenerator(None, None)
+  reporter.loadRecord({'barcode': 'A+B', 'mutations': [], 'genes': [{'gene': 'RT', 'drugScores': [drugScore]}]})
+  assert reporter.profile['reverse_transcriptase'] == [drugScore]
+  assert reporter.frequencies(drugScore) == "M184V   54.20"
+
+
+# profiles written before frequencies were recorded list mutation:score only
+def testOlderTextView():
+  reporter = ReportGenerator(None, None)
+  reporter.parseFile(os.path.join(REPO, 'one_profile.txt'))
+  evg = [drugScore for drugScore in reporter.profile['integrase'] if drugScore['drug'] == 'EVG'][0]
+  assert evg['text'] == 'Potential Low-Level Resistance' and evg['level'] == 2
+  assert reporter.frequencies(evg) == "T97A"
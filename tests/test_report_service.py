@@ -0,0 +1,76 @@
+import base64
+import collections
+import os
+import re
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from conftest import REPO
+
+with open(os.path.join(REPO, 'called_mutations.txt'), 'r') as infile:
+  plate = infile.read()
+rows = [line for line in plate.splitlines(True) if line.strip()]
+barcode = rows[0].split()[0]
+single = "".join(line for line in rows if line.split()[0] == barcode)
+
+
+# the service on a free port, scoring one request at a time with one more waiting
+@pytest.fixture
+def service(workdir):
+  maxBody = 1.5 * len(plate) / (1024 * 1024)
+  process = subprocess.Popen([sys.executable, os.path.join(REPO, 'ReportService.py'), '-backend', 'local', '-port', '0',
+                              '-limit', '1', '-queue', '1', '-max-body', str(maxBody)], cwd=str(workdir),
+                             stderr=subprocess.PIPE, universal_newlines=True)
+  try:
+    for line in process.stderr:
+      match = re.search(r'listening on (\S+)', line)
+      if match is not None:
+        # keep draining the log so the service never blocks on a full pipe
+        threading.Thread(target=process.stderr.read, daemon=True).start()
+        yield match.group(1)
+        break
+    else:
+      pytest.fail("ReportService did not start")
+  finally:
+    process.terminate()
+    process.wait()
+
+
+def testScoresAndRenders(service):
+  response = requests.post(service + '/score', data=single)
+  assert response.status_code == 200
+  result, = response.json()['results']
+  assert result['barcode'] == barcode and result['status'] == 'scored'
+  assert result['record']['barcode'] == barcode
+  assert base64.b64decode(result['pdf'])[:4] == b'%PDF'
+  assert base64.b64decode(result['xlsx'])[:2] == b'PK'
+
+  response = requests.post(service + '/score?formats=xlsx', data=single)
+  assert 'pdf' not in response.json()['results'][0] and 'xlsx' in response.json()['results'][0]
+
+
+def testMalformedBody(service):
+  response = requests.post(service + '/score', data="not called mutations\n")
+  assert response.status_code == 400
+  assert 'error' in response.json()
+
+
+def testOversizedBody(service):
+  response = requests.post(service + '/score', data=plate * 2)
+  assert response.status_code == 413
+
+
+# beyond limit + queue concurrent requests are turned away with Retry-After
+def testBackpressure(service):
+  def post(i):
+    response = requests.post(service + '/score', data=plate)
+    return response.status_code, response.headers.get('Retry-After')
+  with ThreadPoolExecutor(max_workers=8) as executor:
+    answers = list(executor.map(post, range(8)))
+  statuses = collections.Counter(status for status, retryAfter in answers)
+  assert set(statuses) == set([200, 503])
+  assert statuses[200] >= 2
+  assert all(retryAfter == '1' for status, retryAfter in answers if status == 503)
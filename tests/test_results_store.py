@@ -0,0 +1,99 @@
+import json
+import os
+import zipfile
+import pytest
+from ResultsStore import ResultsStore, importPaths
+from conftest import REPO, runScript
+
+legacyDir = os.path.join(REPO, 'test')
+
+
+# a store holding the legacy test/ profiles and a scored run imported as a directory,
+# a results.jsonl file, a run archive and an archive of _scores.txt files
+@pytest.fixture
+def store(workdir):
+  command = ['-file', os.path.join(REPO, 'called_mutations.txt'), '-backend', 'local']
+  assert runScript('ScoreMutations.py', command + ['-output', 'scored'], workdir).returncode == 0
+  assert runScript('ScoreMutations.py', command + ['-output', 'archived', '-archive', 'run.zip'], workdir).returncode == 0
+  with zipfile.ZipFile(str(workdir / 'legacy.zip'), 'w') as archive:
+    for name in sorted(os.listdir(legacyDir)):
+      archive.write(os.path.join(legacyDir, name), name)
+
+  store = ResultsStore(str(workdir / 'results.db'))
+  importPaths(store, [legacyDir, str(workdir / 'scored'), str(workdir / 'scored' / 'results.jsonl'),
+                      str(workdir / 'run.zip'), str(workdir / 'legacy.zip')])
+  yield store
+  store.close()
+
+
+@pytest.fixture
+def records(workdir, store):
+  with open(str(workdir / 'scored' / 'results.jsonl'), 'r') as infile:
+    return [json.loads(line) for line in infile]
+
+
+scoredRuns = ['scored', 'results.jsonl', 'run.zip']
+allRuns = ['test'] + scoredRuns + ['legacy.zip']
+
+
+def testRuns(store, records):
+  legacy = len([name for name in os.listdir(legacyDir) if name.endswith('_scores.txt')])
+  assert [(name, count) for run, name, source, created, count in store.runs()] == \
+    list(zip(allRuns, [legacy, len(records), len(records), len(records), legacy]))
+
+
+# a barcode has one result per run, the scored runs keep the record as it was written
+def testHistory(store, records):
+  record = records[0]
+  history = store.history(record['barcode'])
+  assert [name for name, created, stored in history] == allRuns
+  assert all(stored == record for name, created, stored in history if name in scoredRuns)
+  assert history[0][2] == history[-1][2]
+  assert store.history('AAAAAAAA+AAAAAAAA') == []
+
+
+def testAddRecords(store, records):
+  run = store.addRun('added')
+  store.addRecords(run, records[:2])
+  run, name, source, created, count = store.runs()[-1]
+  assert (name, source, count) == ('added', None, 2)
+  assert [name for name, created, stored in store.history(records[1]['barcode'])] == allRuns + ['added']
+  assert store.history(records[1]['barcode'])[-1][2] == records[1]
+
+
+def expectedMutations(records, mutation, minFrequency=0.0):
+  return [(record['barcode'], name, item['mutation'], item['frequency']) for name in scoredRuns for record in records
+          for item in record['mutations'] if item['mutation'] == mutation and item['frequency'] >= minFrequency]
+
+
+# a gene-qualified name matches the mutation column, a bare name every gene, and a minimum
+# frequency drops the legacy profiles that carry none
+def testWithMutation(store, records):
+  rows = store.withMutation('RT:K103N')
+  legacyRows = [row for row in rows if row[1] in ('test', 'legacy.zip')]
+  assert len(legacyRows) > 0 and all(row[2] == 'RT:K103N' and row[3] is None for row in legacyRows)
+  assert [row for row in rows if row[1] in scoredRuns] == expectedMutations(records, 'RT:K103N')
+  assert store.withMutation('K103N') == rows
+  assert store.withMutation('PR:K103N') == []
+
+  frequencies = sorted(row[3] for row in rows if row[3] is not None)
+  threshold = frequencies[len(frequencies) // 2]
+  filtered = store.withMutation('K103N', threshold)
+  assert filtered == store.withMutation('RT:K103N', threshold) == expectedMutations(records, 'RT:K103N', threshold)
+  assert 0 < len(filtered) < len(expectedMutations(records, 'RT:K103N'))
+
+
+# 3TC is stored and queried under one name whichever abbreviation the scores use
+def testAtLevel(store, records):
+  expected = [(record['barcode'], name, drugScore['score'], drugScore['level']) for name in scoredRuns for record in records
+              for gene in record['genes'] for drugScore in gene['drugScores']
+              if drugScore['drug'] == 'LMV' and drugScore['level'] >= 5]
+  rows = store.atLevel('LMV')
+  assert len(expected) > 0
+  assert [row for row in rows if row[1] in scoredRuns] == expected
+  assert store.atLevel('3TC') == rows
+  assert len([row for row in rows if row[1] == 'test']) == len([row for row in rows if row[1] == 'legacy.zip']) > 0
+  assert [row for row in store.atLevel('LMV', 3) if row[3] < 5 and row[1] in scoredRuns] == \
+    [(record['barcode'], name, drugScore['score'], drugScore['level']) for name in scoredRuns for record in records
+     for gene in record['genes'] for drugScore in gene['drugScores']
+     if drugScore['drug'] == 'LMV' and 3 <= drugScore['level'] < 5]
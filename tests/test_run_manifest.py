@@ -0,0 +1,21 @@
+from RunManifest import RunManifest
+
+
+def writeManifest(path, resume, keys):
+  manifest = RunManifest(str(path), ['local'], resume)
+  for key in keys:
+    manifest.record(key, 'scored', manifest.inputHash(key), manifest.outputHash(key))
+  manifest.close()
+  return manifest
+
+
+# a fresh run only appends its entries, a resumed run reads them back
+def testEntriesOnlyKeptWhenResuming(tmp_path):
+  path = tmp_path / 'manifest.jsonl'
+  assert writeManifest(path, False, ['a', 'b']).entries == {}
+  assert len(path.read_text().splitlines()) == 2
+
+  manifest = writeManifest(path, True, ['c'])
+  assert sorted(manifest.entries) == ['a', 'b', 'c']
+  assert manifest.current('a', manifest.inputHash('a'), 'a')
+  assert len(path.read_text().splitlines()) == 3
@@ -0,0 +1,26 @@
+from RunTimer import RunTimer
+
+
+def addSamples(timer):
+  for barcode in range(100):
+    with timer.stage('score', 1, [str(barcode)]):
+      pass
+
+
+# without detail only the per-stage totals are kept, however many barcodes are timed
+def testTotalsOnly():
+  timer = RunTimer()
+  addSamples(timer)
+  summary = timer.summary()
+  assert len(timer.samples) == 0 and len(timer.barcodes) == 0
+  assert summary['stages']['score']['count'] == 100
+  assert 'p95' not in summary['stages']['score'] and 'barcodes' not in summary
+  assert "score" in timer.report(summary)
+
+
+def testDetailed():
+  timer = RunTimer(detailed=True)
+  addSamples(timer)
+  summary = timer.summary()
+  assert summary['stages']['score']['p95'] <= summary['stages']['score']['max']
+  assert summary['barcodes']['count'] == 100 and len(summary['barcodes']['slowest']) == 10
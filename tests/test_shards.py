@@ -0,0 +1,81 @@
+import glob
+import os
+import zipfile
+from benchmark import makePlateFile
+from conftest import REPO, runScript
+
+mutationsFile = os.path.join(REPO, 'called_mutations.txt')
+
+
+# called_mutations.txt plus a synthetic plate split over two files
+def makeInputs(workdir, barcodes=400):
+  makePlateFile(barcodes, str(workdir / 'plate.txt'))
+  rows = (workdir / 'plate.txt').read_text().splitlines(True)
+  half = len(rows) // 2
+  while 0 < half < len(rows) and rows[half].split()[0] == rows[half - 1].split()[0]:
+    half += 1
+  (workdir / 'plates').mkdir()
+  (workdir / 'plates' / 'plate-a.txt').write_text("".join(rows[:half]))
+  (workdir / 'plates' / 'plate-b.txt').write_text("".join(rows[half:]))
+  return ['-file', mutationsFile, os.path.join('plates', '*.txt'), '-backend', 'local']
+
+
+def outputFiles(directory):
+  return {os.path.basename(filename): open(filename, 'rb').read() for filename in glob.glob(os.path.join(str(directory), '*'))}
+
+
+# shards run side by side and merged write every output file of the unsharded run
+def testMergedShardsMatchUnsharded(workdir):
+  command = makeInputs(workdir)
+  assert runScript('ScoreMutations.py', command + ['-output', 'single'], workdir).returncode == 0
+  for index in range(3):
+    process = runScript('ScoreMutations.py', command + ['-output', 'sharded', '-stream', '-shard', '%d/3' % index], workdir)
+    assert process.returncode == 0, process.stderr
+  process = runScript('ScoreMutations.py', command + ['-output', 'sharded', '-merge'], workdir)
+  assert process.returncode == 0, process.stderr
+
+  single = outputFiles(workdir / 'single')
+  merged = outputFiles(workdir / 'sharded')
+  for name, data in single.items():
+    assert merged.get(name) == data, name
+
+
+# -results and -manifest get shard names, so shards sharing them do not overwrite each other
+def testShardsOfExplicitResults(workdir):
+  command = makeInputs(workdir, 100) + ['-results', 'run.jsonl', '-manifest', 'run-manifest.jsonl', '-no-text']
+  assert runScript('ScoreMutations.py', command + ['-output', 'single'], workdir).returncode == 0
+  expected = (workdir / 'run.jsonl').read_bytes(), (workdir / 'run-manifest.jsonl').read_bytes()
+  for index in range(2):
+    assert runScript('ScoreMutations.py', command + ['-output', 'sharded', '-shard', '%d/2' % index], workdir).returncode == 0
+  for name in ('run', 'run-manifest'):
+    assert sorted(glob.glob(str(workdir / (name + '.shard-*')))) == [str(workdir / (name + '.shard-%d-of-2.jsonl' % index))
+                                                                     for index in range(2)]
+  os.remove(str(workdir / 'run.jsonl'))
+  os.remove(str(workdir / 'run-manifest.jsonl'))
+  assert runScript('ScoreMutations.py', command + ['-output', 'sharded', '-merge'], workdir).returncode == 0
+  assert ((workdir / 'run.jsonl').read_bytes(), (workdir / 'run-manifest.jsonl').read_bytes()) == expected
+
+
+def testMergeNeedsInputs(workdir):
+  process = runScript('ScoreMutations.py', ['-merge'], workdir)
+  assert process.returncode == 2
+  assert "-file is required" in process.stderr
+  assert "Traceback" not in process.stderr
+
+
+def archiveEntries(path):
+  with zipfile.ZipFile(str(path), 'r') as archive:
+    return [(name, archive.read(name)) for name in archive.namelist()]
+
+
+# the shard archives are merged into the archive a single run writes, entries in input order
+def testMergedShardArchives(workdir):
+  command = makeInputs(workdir, 100)
+  assert runScript('ScoreMutations.py', command + ['-output', 'single', '-archive', 'single.zip'], workdir).returncode == 0
+  for index in range(2):
+    process = runScript('ScoreMutations.py', command + ['-output', 'sharded', '-archive', 'run.zip', '-shard', '%d/2' % index],
+                        workdir)
+    assert process.returncode == 0, process.stderr
+  process = runScript('ScoreMutations.py', command + ['-output', 'sharded', '-archive', 'run.zip', '-merge'], workdir)
+  assert process.returncode == 0, process.stderr
+  assert archiveEntries(workdir / 'run.zip') == archiveEntries(workdir / 'single.zip')
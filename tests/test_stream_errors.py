@@ -0,0 +1,32 @@
+import os
+import zipfile
+import pytest
+from conftest import REPO, runScript
+
+
+def writeInput(workdir, extra):
+  with open(os.path.join(REPO, 'called_mutations.txt'), 'r') as infile:
+    rows = infile.readlines()
+  (workdir / 'input.txt').write_text("".join(rows) + extra(rows))
+
+
+# input errors found while streaming stop the run with a message and keep the previous archive
+@pytest.mark.parametrize("extra, message", [
+  (lambda rows: rows[0], "without -stream"),
+  (lambda rows: "AAAAAAAA+AAAAAAAA\tnot a row\n", "AAAAAAAA+AAAAAAAA"),
+], ids=["barcode split", "malformed row"])
+@pytest.mark.parametrize("script", ['ScoreMutations.py', 'pipeline.py'])
+def testStreamInputError(workdir, script, extra, message):
+  command = ['-file', os.path.join(REPO, 'called_mutations.txt'), '-backend', 'local', '-archive', 'run.zip']
+  assert runScript('ScoreMutations.py', command, workdir).returncode == 0
+  previous = (workdir / 'run.zip').read_bytes()
+
+  writeInput(workdir, extra)
+  process = runScript(script, ['-file', 'input.txt', '-backend', 'local', '-archive', 'run.zip', '-stream'], workdir)
+  assert process.returncode == 1
+  assert "Traceback" not in process.stderr
+  assert message in process.stderr
+  assert (workdir / 'run.zip').read_bytes() == previous
+  assert not (workdir / 'run.zip.tmp').exists()
+  with zipfile.ZipFile(str(workdir / 'run.zip'), 'r') as archive:
+    assert archive.testzip() is None
@@ -0,0 +1,43 @@
+import resource
+import subprocess
+import sys
+import zipfile
+from benchmark import makePlateFile
+from conftest import REPO, runScript
+
+
+def scorePlate(workdir, barcodes):
+  makePlateFile(barcodes, str(workdir / 'plate.txt'))
+  assert runScript('ScoreMutations.py', ['-file', 'plate.txt', '-backend', 'local', '-no-text'], workdir).returncode == 0
+
+
+# render a cohort workbook with at most 256 open files
+def renderWorkbook(workdir, sheets):
+  def limitFiles():
+    resource.setrlimit(resource.RLIMIT_NOFILE, (256, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))
+  return subprocess.run([sys.executable, REPO + '/looper.py', 'output/results.jsonl', '-formats', 'xlsx', '-workbook',
+                         'cohort.xlsx', '-sheets', str(sheets)], cwd=str(workdir), preexec_fn=limitFiles,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def sheetNames(path):
+  with zipfile.ZipFile(str(path), 'r') as workbook:
+    return sorted(name for name in workbook.namelist() if name.startswith('xl/worksheets/sheet'))
+
+
+# a cohort larger than the open file limit is split over several workbooks
+def testLargeCohortIsSplit(workdir):
+  scorePlate(workdir, 350)
+  process = renderWorkbook(workdir, 150)
+  assert process.returncode == 0, process.stderr
+  assert "cohort.xlsx, cohort-2.xlsx, cohort-3.xlsx" in process.stderr
+  # summary and cohort sheets only in the first workbook
+  assert [len(sheetNames(workdir / name)) for name in ('cohort.xlsx', 'cohort-2.xlsx', 'cohort-3.xlsx')] == [152, 150, 50]
+
+
+def testTooManySheetsFailBeforeWriting(workdir):
+  scorePlate(workdir, 10)
+  process = renderWorkbook(workdir, 1000)
+  assert process.returncode == 1
+  assert "open files" in process.stderr
+  assert not (workdir / 'cohort.xlsx').exists()